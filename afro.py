@@ -1,22 +1,36 @@
 import os
-import subprocess
 import random
+from functools import lru_cache
+import numpy as np
 from pydub import AudioSegment, effects
-from hashlib import sha1
+from song_plan import pattern_hash, list_wav_files, new_seed, write_manifest
+from uniqueness_store import get_pattern_store, record_shipped
+from fingerprint_index import get_fingerprint_index, compute_fingerprint
+from plan_enumerator import CombinationSpace, EnumerationCursor
+from effects_chain import EffectChain
+from timeline import Timeline, load_frames, segment_frames, section_fades, SECTION_CROSSFADE_MS, LOOP_SEAM_FRAMES, SEAM_JUMP
+from instrumentation import stage, song as song_metrics, write_batch_summary, count_cache, register_cache_info
+from metrics_exporter import MetricsExporter
+from wav_writer import write_limited
+from run_journal import RunJournal
+from sample_analysis import drop_mislabelled
 
 # Configuration
 NUM_SONGS = 1000
 SONG_LENGTH_SEC = 180
+LIMITER_LEVEL = 0.8
 DEFAULT_SECTION_DURATION_SEC = 24
 SHORT_SECTION_DURATION_SEC = 12
+ENUMERATION_SEED = 0
+COMBINATION_ATTEMPTS = 5   # plans tried on one enumerated combination before it is given up
+DECODED_CACHE_ITEMS = 64  # decoded samples kept across songs
+CORE_LAYERS = ["drums", "chords", "bass", "melody"]
+MASTER_EFFECTS = []  # effect specs for the master bus, e.g. [{"type": "wah", "bpm": None}]
 
 # Paths
 SAMPLES_DIR = "samples"
 GLOBAL_DRUMS_DIR = os.path.join(SAMPLES_DIR, "drums")
 OUTPUT_DIR = "output_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-used_patterns = set()
 
 def get_key_bpm_folders():
     return [
@@ -24,14 +38,19 @@ def get_key_bpm_folders():
         if os.path.isdir(os.path.join(SAMPLES_DIR, f)) and "_" in f and f != "drums"
     ]
 
+@lru_cache(maxsize=DECODED_CACHE_ITEMS)
 def load_and_adjust_sample(path, target_bpm):
-    return AudioSegment.from_wav(path)
+    """Decoded once per process; AudioSegments are immutable, so songs share them safely"""
+    with stage("decode"):
+        return AudioSegment.from_wav(path)
+
+register_cache_info("afro_decoded", load_and_adjust_sample.cache_info)
 
-def create_section(key_bpm_dir, section_layers, target_bpm, cached_drum=None, section_name=None, static_layers={}):
+def plan_section(key_bpm_dir, section_layers, section_name, static_layers, file_cache=None, rng=random):
+    """Choose samples, gains and ambient treatments for a section without touching any audio"""
     section_duration = SHORT_SECTION_DURATION_SEC if section_name in ["intro", "breakdown", "outro"] else DEFAULT_SECTION_DURATION_SEC
     duration_ms = section_duration * 1000
-    section = AudioSegment.silent(duration=duration_ms)
-    used_files = []
+    layers = []
 
     gain_per_layer = -3 if len(section_layers) >= 4 else -2
 
@@ -40,74 +59,91 @@ def create_section(key_bpm_dir, section_layers, target_bpm, cached_drum=None, se
         if not os.path.isdir(folder):
             continue
 
-        if layer == "drums" and cached_drum:
-            sample = cached_drum
-            chosen = "cached_drum.wav"
-        elif layer in static_layers:
-            sample = static_layers[layer]
-            chosen = f"cached_{layer}.wav"
+        if layer in static_layers:
+            source = static_layers[layer]
         else:
-            files = [f for f in os.listdir(folder) if f.endswith(".wav")]
+            files = drop_mislabelled(folder, list_wav_files(folder, file_cache))
             if not files:
                 continue
 
             if section_name == "intro" and layer == "ambient":
-                num_layers = random.choice([2, 3])
-                ambient_samples = random.sample(files, min(num_layers, len(files)))
-                combined = AudioSegment.silent(duration=duration_ms)
-                for amb_file in ambient_samples:
-                    amb_sample = load_and_adjust_sample(os.path.join(folder, amb_file), target_bpm)
-
-                    if len(amb_sample) > 3000:
-                        offset = random.randint(0, min(2000, len(amb_sample) - 1000))
-                        amb_sample = amb_sample[offset:]
-
-                    if random.random() < 0.3:
-                        amb_sample = amb_sample.reverse()
-
-                    if random.random() < 0.4:
-                        pitch_factor = 2 ** (random.uniform(-2, 2) / 12.0)
-                        amb_sample = amb_sample._spawn(amb_sample.raw_data, overrides={
-                            "frame_rate": int(amb_sample.frame_rate * pitch_factor)
-                        }).set_frame_rate(amb_sample.frame_rate)
-
-                    amb_sample = amb_sample + random.randint(-6, 3)
-                    pan = random.uniform(-0.8, 0.8)
-                    amb_sample = amb_sample.pan(pan)
-
-                    combined = combined.overlay(amb_sample[:duration_ms])
-                    used_files.append(f"{layer}/{amb_file}")
-
-                static_layers["ambient"] = combined
+                num_layers = rng.choice([2, 3])
+                parts = []
+                for amb_file in rng.sample(files, min(num_layers, len(files))):
+                    treatments = []
+                    if rng.random() < 0.3:
+                        treatments.append({"type": "reverse"})
+                    if rng.random() < 0.4:
+                        treatments.append({"type": "pitch", "factor": 2 ** (rng.uniform(-2, 2) / 12.0)})
+                    treatments.append({"type": "gain", "db": rng.randint(-6, 3)})
+                    treatments.append({"type": "pan", "position": rng.uniform(-0.8, 0.8)})
+                    parts.append({
+                        "path": os.path.join(folder, amb_file),
+                        # Clamped against the sample length at render time
+                        "offset_ms": rng.randint(0, 2000),
+                        "effects": treatments,
+                    })
+                static_layers["ambient"] = {"parts": parts, "duration_ms": duration_ms}
                 continue
 
-            chosen = random.choice(files)
-            sample = load_and_adjust_sample(os.path.join(folder, chosen), target_bpm)
-
-            if layer == "drums":
-                cached_drum = sample
-            if layer in ["chords", "bass", "ambient", "melody", "fx"]:
-                static_layers[layer] = sample
+            source = {"path": os.path.join(folder, rng.choice(files))}
+            if layer in ["drums", "chords", "bass", "ambient", "melody", "fx"]:
+                static_layers[layer] = source
 
-        sample = sample + gain_per_layer
-        section = section.overlay(sample[:duration_ms])
-        used_files.append(f"{layer}/{chosen}")
+        layers.append({"layer": layer, "source": source, "gain_db": gain_per_layer})
 
     # Always overlay cached ambient sample even if it's not in this section's layers
     if "ambient" in static_layers:
-        ambient_sample = static_layers["ambient"]
-        ambient_overlay = ambient_sample - 6
-        ambient_overlay = ambient_overlay[:duration_ms]
-        section = section.overlay(ambient_overlay)
-
-    return section, used_files, cached_drum, static_layers
-
-def generate_lofi_song(index):
-    key_bpm_dir = random.choice(get_key_bpm_folders())
+        layers.append({"layer": "ambient_bed", "source": static_layers["ambient"], "gain_db": -6})
+
+    return {"name": section_name, "duration_ms": duration_ms, "layers": layers}
+
+def source_paths(source):
+    if "parts" in source:
+        return [part["path"] for part in source["parts"]]
+    return [source["path"]]
+
+def plan_sample_paths(plan):
+    paths = []
+    for section in plan["sections"]:
+        for layer in section["layers"]:
+            paths.extend(source_paths(layer["source"]))
+        if "riser" in section:
+            paths.append(section["riser"]["path"])
+    return paths
+
+def build_combination_space(seed=ENUMERATION_SEED):
+    """One mixed-radix group per key/BPM folder: drums x chords x bass x melody choices"""
+    drum_files = drop_mislabelled(GLOBAL_DRUMS_DIR, list_wav_files(GLOBAL_DRUMS_DIR))
+    catalog = []
+    for folder in sorted(get_key_bpm_folders()):
+        layer_files = {"drums": drum_files}
+        for layer in CORE_LAYERS[1:]:
+            layer_dir = os.path.join(SAMPLES_DIR, folder, layer)
+            layer_files[layer] = drop_mislabelled(layer_dir, list_wav_files(layer_dir))
+        catalog.append((folder, layer_files))
+    space = CombinationSpace([[len(files[layer]) for layer in CORE_LAYERS] for _, files in catalog], seed)
+    return space, catalog
+
+def plan_song(combination=None, catalog=None, rng=random):
+    """Pick folder, sections, risers and every sample for a song; returns a plan with its pattern_id and duration.
+
+    An enumerated combination fixes the folder and the static drums, chords, bass and melody;
+    everything else comes from rng.
+    """
+    static_layers = {}
+    file_cache = {}
+    if combination is not None:
+        group, digits = combination
+        key_bpm_dir, layer_files = catalog[group]
+        for layer, digit in zip(CORE_LAYERS, digits):
+            if layer_files[layer]:
+                folder = GLOBAL_DRUMS_DIR if layer == "drums" else os.path.join(SAMPLES_DIR, key_bpm_dir, layer)
+                static_layers[layer] = {"path": os.path.join(folder, layer_files[layer][digit])}
+    else:
+        key_bpm_dir = rng.choice(sorted(get_key_bpm_folders()))
     bpm_str, _ = key_bpm_dir.split("_", 1)
     bpm = int(bpm_str)
-    cached_drum = None
-    static_layers = {}
 
     structure = [
         "intro",
@@ -130,80 +166,215 @@ def generate_lofi_song(index):
         "outro":        ["ambient", "chords"]
     }
 
-    song = AudioSegment.silent(duration=0)
+    sections = []
     pattern_id = []
+    duration_ms = 0
 
     for i, section_name in enumerate(structure):
-        section, used, cached_drum, static_layers = create_section(
-            key_bpm_dir,
-            section_presets[section_name],
-            bpm,
-            cached_drum,
-            section_name=section_name,
-            static_layers=static_layers
-        )
-
-        # Overlay riser
+        section = plan_section(key_bpm_dir, section_presets[section_name], section_name, static_layers, file_cache, rng)
+
+        # Riser blended into the tail of the song before this section
         if section_name in ["beat_drop", "return_loop"] and i > 0:
-            riser_path = os.path.join(SAMPLES_DIR, key_bpm_dir, "risers")
-            if os.path.isdir(riser_path):
-                riser_files = [f for f in os.listdir(riser_path) if f.endswith(".wav")]
-                if riser_files:
-                    riser_file = random.choice(riser_files)
-                    riser_sample = load_and_adjust_sample(os.path.join(riser_path, riser_file), bpm)
-                    riser_sample = riser_sample - 3
-                    riser_duration = len(riser_sample)
-                    song_duration = len(song)
-
-                    if song_duration >= riser_duration:
-                        tail = song[-riser_duration:]
-                        blended = tail.overlay(riser_sample)
-                        song = song[:-riser_duration] + blended
-                    else:
-                        blended = song.overlay(riser_sample[-song_duration:])
-                        song = blended
-
-        song += section
-        pattern_id.append(tuple(sorted(used)))
-
-        if song.duration_seconds >= SONG_LENGTH_SEC:
+            riser_files = list_wav_files(os.path.join(SAMPLES_DIR, key_bpm_dir, "risers"), file_cache)
+            if riser_files:
+                section["riser"] = {
+                    "path": os.path.join(SAMPLES_DIR, key_bpm_dir, "risers", rng.choice(riser_files)),
+                    "gain_db": -3,
+                }
+
+        sections.append(section)
+        pattern_id.append(tuple(sorted(
+            path for layer in section["layers"] if layer["layer"] != "ambient_bed"
+            for path in source_paths(layer["source"])
+        )))
+        duration_ms += section["duration_ms"]
+
+        if duration_ms >= SONG_LENGTH_SEC * 1000:
             break
 
-    if song.duration_seconds < 150:
-        return False
-
-    song = song.fade_in(3000).fade_out(4000)
-    song = effects.normalize(song)
+    return {
+        "bpm": bpm,
+        "key_bpm_dir": key_bpm_dir,
+        "sections": sections,
+        "pattern_id": pattern_id,
+        "duration_ms": duration_ms,
+        "master_effects": MASTER_EFFECTS,
+    }
 
-    song_hash = sha1(str(pattern_id).encode()).hexdigest()
-    if song_hash in used_patterns:
+def render_ambient_bed(source, sample_cache, target_bpm):
+    duration_ms = source["duration_ms"]
+    combined = AudioSegment.silent(duration=duration_ms)
+    for part in source["parts"]:
+        amb_sample = load_cached_sample(part["path"], sample_cache, target_bpm)
+
+        if len(amb_sample) > 3000:
+            offset = min(part["offset_ms"], len(amb_sample) - 1000)
+            amb_sample = amb_sample[offset:]
+
+        # Reverse, pitch, gain and pan in one NumPy pass
+        with stage("effects"):
+            amb_sample = EffectChain(part["effects"]).apply_to_segment(amb_sample)
+
+        with stage("overlay"):
+            combined = combined.overlay(amb_sample[:duration_ms])
+    return combined
+
+def load_cached_sample(path, sample_cache, target_bpm):
+    count_cache("sample", path in sample_cache)
+    if path not in sample_cache:
+        sample_cache[path] = load_and_adjust_sample(path, target_bpm)
+    return sample_cache[path]
+
+def render_source(source, sample_cache, target_bpm):
+    if "parts" in source:
+        # Keyed by content rather than identity so a plan loaded from a manifest renders the bed once too
+        key = repr(source)
+        if key not in sample_cache:
+            sample_cache[key] = render_ambient_bed(source, sample_cache, target_bpm)
+        return sample_cache[key]
+    return load_cached_sample(source["path"], sample_cache, target_bpm)
+
+def source_key(source):
+    return repr(source) if "parts" in source else source["path"]
+
+def render_section(timeline, offset, section, sample_cache, target_bpm, fades=None):
+    """Place each layer of a section from frame offset, cut at the section end. A layer still sounding
+    there fades out: over the crossfade when the next section drops it, over a few ms when it restarts.
+    A sample that starts or stops mid-waveform gets a few ms of fade there too."""
+    length = timeline.frame_at(section["duration_ms"])
+    for layer in section["layers"]:
+        key = source_key(layer["source"])
+        if ("frames", key) not in sample_cache:
+            sample_cache[("frames", key)] = segment_frames(render_source(layer["source"], sample_cache, target_bpm))
+        frames = sample_cache[("frames", key)]
+        frames = frames[:length]
+        if len(sample_cache[("frames", key)]) > length:
+            fade_out = (fades or {}).get(key, (0, 0))[1] or LOOP_SEAM_FRAMES
+        else:
+            fade_out = LOOP_SEAM_FRAMES if len(frames) and np.abs(frames[-1]).max() > SEAM_JUMP else 0
+        fade_in = LOOP_SEAM_FRAMES if len(frames) and np.abs(frames[0]).max() > SEAM_JUMP else 0
+        with stage("place"):
+            timeline.place(frames, offset, layer["gain_db"], fade_in, fade_out)
+
+def mix_song(plan):
+    """Every section of the plan on one float Timeline, before mastering"""
+    bpm = plan["bpm"]
+    sample_cache = {}
+    timeline = Timeline(plan["duration_ms"])
+    fades = section_fades(
+        [[source_key(layer["source"]) for layer in section["layers"]] for section in plan["sections"]],
+        timeline.frame_at(SECTION_CROSSFADE_MS),
+    )
+
+    offset = 0
+    for section, section_fade in zip(plan["sections"], fades):
+        # Riser ends exactly where this section starts; a riser longer than the song so far keeps its tail
+        if "riser" in section and offset > 0:
+            riser = load_frames(section["riser"]["path"])
+            with stage("place"):
+                timeline.place(riser, offset - len(riser), section["riser"]["gain_db"])
+
+        render_section(timeline, offset, section, sample_cache, bpm, section_fade)
+        offset += timeline.frame_at(section["duration_ms"])
+    return timeline
+
+def master_song(plan, timeline):
+    with stage("master"):
+        song = timeline.to_segment()
+        song = EffectChain(plan.get("master_effects", [])).apply_to_segment(song)
+        song = song.fade_in(3000).fade_out(4000)
+        return effects.normalize(song)
+
+def render_song(plan):
+    return master_song(plan, mix_song(plan))
+
+def export_song(song, filename):
+    write_limited(song, filename, LIMITER_LEVEL)
+
+def generate_lofi_song(index, combination=None, catalog=None, seed=None, journal=None):
+    # Every choice for this song comes from its own seeded generator, recorded in the manifest
+    seed = new_seed() if seed is None else seed
+    with stage("plan"):
+        plan = plan_song(combination, catalog, random.Random(seed))
+
+    # Reject short songs and duplicates from the plan alone, before any audio is decoded
+    if plan["duration_ms"] < 150 * 1000:
         return False
-    used_patterns.add(song_hash)
-
-    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}.wav")
-    song.export(filename, format="wav")
 
-    limited_file = filename.replace(".wav", "_limited.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-i", filename,
-        "-af", "alimiter=limit=0.8",
-        limited_file
-    ])
-    os.remove(filename)
-    os.rename(limited_file, filename)
+    song_hash = pattern_hash(plan["pattern_id"])
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            return False
+
+    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}_{song_hash:016x}.wav")
+    # Written before rendering so a song that hangs or crashes can still be replayed; removed again
+    # when the song is rejected, so every manifest left names a song that shipped or never finished
+    manifest = write_manifest("afro", "afro", index, seed, song_hash, plan, plan_sample_paths(plan), filename, combination)
+
+    with stage("render"):
+        timeline = mix_song(plan)
+
+    # Perceptual check on the float mix catches different plans that still sound the same; the master
+    # chain is the same for every song, so it runs only once the song is kept
+    with stage("fingerprint"):
+        fingerprint = compute_fingerprint(timeline.buffer, timeline.sample_rate)
+        if get_fingerprint_index().find_near_duplicate(fingerprint) is not None:
+            print("❌ Song too similar to an existing one.")
+            os.remove(manifest)
+            return False
+
+    song = master_song(plan, timeline)
+    export_song(song, filename)
+    if not record_shipped(song_hash, filename):
+        os.remove(manifest)
+        return False
+    get_fingerprint_index().add(song_hash, fingerprint)
+    if journal is not None:
+        journal.record(index, song_hash, filename, seed=seed)
 
     return True
 
 def main():
-    count = 0
-    attempts = 0
-    while count < NUM_SONGS and attempts < NUM_SONGS * 5:
-        if generate_lofi_song(count + 1):
-            print(f"✔️ Generated song {count + 1}")
-            count += 1
-        else:
-            print("⚠️ Skipped duplicate pattern")
-        attempts += 1
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    space, catalog = build_combination_space()
+    cursor = EnumerationCursor("afro", space)
+    print(f"🎲 {cursor.remaining()} unique songs left in this sample library")
+
+    journal = RunJournal("afro")
+    count = journal.resume()
+    with MetricsExporter("afro", total=max(NUM_SONGS - count, 0)) as exporter:
+        exporter.set_queue("unique_combinations_left", cursor.remaining)
+        song_index = None
+        index, attempts = None, 0
+        try:
+            while count < NUM_SONGS:
+                if index is None:
+                    index = cursor.take()
+                    if index is None:
+                        print("🏁 Every unique combination has been generated")
+                        break
+                # The journal index and the combination are both kept until a song actually lands, so a
+                # rejected plan re-plans the same combination with a new seed instead of using it up
+                song_index = song_index or journal.claim()
+                with song_metrics("afro", song_index) as record:
+                    generated = generate_lofi_song(song_index, space.combination(index), catalog, journal=journal)
+                    record["outcome"] = "ok" if generated else "skipped"
+                attempts += 1
+                if generated:
+                    print(f"✔️ Generated song {song_index}")
+                    count += 1
+                    song_index = None
+                    index, attempts = None, 0
+                elif attempts >= COMBINATION_ATTEMPTS:
+                    print(f"⚠️ Giving up on combination {index} after {attempts} rejected plans")
+                    index, attempts = None, 0
+                else:
+                    print("⚠️ Skipped duplicate pattern, re-planning the same combination")
+        finally:
+            if index is not None:
+                cursor.release(index)
+
+    write_batch_summary("afro")
 
 if __name__ == "__main__":
     main()
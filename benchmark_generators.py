@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import importlib
+import subprocess
+from hashlib import blake2b
+import numpy as np
+from scipy.io import wavfile
+
+# === CONFIGURATION ===
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.path.join(REPO_DIR, "song_state", "benchmark_history.jsonl")
+SAMPLE_RATE = 44100
+SONGS_PER_GENERATOR = 5
+SAMPLES_PER_LAYER = 4
+SAMPLE_SECONDS = 8
+LIBRARY_BPMS = [80, 90]
+LIBRARY_KEYS = ["am", "c", "em", "g"]
+THROUGHPUT_TOLERANCE = 0.15  # fail if songs/min drops by more than this fraction
+MEMORY_TOLERANCE = 0.20      # fail if per-song peak memory or peak RSS grows by more than this fraction
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+# module -> (song count constant, metrics name used by its main loop)
+GENERATORS = {
+    "final_main": ("NUM_SONGS", "lofi"),
+    "edm": ("SONG_COUNT", "edm"),
+    "edm_cohesion": ("SONG_COUNT", "edm_cohesion"),
+    "afro": ("NUM_SONGS", "afro"),
+    "piano": ("NUM_SONGS", "piano"),
+}
+
+LOFI_LAYERS = ["chords", "bass", "melody", "ambient", "fx", "risers"]
+EDM_LAYERS = ["drums", "chords", "bass", "leads", "fx", "vocals", "builds", "risers"]
+NOTE_FREQS = {"c": 261.6, "g": 196.0, "am": 220.0, "em": 164.8}
+
+
+def synth_loop(rng, seconds, root_hz, kind, sample_rate=SAMPLE_RATE):
+    """A stereo 16-bit loop: decaying noise hits for drums, a few detuned partials for everything else"""
+    frames = int(seconds * sample_rate)
+    t = np.arange(frames) / sample_rate
+    if kind == "drums":
+        hits = np.zeros(frames)
+        hits[::sample_rate // 2] = 1.0
+        signal = np.convolve(hits, np.exp(-np.arange(4000) / 400.0))[:frames] * rng.uniform(-1, 1, frames)
+    else:
+        ratios = rng.choice([1, 1.25, 1.5, 2, 3], size=3, replace=False)
+        signal = sum(np.sin(2 * np.pi * root_hz * r * t + rng.uniform(0, np.pi)) for r in ratios) / 3
+        signal *= 0.6 + 0.4 * np.sin(2 * np.pi * rng.uniform(0.1, 1.0) * t)
+    stereo = np.stack([signal, np.roll(signal, rng.integers(1, 400))], axis=1) * 0.4
+    return (stereo * 32767).astype(np.int16)
+
+
+def write_samples(rng, folder, count, seconds, root_hz, kind):
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        path = os.path.join(folder, f"{kind}_{i:02d}.wav")
+        wavfile.write(path, SAMPLE_RATE, synth_loop(rng, seconds * rng.uniform(0.75, 1.25), root_hz, kind))
+
+
+def build_synthetic_library(root, samples_per_layer=SAMPLES_PER_LAYER, sample_seconds=SAMPLE_SECONDS, seed=0):
+    """Lay out samples/, edm_samples/ and samples_piano_nature/ the way the generators expect"""
+    rng = np.random.default_rng(seed)
+    samples_dir = os.path.join(root, "samples")
+    for bpm in LIBRARY_BPMS:
+        write_samples(rng, os.path.join(samples_dir, "drums", str(bpm)), samples_per_layer, sample_seconds, 0, "drums")
+        for key in LIBRARY_KEYS:
+            for layer in LOFI_LAYERS:
+                folder = os.path.join(samples_dir, f"{bpm}_{key}", layer)
+                write_samples(rng, folder, samples_per_layer, sample_seconds, NOTE_FREQS[key], layer)
+    # afro picks its drums straight from samples/drums
+    write_samples(rng, os.path.join(samples_dir, "drums"), samples_per_layer, sample_seconds, 0, "drums")
+
+    for layer in EDM_LAYERS:
+        folder = os.path.join(root, "edm_samples", "120_house", layer)
+        write_samples(rng, folder, samples_per_layer, sample_seconds, 220.0, "drums" if layer == "drums" else layer)
+
+    piano_dir = os.path.join(root, "samples_piano_nature")
+    write_samples(rng, os.path.join(piano_dir, "piano"), max(3, samples_per_layer), sample_seconds, 261.6, "piano")
+    write_samples(rng, os.path.join(piano_dir, "nature"), 2, sample_seconds, 80.0, "nature")
+
+
+def library_key(samples_per_layer, sample_seconds, seed, memory):
+    """Runs are only compared with earlier runs on the same library; tracemalloc slows rendering, so memory mode is part of it"""
+    layout = [samples_per_layer, sample_seconds, seed, LIBRARY_BPMS, LIBRARY_KEYS, SAMPLE_RATE, memory]
+    return blake2b(json.dumps(layout).encode(), digest_size=6).hexdigest()
+
+
+def skip_limiter(cmd, *args, **kwargs):
+    """Stand-in for the piped ffmpeg limiter on machines without ffmpeg: returns the audio unchanged"""
+    return subprocess.CompletedProcess(cmd, 0, stdout=kwargs["input"], stderr=b"")
+
+
+def run_child(module_name, songs, seed):
+    """Runs inside the library directory: generate songs with one generator and report its metrics"""
+    sys.path.insert(0, REPO_DIR)
+    from instrumentation import peak_rss_mb
+    random.seed(seed)
+    if not shutil.which("ffmpeg"):
+        subprocess.run = skip_limiter
+    count_attr, metrics_name = GENERATORS[module_name]
+    module = importlib.import_module(module_name)
+    setattr(module, count_attr, songs)
+    module.main()
+
+    with open(os.path.join("song_state", "metrics", f"{metrics_name}.jsonl")) as f:
+        batch = [json.loads(line) for line in f if '"type": "batch"' in line][-1]
+    print(RESULT_PREFIX + json.dumps({
+        "songs": batch["songs"],
+        "songs_per_minute": batch["songs_per_minute"],
+        "song_sec": batch["total"],
+        "stages": {name: {"p50": s["p50"], "p95": s["p95"]} for name, s in batch["stages"].items()},
+        "song_peak_mb": batch["memory"]["song_peak_mb"] if "memory" in batch else None,
+        "stage_peak_mb": {name: s["p95"] for name, s in batch.get("memory", {}).get("stages", {}).items()},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }))
+
+
+def run_generator(module_name, library_dir, songs, seed, memory=True):
+    """Fresh interpreter per generator so peak RSS and module state are its own"""
+    state_dir = os.path.join(library_dir, "song_state")
+    shutil.rmtree(state_dir, ignore_errors=True)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", module_name, "--songs", str(songs), "--seed", str(seed)],
+        cwd=library_dir, capture_output=True, text=True, env={**os.environ, "SONG_MEMORY": "1" if memory else "0"}
+    )
+    wall = time.perf_counter() - start
+    for line in proc.stdout.splitlines():
+        if "budget" in line:
+            print(f"   {line}")
+    results = [line[len(RESULT_PREFIX):] for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if proc.returncode != 0 or not results:
+        print(f"❌ {module_name} failed:\n{proc.stderr[-2000:]}")
+        return None
+    result = json.loads(results[-1])
+    result["process_sec"] = round(wall, 3)
+    return result
+
+
+def load_previous(history_path, key):
+    if not os.path.exists(history_path):
+        return None
+    previous = None
+    with open(history_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("library") == key:
+                previous = entry
+    return previous
+
+
+def check_regressions(current, previous):
+    """Compare songs/min and memory peaks with the previous run on the same library; returns a list of messages"""
+    problems = []
+    for name, result in current["generators"].items():
+        before = (previous or {}).get("generators", {}).get(name)
+        if not result or not before:
+            continue
+        if result["songs_per_minute"] < before["songs_per_minute"] * (1 - THROUGHPUT_TOLERANCE):
+            problems.append(
+                f"{name}: {result['songs_per_minute']:.2f} songs/min vs {before['songs_per_minute']:.2f} previously"
+            )
+        if result.get("song_peak_mb") and before.get("song_peak_mb"):
+            now, then = result["song_peak_mb"]["p95"], before["song_peak_mb"]["p95"]
+            if now > then * (1 + MEMORY_TOLERANCE):
+                problems.append(f"{name}: peak memory per song {now:.0f}MB vs {then:.0f}MB previously")
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + MEMORY_TOLERANCE):
+            problems.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f}MB vs {before['peak_rss_mb']:.0f}MB previously")
+    return problems
+
+
+def print_report(results):
+    print(f"\n{'generator':14} {'songs/min':>10} {'song p50':>10} {'song p95':>10} {'mem/song':>10} {'peak RSS':>10}   slowest stages (p50)")
+    for name, result in results.items():
+        if not result:
+            print(f"{name:14} {'failed':>10}")
+            continue
+        song = result["song_sec"] or {"p50": 0, "p95": 0}
+        slowest = sorted(result["stages"].items(), key=lambda item: -item[1]["p50"])[:3]
+        stages = ", ".join(f"{stage} {s['p50'] * 1000:.0f}ms" for stage, s in slowest)
+        song_mb = (result.get("song_peak_mb") or {"p95": 0})["p95"]
+        print(f"{name:14} {result['songs_per_minute']:10.2f} {song['p50']:9.2f}s {song['p95']:9.2f}s "
+              f"{song_mb:8.0f}MB {result['peak_rss_mb']:8.0f}MB   {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end generator benchmarks on a synthetic sample library")
+    parser.add_argument("--songs", type=int, default=SONGS_PER_GENERATOR)
+    parser.add_argument("--samples-per-layer", type=int, default=SAMPLES_PER_LAYER)
+    parser.add_argument("--sample-seconds", type=float, default=SAMPLE_SECONDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generators", nargs="+", choices=list(GENERATORS), default=list(GENERATORS))
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc to time rendering at full speed")
+    parser.add_argument("--library", help="reuse or create the synthetic library in this folder")
+    parser.add_argument("--history", default=HISTORY_PATH)
+    parser.add_argument("--child", choices=list(GENERATORS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.songs, args.seed)
+        return
+
+    library_dir = args.library or tempfile.mkdtemp(prefix="song_bench_")
+    if not os.path.isdir(os.path.join(library_dir, "samples")):
+        print(f"🧪 Building synthetic library in {library_dir}")
+        build_synthetic_library(library_dir, args.samples_per_layer, args.sample_seconds, args.seed)
+    if not shutil.which("ffmpeg"):
+        print("ℹ️ ffmpeg not found — the limiter passes audio through unchanged")
+
+    results = {}
+    for name in args.generators:
+        print(f"⏱️ {name}: {args.songs} songs")
+        results[name] = run_generator(name, library_dir, args.songs, args.seed, not args.no_memory)
+    print_report(results)
+
+    key = library_key(args.samples_per_layer, args.sample_seconds, args.seed, not args.no_memory)
+    entry = {"time": time.time(), "library": key, "songs": args.songs, "generators": results}
+    problems = check_regressions(entry, load_previous(args.history, key))
+
+    os.makedirs(os.path.dirname(args.history), exist_ok=True)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    if not args.library:
+        shutil.rmtree(library_dir, ignore_errors=True)
+
+    if problems:
+        print("\n❌ Regressions against the previous run:")
+        for problem in problems:
+            print(f"   {problem}")
+        sys.exit(1)
+    print("\n✅ No regressions against the previous run")
+
+
+if __name__ == "__main__":
+    main()
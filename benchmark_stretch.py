@@ -0,0 +1,90 @@
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from scipy.io import wavfile
+from stretch_cache import read_wav_float
+from time_stretch import TIERS, stretch
+
+# === CONFIGURATION ===
+SAMPLE_RATE = 44100
+SAMPLE_SECONDS = 10
+RATES = [90 / 80, 80 / 90, 0.97]
+REPEATS = 3
+
+
+def make_test_loop(seconds=SAMPLE_SECONDS, sample_rate=SAMPLE_RATE):
+    """Stereo loop with a click track and a detuned chord so both transients and tones are exercised"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    chord = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6)) / 6
+    clicks = np.zeros_like(t)
+    clicks[::sample_rate // 2] = 1.0
+    clicks = np.convolve(clicks, np.exp(-np.arange(2000) / 200.0))[:t.size] * 0.5
+    left = chord + clicks
+    right = np.roll(chord, 441) + clicks
+    return np.stack([left, right], axis=1).astype(np.float32)
+
+
+def ffmpeg_atempo(path, rate):
+    """The old main5 path: spawn ffmpeg with an atempo chain through a temporary file"""
+    filters = []
+    remaining = rate
+    while remaining < 0.5 or remaining > 2.0:
+        step = 2.0 if remaining > 2.0 else 0.5
+        filters.append(f"atempo={step}")
+        remaining /= step
+    filters.append(f"atempo={remaining:.6f}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, "stretched.wav")
+        subprocess.run(
+            ["ffmpeg", "-y", "-i", path, "-filter:a", ",".join(filters), output_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+        )
+        return read_wav_float(output_path)[0]
+
+
+def librosa_stretch(path, rate):
+    """The old script.py/piano.py path: mono load plus librosa's phase vocoder"""
+    import librosa
+    y, _ = librosa.load(path, sr=None)
+    return librosa.effects.time_stretch(y=y, rate=rate)
+
+
+def time_call(fn, *args):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    samples = make_test_loop()
+    contenders = [(f"numpy:{tier}", lambda path, rate, tier=tier: stretch(read_wav_float(path)[0], rate, tier)) for tier in TIERS]
+    if shutil.which("ffmpeg"):
+        contenders.append(("ffmpeg:atempo", ffmpeg_atempo))
+    else:
+        print("ℹ️ ffmpeg not found — skipping the ffmpeg baseline")
+    try:
+        import librosa  # noqa: F401
+        contenders.append(("librosa:phase_vocoder (mono)", librosa_stretch))
+    except ImportError:
+        print("ℹ️ librosa not installed — skipping the librosa baseline")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "loop.wav")
+        wavfile.write(path, SAMPLE_RATE, (samples * 32767).astype(np.int16))
+
+        print(f"⏱️ Stretching a {SAMPLE_SECONDS}s stereo loop, best of {REPEATS} runs\n")
+        print(f"{'engine':32} " + " ".join(f"{f'rate {r:.3f}':>16}" for r in RATES))
+        for name, fn in contenders:
+            timings = [time_call(fn, path, rate) for rate in RATES]
+            cells = [f"{t * 1000:7.1f}ms {SAMPLE_SECONDS / t:5.0f}x" for t in timings]
+            print(f"{name:32} " + " ".join(f"{c:>16}" for c in cells))
+
+
+if __name__ == "__main__":
+    main()
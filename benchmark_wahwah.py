@@ -0,0 +1,67 @@
+import time
+import numpy as np
+from scipy.signal import butter, lfilter
+import wahwah
+
+# === CONFIGURATION ===
+SAMPLE_RATE = 44100
+MINUTES = 1.0
+REPEATS = 3
+
+
+def legacy_wahwah_effect(data, samplerate):
+    """The original implementation: a fresh butter design and zero-state lfilter per 1024-sample chunk"""
+    t = np.arange(len(data)) / samplerate
+    mod = (np.sin(2 * np.pi * wahwah.LFO_FREQ * t) + 1) / 2
+    freqs = wahwah.CENTER_FREQ * (1 - wahwah.DEPTH + wahwah.DEPTH * mod)
+    processed = np.zeros_like(data, dtype=np.float32)
+    for i in range(0, len(data), 1024):
+        fc = freqs[i]
+        bw = fc / wahwah.RESONANCE
+        low = max(20, fc - bw / 2)
+        high = min(samplerate / 2 - 1, fc + bw / 2)
+        b, a = butter(2, [low, high], btype='band', fs=samplerate)
+        processed[i:i + 1024] = lfilter(b, a, data[i:i + 1024])
+    return processed.astype(data.dtype)
+
+
+def boundary_jump(processed, block=1024):
+    """Mean absolute sample step at block boundaries relative to elsewhere (1.0 = no discontinuities)"""
+    mono = processed.astype(np.float64).reshape(len(processed), -1)[:, 0]
+    steps = np.abs(np.diff(mono))
+    at_boundary = steps[block - 1::block].mean()
+    return at_boundary / (steps.mean() + 1e-12)
+
+
+def time_call(fn, *args):
+    best = float("inf")
+    result = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    frames = int(MINUTES * 60 * SAMPLE_RATE)
+    rng = np.random.default_rng(0)
+    stereo = (rng.standard_normal((frames, 2)) * 6000).astype(np.int16)
+    mono = stereo.mean(axis=1).astype(np.int16)
+
+    wahwah.coefficient_table(SAMPLE_RATE)  # table design is a one-off per sample rate
+
+    contenders = [
+        ("legacy (mono)", legacy_wahwah_effect, mono),
+        ("sos table + state (mono)", wahwah.wahwah_effect, mono),
+        ("sos table + state (stereo)", wahwah.wahwah_effect, stereo),
+    ]
+    print(f"⏱️ Wah on {MINUTES:g} min of noise at {SAMPLE_RATE} Hz, best of {REPEATS} runs\n")
+    print(f"{'engine':30} {'sec / audio min':>16} {'x realtime':>11} {'boundary jump':>14}")
+    for name, fn, data in contenders:
+        seconds, processed = time_call(fn, data, SAMPLE_RATE)
+        print(f"{name:30} {seconds / MINUTES:16.3f} {MINUTES * 60 / seconds:11.0f} {boundary_jump(processed):14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import os
 import subprocess
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics_exporter import MetricsExporter
 
 # === CONFIGURATION ===
 INPUT_FOLDER = "input_wavs"
@@ -9,16 +10,11 @@ OUTPUT_FOLDER = "output_mp3s"
 BITRATE = "192k"
 MAX_WORKERS = os.cpu_count() or 4  # Use all CPU threads
 
-# === SETUP ===
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-wav_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith(".wav")]
-total_files = len(wav_files)
-
 # === FUNCTION ===
-def convert_file(filename):
-    input_path = os.path.join(INPUT_FOLDER, filename)
+def convert_file(filename, input_folder=INPUT_FOLDER, output_folder=OUTPUT_FOLDER):
+    input_path = os.path.join(input_folder, filename)
     output_filename = os.path.splitext(filename)[0] + ".mp3"
-    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    output_path = os.path.join(output_folder, output_filename)
 
     try:
         start_time = time.time()
@@ -33,35 +29,44 @@ def convert_file(filename):
         return False, filename, 0
 
 # === EXECUTION WITH ETA ===
-start_all = time.time()
-converted = 0
-failures = 0
-times = []
+def main(input_folder=INPUT_FOLDER, output_folder=OUTPUT_FOLDER, workers=MAX_WORKERS):
+    os.makedirs(output_folder, exist_ok=True)
+    wav_files = [f for f in os.listdir(input_folder) if f.lower().endswith(".wav")]
+    total_files = len(wav_files)
+
+    start_all = time.time()
+    converted = 0
+    failures = 0
+
+    print(f"🎧 Starting conversion of {total_files} WAV files using {workers} threads...\n")
 
-print(f"🎧 Starting conversion of {total_files} WAV files using {MAX_WORKERS} threads...\n")
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            MetricsExporter("convert_mp3", total=total_files, workers=workers) as exporter:
+        future_to_file = {executor.submit(convert_file, f, input_folder, output_folder): f for f in wav_files}
+        exporter.set_queue("pending", lambda: sum(not f.done() for f in future_to_file))
 
-with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-    future_to_file = {executor.submit(convert_file, f): f for f in wav_files}
+        for i, future in enumerate(as_completed(future_to_file), 1):
+            success, filename, elapsed = future.result()
 
-    for i, future in enumerate(as_completed(future_to_file), 1):
-        success, filename, elapsed = future.result()
-        times.append(elapsed)
+            if success:
+                converted += 1
+                exporter.record("done", elapsed)
+                print(f"✔️ [{converted}/{total_files}] {filename} converted in {elapsed:.1f}s")
+            else:
+                failures += 1
+                exporter.record("failed")
+                print(f"❌ [{converted + failures}/{total_files}] Failed to convert {filename}")
 
-        if success:
-            converted += 1
-            print(f"✔️ [{converted}/{total_files}] {filename} converted in {elapsed:.1f}s")
-        else:
-            failures += 1
-            print(f"❌ [{converted + failures}/{total_files}] Failed to convert {filename}")
+            # Estimate time remaining from observed throughput, so all worker threads are accounted for
+            eta_sec = exporter.eta_seconds()
+            if eta_sec is not None:
+                eta_min, eta_rem_sec = divmod(int(eta_sec), 60)
+                print(f"⏳ ETA: {eta_min} min {eta_rem_sec} sec remaining...\n")
 
-        # Estimate time remaining
-        avg_time = sum(times) / len(times)
-        remaining_files = total_files - (converted + failures)
-        eta_sec = int(avg_time * remaining_files)
-        eta_min, eta_rem_sec = divmod(eta_sec, 60)
-        print(f"⏳ ETA: {eta_min} min {eta_rem_sec} sec remaining...\n")
+    # === SUMMARY ===
+    total_time = int(time.time() - start_all)
+    total_min, total_sec = divmod(total_time, 60)
+    print(f"✅ Done in {total_min} min {total_sec} sec — {converted} converted, {failures} failed.")
 
-# === SUMMARY ===
-total_time = int(time.time() - start_all)
-total_min, total_sec = divmod(total_time, 60)
-print(f"✅ Done in {total_min} min {total_sec} sec — {converted} converted, {failures} failed.")
+if __name__ == "__main__":
+    main()
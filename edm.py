@@ -1,20 +1,25 @@
 import os
 import random
-import subprocess
-from pydub import AudioSegment, effects
-from hashlib import sha1
+from pydub import effects
+from song_plan import pattern_hash
+from uniqueness_store import get_pattern_store
+from timeline import Timeline, load_frames, load_trimmed, section_fades, SECTION_CROSSFADE_MS
+from instrumentation import stage, song as song_metrics, write_batch_summary
+from metrics_exporter import MetricsExporter
+from wav_writer import write_limited
+from run_journal import RunJournal
+from sample_analysis import drop_mislabelled
 
 # === CONFIGURATION ===
 SONG_COUNT = 50
 SONG_MIN_LENGTH_SEC = 150
 SECTION_LEN_DEFAULT_SEC = 16
 SECTION_LEN_SHORT_SEC = 8
+RISER_GAIN_DB = -3
+LIMITER_LEVEL = 0.8
 
 SAMPLES_DIR = "edm_samples"
 OUTPUT_DIR = "edm_output"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-used_hashes = set()
 
 def get_genre_dirs():
     return [
@@ -22,17 +27,12 @@ def get_genre_dirs():
         if "_" in d and os.path.isdir(os.path.join(SAMPLES_DIR, d))
     ]
 
-def loop_to_duration(sample: AudioSegment, target_duration_ms: int) -> AudioSegment:
-    if len(sample) == 0:
-        return AudioSegment.silent(duration=target_duration_ms)
-    loops_needed = target_duration_ms // len(sample)
-    remainder = target_duration_ms % len(sample)
-    looped = sample * loops_needed
-    if remainder > 0:
-        looped += sample[:remainder]
-    return looped
-
-def load_sample(folder: str, layer: str, static_layers: dict) -> AudioSegment:
+def section_duration_ms(section_name: str) -> int:
+    duration_sec = SECTION_LEN_SHORT_SEC if section_name in ["intro", "break"] else SECTION_LEN_DEFAULT_SEC
+    return duration_sec * 1000
+
+def load_sample(folder: str, layer: str, static_layers: dict) -> str:
+    """Pick a sample path for a layer; chords and bass stay the same for the whole song"""
     if layer in static_layers:
         return static_layers[layer]
 
@@ -40,68 +40,66 @@ def load_sample(folder: str, layer: str, static_layers: dict) -> AudioSegment:
     if not os.path.isdir(path):
         return None
 
-    files = [f for f in os.listdir(path) if f.endswith(".wav")]
+    files = drop_mislabelled(path, [f for f in os.listdir(path) if f.endswith(".wav")])
     if not files:
         return None
 
     sample_path = os.path.join(path, random.choice(files))
-    sample = AudioSegment.from_wav(sample_path)
 
     if layer in ["chords", "bass"]:
-        static_layers[layer] = sample
+        static_layers[layer] = sample_path
 
-    return sample
+    return sample_path
 
-def add_riser(folder: str, target_duration_ms: int) -> AudioSegment:
+def choose_riser(folder: str):
+    """Path of a random riser, or None when there are no risers"""
     riser_path = os.path.join(folder, "risers")
     if not os.path.isdir(riser_path):
-        return AudioSegment.silent(duration=0)
+        return None
 
     files = [f for f in os.listdir(riser_path) if f.endswith(".wav")]
     if not files:
-        return AudioSegment.silent(duration=0)
-
-    sample_path = os.path.join(riser_path, random.choice(files))
-    riser = AudioSegment.from_wav(sample_path) - 3
+        return None
 
-    if len(riser) > target_duration_ms:
-        riser = riser[-target_duration_ms:]
-    elif len(riser) < target_duration_ms:
-        riser += AudioSegment.silent(duration=target_duration_ms - len(riser))
+    return os.path.join(riser_path, random.choice(files))
 
-    return riser
+def choose_section(folder: str, layers: list, static_layers: dict, add_riser_next=False) -> tuple:
+    """Pick a section's samples; returns ((layer, path) pairs, riser path or None, used layers)"""
+    samples = []
+    for layer in layers:
+        sample_path = load_sample(folder, layer, static_layers)
+        if not sample_path:
+            continue
+        samples.append((layer, sample_path))
+    used_layers = [layer for layer, _ in samples]
 
-def create_section(folder: str, section_name: str, layers: list, static_layers: dict, add_riser_next=False) -> tuple:
-    duration_sec = SECTION_LEN_SHORT_SEC if section_name in ["intro", "break"] else SECTION_LEN_DEFAULT_SEC
-    duration_ms = duration_sec * 1000
+    riser = None
+    if add_riser_next:
+        riser = choose_riser(folder)
+        used_layers.append("riser")
 
-    section = AudioSegment.silent(duration=duration_ms)
-    used_layers = []
+    return samples, riser, used_layers
 
+def create_section(timeline: Timeline, offset: int, section_name: str, layers: list, samples: list, riser=None, fades=None) -> int:
+    """Mix a section's chosen samples into the timeline at frame offset; returns the section length in frames.
+    fades maps a looped sample's path to its (lead_in, fade_out) frames from timeline.section_fades."""
+    length = timeline.frame_at(section_duration_ms(section_name))
     gain_per_layer = -3 if len(layers) >= 4 else -2  # Dynamic gain control
 
-    for layer in layers:
-        sample = load_sample(folder, layer, static_layers)
-        if not sample:
-            continue
-
+    for layer, sample_path in samples:
         if layer in ["builds", "risers"]:
-            sample = sample[:duration_ms]
-            if len(sample) < duration_ms:
-                sample += AudioSegment.silent(duration=duration_ms - len(sample))
+            # One-shots play once from the section start
+            timeline.place(load_trimmed(sample_path, length), offset, gain_per_layer)
         else:
-            sample = loop_to_duration(sample, duration_ms)
-
-        sample = sample + gain_per_layer  # Apply gain based on number of layers
-        section = section.overlay(sample)
-        used_layers.append(layer)
+            lead_in, fade_out = (fades or {}).get(sample_path, (0, 0))
+            timeline.place_looped(load_frames(sample_path), offset, length, gain_per_layer, lead_in, fade_out)
 
-    if add_riser_next:
-        riser = add_riser(folder, duration_ms)
-        section = section.overlay(riser, position=duration_ms - len(riser))
-        used_layers.append("riser")
+    if riser is not None:
+        # A riser longer than the section keeps its tail; a shorter one starts with the section
+        riser = load_trimmed(riser, length, from_end=True)
+        timeline.place(riser, offset, RISER_GAIN_DB)
 
-    return section, used_layers
+    return length
 
 
 def build_expanded_structure(base_structure, min_duration_sec=180):
@@ -128,7 +126,7 @@ def build_expanded_structure(base_structure, min_duration_sec=180):
 
     return structure
 
-def generate_edm_song(index: int) -> bool:
+def generate_edm_song(index: int, journal=None) -> bool:
     genre_dirs = get_genre_dirs()
     if not genre_dirs:
         print("❌ No genre folders found in edm_samples/")
@@ -157,58 +155,72 @@ def generate_edm_song(index: int) -> bool:
     while total_duration < SONG_MIN_LENGTH_SEC:
         for s in base_structure:
             structure.append(s)
-            section_len = SECTION_LEN_SHORT_SEC if s[0] in ["intro", "break"] else SECTION_LEN_DEFAULT_SEC
-            total_duration += section_len
+            total_duration += section_duration_ms(s[0]) // 1000
             if total_duration >= SONG_MIN_LENGTH_SEC:
                 break
 
-    song = AudioSegment.silent(duration=0)
+    # Samples are chosen for the whole song first, so each boundary knows which layers change across it
+    with stage("plan"):
+        chosen = []
+        for i, (section_name, layers) in enumerate(structure):
+            add_riser_next = (i + 1 < len(structure)) and structure[i + 1][0].startswith("drop")
+            chosen.append(choose_section(folder, layers, static_layers, add_riser_next))
+
+    timeline = Timeline(sum(section_duration_ms(name) for name, _ in structure))
+    fades = section_fades([[path for _, path in samples] for samples, _, _ in chosen], timeline.frame_at(SECTION_CROSSFADE_MS))
+    offset = 0
     pattern_id = []
 
-    for i, (section_name, layers) in enumerate(structure):
-        add_riser = (i + 1 < len(structure)) and structure[i + 1][0].startswith("drop")
-        section, used_layers = create_section(folder, section_name, layers, static_layers, add_riser_next=add_riser)
-        song += section
+    for (section_name, layers), (samples, riser, used_layers), section_fade in zip(structure, chosen, fades):
+        with stage("render"):
+            offset += create_section(timeline, offset, section_name, layers, samples, riser, section_fade)
         pattern_id.append(tuple(sorted(used_layers)))
 
+    song = timeline.to_segment()
     if song.duration_seconds < SONG_MIN_LENGTH_SEC:
         print(f"ℹ️ Song is {int(song.duration_seconds)}s — under minimum length but still saving.")
 
-    song_hash = sha1(str(pattern_id).encode()).hexdigest()
-    if song_hash in used_hashes:
-        print("ℹ️ Duplicate pattern detected — saving anyway.")
-    else:
-        used_hashes.add(song_hash)
+    song_hash = pattern_hash(pattern_id)
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            print("ℹ️ Duplicate pattern detected — saving anyway.")
 
     # ✨ Mastering: fade, normalize, limiter
-    song = song.fade_in(3000).fade_out(3000)
-    song = effects.normalize(song)
+    with stage("master"):
+        song = song.fade_in(3000).fade_out(3000)
+        song = effects.normalize(song)
 
-    filename = os.path.join(OUTPUT_DIR, f"edm_song_{index:03d}.wav")
-    song.export(filename, format="wav")
-
-    limited_file = filename.replace(".wav", "_limited.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-i", filename,
-        "-af", "alimiter=limit=0.8",
-        limited_file
-    ])
-    os.remove(filename)
-    os.rename(limited_file, filename)
+    filename = os.path.join(OUTPUT_DIR, f"edm_song_{index:03d}_{song_hash:016x}.wav")
+    write_limited(song, filename, LIMITER_LEVEL)
+    # Recorded only once the file is written, so a failed export does not mark the pattern as shipped
+    get_pattern_store().add(song_hash)
+    if journal is not None:
+        journal.record(index, song_hash, filename)
 
     return True
 
 
 def main():
-    count = 0
-    attempts = 0
-    while count < SONG_COUNT and attempts < SONG_COUNT * 5:
-        if generate_edm_song(count + 1):
-            print(f"\U0001F3B6 Generated EDM song {count + 1}")
-            count += 1
-        else:
-            print("⚠️ Skipped duplicate or too short")
-        attempts += 1
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    journal = RunJournal("edm")
+    count = journal.resume()
+    with MetricsExporter("edm", total=max(SONG_COUNT - count, 0)):
+        attempts = 0
+        song_index = None
+        while count < SONG_COUNT and attempts < SONG_COUNT * 5:
+            song_index = song_index or journal.claim()
+            with song_metrics("edm", song_index) as record:
+                generated = generate_edm_song(song_index, journal)
+                record["outcome"] = "ok" if generated else "skipped"
+            if generated:
+                print(f"\U0001F3B6 Generated EDM song {song_index}")
+                count += 1
+                song_index = None
+            else:
+                print("⚠️ Skipped duplicate or too short")
+            attempts += 1
+
+    write_batch_summary("edm")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import numpy as np
+from stretch_cache import to_segment
+from fingerprint_index import segment_to_array
+from time_stretch import resample_stretch
+from wahwah import wah_blocks
+
+# Effects work on float32 NumPy blocks shaped (frames, channels). Streaming effects keep their
+# own state between process() calls, so a chain can run over a whole sample or block by block.
+
+
+def _as_2d(block):
+    block = np.asarray(block, dtype=np.float32)
+    return block[:, None] if block.ndim == 1 else block
+
+
+class Effect:
+    streaming = True
+
+    def reset(self):
+        pass
+
+    def process(self, block, sample_rate, start_frame=0):
+        return block
+
+    def spec(self):
+        return {"type": self.name, **{k: v for k, v in vars(self).items() if not k.startswith("_")}}
+
+
+class Gain(Effect):
+    name = "gain"
+
+    def __init__(self, db=0.0):
+        self.db = db
+
+    def process(self, block, sample_rate, start_frame=0):
+        return block * np.float32(10 ** (self.db / 20))
+
+
+class Pan(Effect):
+    """Same law as pydub's AudioSegment.pan: up to +3 dB on one side, the other side cut to match"""
+    name = "pan"
+
+    def __init__(self, position=0.0):
+        self.position = position
+
+    def process(self, block, sample_rate, start_frame=0):
+        if block.shape[1] == 1:
+            block = np.repeat(block, 2, axis=1)
+        amount = min(abs(self.position), 1.0)
+        boost = 2.0 ** (amount / 2)
+        reduce = max(2.0 - 2.0 ** amount, 0.0)
+        left, right = (boost, reduce) if self.position < 0 else (reduce, boost)
+        return block[:, :2] * np.array([left, right], dtype=np.float32)
+
+
+class Reverse(Effect):
+    """Needs the whole sample, so it only runs in apply()"""
+    name = "reverse"
+    streaming = False
+
+    def process(self, block, sample_rate, start_frame=0):
+        return block[::-1]
+
+
+class Pitch(Effect):
+    """Varispeed pitch shift, like playing the sample back at frame_rate * factor"""
+    name = "pitch"
+    streaming = False
+
+    def __init__(self, factor=1.0):
+        self.factor = factor
+
+    def process(self, block, sample_rate, start_frame=0):
+        if abs(self.factor - 1.0) < 1e-6:
+            return block
+        return resample_stretch(block, self.factor)
+
+
+class Filter(Effect):
+    name = "filter"
+
+    def __init__(self, btype="lowpass", cutoff=8000.0, order=2):
+        self.btype = btype
+        self.cutoff = cutoff
+        self.order = order
+        self.reset()
+
+    def reset(self):
+        self._zi = None
+
+    def process(self, block, sample_rate, start_frame=0):
+        from scipy.signal import butter, sosfilt  # deferred, see wahwah.coefficient_table
+        sos = butter(self.order, self.cutoff, btype=self.btype, fs=sample_rate, output="sos")
+        if self._zi is None:
+            self._zi = np.zeros((sos.shape[0], 2, block.shape[1]))
+        out, self._zi = sosfilt(sos, block, axis=0, zi=self._zi)
+        return out.astype(np.float32)
+
+
+class Wah(Effect):
+    name = "wah"
+
+    def __init__(self, bpm=None):
+        self.bpm = bpm
+        self.reset()
+
+    def reset(self):
+        self._zi = None
+
+    def process(self, block, sample_rate, start_frame=0):
+        out, self._zi = wah_blocks(block, sample_rate, zi=self._zi, start_sample=start_frame, bpm=self.bpm)
+        return out
+
+
+EFFECTS = {cls.name: cls for cls in (Gain, Pan, Reverse, Pitch, Filter, Wah)}
+
+
+def from_spec(spec):
+    """Build an effect from a plan entry such as {"type": "pan", "position": -0.4}"""
+    params = {k: v for k, v in spec.items() if k != "type"}
+    return EFFECTS[spec["type"]](**params)
+
+
+class EffectChain:
+    """Ordered effects for one layer or the master bus"""
+
+    def __init__(self, effects=()):
+        self.effects = [from_spec(e) if isinstance(e, dict) else e for e in effects]
+
+    def __bool__(self):
+        return bool(self.effects)
+
+    def specs(self):
+        """JSON-friendly description, suitable for storing in a song plan"""
+        return [effect.spec() for effect in self.effects]
+
+    def reset(self):
+        for effect in self.effects:
+            effect.reset()
+
+    def process(self, block, sample_rate, start_frame=0):
+        """Run one block of a stream through every effect; all effects must be streaming"""
+        block = _as_2d(block)
+        for effect in self.effects:
+            if not effect.streaming:
+                raise ValueError(f"{effect.name} needs the whole sample and cannot run on a stream")
+            block = effect.process(block, sample_rate, start_frame)
+        return block
+
+    def apply(self, samples, sample_rate):
+        """Run a whole sample through the chain from a fresh state"""
+        self.reset()
+        samples = _as_2d(samples)
+        for effect in self.effects:
+            samples = effect.process(samples, sample_rate, 0)
+        return samples
+
+    def apply_to_segment(self, segment):
+        """Process a pydub AudioSegment in one NumPy pass and hand back a 16-bit AudioSegment"""
+        if not self.effects:
+            return segment
+        samples, sample_rate = segment_to_array(segment)
+        return to_segment(self.apply(samples, sample_rate), sample_rate)
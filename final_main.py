@@ -1,22 +1,38 @@
 import os
-import subprocess
 import random
+from functools import lru_cache
 from pydub import AudioSegment, effects
-from hashlib import sha1
+from song_plan import pattern_hash, list_wav_files, new_seed, write_manifest
+from uniqueness_store import get_pattern_store, record_shipped
+from fingerprint_index import get_fingerprint_index, compute_fingerprint
+from plan_enumerator import CombinationSpace, EnumerationCursor
+from effects_chain import EffectChain
+from instrumentation import stage, song as song_metrics, write_batch_summary, count_cache, register_cache_info
+from metrics_exporter import MetricsExporter
+from wav_writer import write_limited
+from run_journal import RunJournal
+from sample_stats import get_sample_stats, segment_rms
+from sample_analysis import drop_mislabelled
+from timeline import Timeline, segment_frames, section_fades, SECTION_CROSSFADE_MS
 
 # Configuration
 NUM_SONGS = 1000
 MIN_SONG_LENGTH_SEC = 150
 MAX_SONG_LENGTH_SEC = 180
+LIMITER_LEVEL = 0.9
+ENUMERATION_SEED = 0
+COMBINATION_ATTEMPTS = 5   # plans tried on one enumerated combination before it is given up
+DECODED_CACHE_ITEMS = 64  # decoded samples kept across songs
+RMS_TOLERANCE = 0.001     # stored RMS is one loop period's, within about 0.05% of the tiled section's
+CORE_LAYERS = ["drums", "chords", "bass", "melody"]
+MASTER_EFFECTS = []  # effect specs for the master bus, e.g. [{"type": "wah", "bpm": None}]
+LAYER_EFFECTS = {}   # layer name -> effect specs, e.g. {"melody": [{"type": "filter", "cutoff": 4000}]}
 
 # Paths
 SAMPLES_DIR = "samples"
 DRUMS_BASE_DIR = os.path.join(SAMPLES_DIR, "drums")
 #change to out_songs 
 OUTPUT_DIR = "output_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-used_patterns = set()
 
 HARMONIC_KEY_MAP = {
     "c": ["am", "em", "f", "g", "dm"],
@@ -65,241 +81,155 @@ def calculate_loop_sections(section_duration, target_duration=60):
     sections_needed = round(target_duration / section_duration)
     return max(1, sections_needed)
 
+@lru_cache(maxsize=DECODED_CACHE_ITEMS)
 def load_and_adjust_sample(path):
-    return AudioSegment.from_wav(path)
+    """Decoded once per process; AudioSegments are immutable, so songs share them safely"""
+    with stage("decode"):
+        return AudioSegment.from_wav(path)
+
+register_cache_info("lofi_decoded", load_and_adjust_sample.cache_info)
+
+def db_to_ratio(db):
+    return 10 ** (db / 20)
 
-def get_rms(audio):
-    return audio.rms if len(audio) > 0 else 0
+def layer_rms(planned, sample):
+    """RMS of a planned layer at its gain: the sample's stored stats, or the processed sample when
+    effects change its level"""
+    rms = segment_rms(sample) if planned.get("effects") else get_sample_stats(planned["path"])["rms"]
+    return rms * db_to_ratio(planned["gain_db"])
 
 def match_rms_levels(loops_data, target_rms=None):
-    """Match RMS levels across all loops for consistent loudness"""
-    if not loops_data:
-        return loops_data
-    
-    # Calculate RMS for each loop
-    rms_values = []
-    for loop_name, loop_audio in loops_data:
-        rms = get_rms(loop_audio)
-        rms_values.append(rms)
-        print(f"📊 {loop_name} RMS: {rms:.2f}")
-    
-    # Use target RMS or average of all loops
-    if target_rms is None:
-        target_rms = sum(rms_values) / len(rms_values)
-    
-    print(f"🎯 Target RMS: {target_rms:.2f}")
-    
-    # Adjust each loop to match target RMS
-    matched_loops = []
-    for (loop_name, loop_audio), current_rms in zip(loops_data, rms_values):
-        if current_rms > 0:
-            # Calculate adjustment needed
-            adjustment_ratio = target_rms / current_rms
-            adjustment_db = 20 * (adjustment_ratio ** 0.5)  # Convert to dB
-            
-            # Apply adjustment (cap at ±6dB for safety)
-            adjustment_db = max(-6, min(6, adjustment_db))
-            adjusted_loop = loop_audio + adjustment_db
-            
-            print(f"🔧 {loop_name}: {adjustment_db:+.1f}dB adjustment")
-            matched_loops.append((loop_name, adjusted_loop))
-        else:
-            matched_loops.append((loop_name, loop_audio))
-    
-    return matched_loops
-    """Match RMS levels across all loops for consistent loudness"""
+    """dB adjustment that matches each loop to the target RMS (default: the loops' average).
+
+    loops_data is a list of (loop name, sample path); returns a list of (loop name, adjustment_db).
+    """
     if not loops_data:
-        return loops_data
-    
-    # Calculate RMS for each loop
-    rms_values = []
-    for loop_name, loop_audio in loops_data:
-        rms = get_rms(loop_audio)
-        rms_values.append(rms)
-        print(f"📊 {loop_name} RMS: {rms:.2f}")
-    
+        return []
+
+    rms_values = [get_sample_stats(path)["rms"] for _, path in loops_data]
+    for (loop_name, _), rms in zip(loops_data, rms_values):
+        print(f"📊 {loop_name} RMS: {rms:.4f}")
+
     # Use target RMS or average of all loops
     if target_rms is None:
         target_rms = sum(rms_values) / len(rms_values)
-    
-    print(f"🎯 Target RMS: {target_rms:.2f}")
-    
-    # Adjust each loop to match target RMS
-    matched_loops = []
-    for (loop_name, loop_audio), current_rms in zip(loops_data, rms_values):
+    print(f"🎯 Target RMS: {target_rms:.4f}")
+
+    adjustments = []
+    for (loop_name, _), current_rms in zip(loops_data, rms_values):
+        adjustment_db = 0.0
         if current_rms > 0:
-            # Calculate adjustment needed
             adjustment_ratio = target_rms / current_rms
             adjustment_db = 20 * (adjustment_ratio ** 0.5)  # Convert to dB
-            
-            # Apply adjustment (cap at ±6dB for safety)
+            # Cap at ±6dB for safety
             adjustment_db = max(-6, min(6, adjustment_db))
-            adjusted_loop = loop_audio + adjustment_db
-            
             print(f"🔧 {loop_name}: {adjustment_db:+.1f}dB adjustment")
-            matched_loops.append((loop_name, adjusted_loop))
-        else:
-            matched_loops.append((loop_name, loop_audio))
-    
-    return matched_loops
+        adjustments.append((loop_name, adjustment_db))
+    return adjustments
 
-def adjust_drum_volume_if_needed(drum, other_layers):
-    other_rms_values = [get_rms(layer) for layer in other_layers if layer is not None]
+def drum_gain_adjustment(drum_rms, other_rms_values):
+    """dB to add to the drums so they sit with the other layers, from RMS values alone"""
     if not other_rms_values:
-        return drum
+        return 0.0
     average_rms = sum(other_rms_values) / len(other_rms_values)
-    drum_rms = get_rms(drum)
-    
-    # If drums are too loud, reduce them (original logic)
-    if drum_rms > average_rms:
-        db_difference = 20 * ((drum_rms / average_rms) ** 0.5)
-        drum = drum - min(db_difference, 6)
-    
+    if average_rms <= 0 or drum_rms <= 0:
+        return 0.0
+
+    # If drums are too loud, reduce them (original logic); a stored level within measurement error of
+    # the average counts as equal
+    if drum_rms > average_rms * (1 + RMS_TOLERANCE):
+        return -min(20 * ((drum_rms / average_rms) ** 0.5), 6)
+
     # NEW: If drums are too quiet, boost them
-    elif drum_rms < average_rms * 0.7:  # If drums are less than 70% of average
+    if drum_rms < average_rms * 0.7:  # If drums are less than 70% of average
         boost_needed = 20 * ((average_rms * 0.8) / drum_rms) ** 0.5  # Boost to 80% of average
-        drum = drum + min(boost_needed, 4)  # Cap boost at 4dB
         print(f"🔊 Boosted drums by {min(boost_needed, 4):.1f}dB")
-    
-    return drum
+        return min(boost_needed, 4)  # Cap boost at 4dB
+    return 0.0
 
-def create_single_section(compatible_folders, section_layers, target_bpm, default_sec, short_sec, section_name=None, cached_samples=None, intro_chords=None):
-    """Create a single section with caching logic"""
+def plan_single_section(compatible_folders, section_layers, target_bpm, default_sec, short_sec, section_name=None, cached_layers=None, intro_chords=None, file_cache=None, forced_layers=None, rng=random):
+    """Choose samples and gains for a single section without touching any audio"""
     section_duration = short_sec if section_name == "intro" else default_sec
     duration_ms = int(section_duration * 1000)
-    section = AudioSegment.silent(duration=duration_ms)
-    used_files = []
-    samples_by_layer = {}
+    layers = {}
     gain_per_layer = -3 if len(section_layers) >= 4 else -2
-    chords_sample_info = None
 
     for layer in section_layers:
-        chosen_folder = None  # Initialize chosen_folder
-        
         if layer == "drums":
             folder = os.path.join(DRUMS_BASE_DIR, str(target_bpm))
-            chosen_folder = f"drums/{target_bpm}"
         else:
-            chosen_folder = random.choice(compatible_folders)
+            chosen_folder = rng.choice(compatible_folders)
             folder = os.path.join(SAMPLES_DIR, chosen_folder, layer)
 
-        files = [f for f in os.listdir(folder) if f.endswith(".wav")]
-        if not files:
+        files = drop_mislabelled(folder, list_wav_files(folder, file_cache))
+        if not files and not (forced_layers and layer in forced_layers):
             continue
 
-        # Check if we have cached sample for this layer
-        if cached_samples and layer in cached_samples:
-            sample = cached_samples[layer]['sample']
-            chosen = cached_samples[layer]['file']
-            chosen_folder = cached_samples[layer].get('folder', chosen_folder)
+        # Reuse the cached choice for this layer, otherwise pick a new random sample
+        trim_ms = None
+        if cached_layers and layer in cached_layers:
+            path = cached_layers[layer]["path"]
+            gain_db = cached_layers[layer]["gain_db"]
+            trim_ms = cached_layers[layer].get("trim_ms")
         elif layer == "chords" and intro_chords is not None:
             # Use intro chords for first loop after intro
-            sample = intro_chords
-            chosen = "intro_chords.wav"
-        else:
-            # Select new random sample
-            chosen = random.choice(files)
-            sample = load_and_adjust_sample(os.path.join(folder, chosen))
-
-        # Adjust sample length to section duration
-        if len(sample) < duration_ms:
-            times = duration_ms // len(sample) + 1
-            sample = (sample * times)[:duration_ms]
+            path = intro_chords["path"]
+            gain_db = intro_chords["gain_db"]
+            trim_ms = intro_chords["trim_ms"]
+        elif forced_layers and layer in forced_layers:
+            # Enumerated combination decides this layer
+            path = forced_layers[layer]
+            gain_db = 0.0
         else:
-            sample = sample[:duration_ms]
+            path = os.path.join(folder, rng.choice(files))
+            gain_db = 0.0
 
-        # Apply volume adjustments
-        if layer == "chords" and (cached_samples or intro_chords):
+        if layer == "chords" and (cached_layers or intro_chords):
             # Randomize volume of cached chords
-            sample = sample - random.uniform(3.0, 6.0)
-
-        sample = sample + gain_per_layer
-        samples_by_layer[layer] = sample
-        used_files.append(os.path.join(chosen_folder if layer != "drums" else f"drums/{target_bpm}", layer, chosen))
-
-        # Store intro chords info for caching
-        if layer == "chords" and section_name == "intro":
-            chords_sample_info = (chosen_folder, chosen, sample)
+            gain_db -= rng.uniform(3.0, 6.0)
 
-    # Adjust drum volume if needed
-    if "drums" in samples_by_layer:
-        drum_sample = samples_by_layer["drums"]
-        other_samples = [v for k, v in samples_by_layer.items() if k != "drums"]
-        samples_by_layer["drums"] = adjust_drum_volume_if_needed(drum_sample, other_samples)
-
-    # Mix all layers
-    for sample in samples_by_layer.values():
-        section = section.overlay(sample)
+        layers[layer] = {"path": path, "gain_db": gain_db + gain_per_layer}
+        if trim_ms:
+            layers[layer]["trim_ms"] = trim_ms
+        if layer in LAYER_EFFECTS:
+            layers[layer]["effects"] = LAYER_EFFECTS[layer]
 
-    return section, used_files, samples_by_layer, chords_sample_info
+    return {"name": section_name, "duration_ms": duration_ms, "layers": layers}
 
-def create_loop_section(compatible_folders, section_layers, target_bpm, default_sec, section_name, loop_caches, intro_chords):
-    """Create a complete loop section (multiple sections chained for ~1 minute)"""
-    # Calculate how many sections needed for ~1 minute
+def plan_loop_section(compatible_folders, section_layers, target_bpm, default_sec, section_name, loop_caches, intro_chords, file_cache=None, forced_layers=None, rng=random):
+    """Plan a complete loop section (multiple sections chained for ~1 minute)"""
     sections_needed = calculate_loop_sections(default_sec, 60)
-    
-    complete_loop = AudioSegment.silent(duration=0)
-    all_used_files = []
-    
-    # Check if this loop type already has cached samples
-    if section_name in loop_caches:
-        # Use cached samples for all sections in this loop
-        cached_samples = loop_caches[section_name]
-        for i in range(sections_needed):
-            section, used_files, _, _ = create_single_section(
-                compatible_folders, section_layers, target_bpm, default_sec, default_sec,
-                section_name, cached_samples, None
-            )
-            complete_loop += section
-            all_used_files.extend(used_files)
-    else:
-        # First time this loop appears - create and cache samples
-        first_section, used_files, samples_by_layer, _ = create_single_section(
+    sections = []
+
+    if section_name not in loop_caches:
+        # First time this loop appears - choose samples and cache them for this loop type
+        first_section = plan_single_section(
             compatible_folders, section_layers, target_bpm, default_sec, default_sec,
-            section_name, None, intro_chords
+            section_name, None, intro_chords, file_cache, forced_layers, rng
         )
-        complete_loop += first_section
-        all_used_files.extend(used_files)
-        
-        # Cache the samples for this loop type
-        loop_caches[section_name] = {}
-        for layer, sample in samples_by_layer.items():
-            # For intro chords, store the sample directly
-            if layer == "chords" and intro_chords is not None:
-                loop_caches[section_name][layer] = {
-                    'sample': intro_chords,
-                    'file': f"cached_{layer}.wav",
-                    'folder': 'cached'
-                }
-            else:
-                # For other layers, store the processed sample
-                loop_caches[section_name][layer] = {
-                    'sample': sample,
-                    'file': f"cached_{layer}.wav",
-                    'folder': 'cached'
-                }
-        
-        # Create remaining sections using cached samples
-        for i in range(1, sections_needed):
-            section, used_files, _, _ = create_single_section(
-                compatible_folders, section_layers, target_bpm, default_sec, default_sec,
-                section_name, loop_caches[section_name], None
-            )
-            complete_loop += section
-            all_used_files.extend(used_files)
-    
-    return complete_loop, all_used_files
+        sections.append(first_section)
+        loop_caches[section_name] = dict(first_section["layers"])
+        if intro_chords is not None and "chords" in loop_caches[section_name]:
+            loop_caches[section_name]["chords"] = intro_chords
+
+    while len(sections) < sections_needed:
+        sections.append(plan_single_section(
+            compatible_folders, section_layers, target_bpm, default_sec, default_sec,
+            section_name, loop_caches[section_name], None, file_cache, rng=rng
+        ))
+
+    return sections
 
-def generate_structure(default_section_sec, short_section_sec):
+def generate_structure(default_section_sec, short_section_sec, rng=random):
     structure = ["intro"]
     current_duration = short_section_sec
     available_loops = ["loop_a", "loop_b", "bridge"]
     
     # Randomize a target song length between 2.5 and 4.0 minutes
-    target_song_length = random.uniform(150, 240)
+    target_song_length = rng.uniform(150, 240)
     
     # Add first loop (will get intro chords)
-    first_loop = random.choice(available_loops)
+    first_loop = rng.choice(available_loops)
     structure.append(first_loop)
     current_duration += 60  # loops are ~1 minute now
     last_loop = first_loop
@@ -313,7 +243,7 @@ def generate_structure(default_section_sec, short_section_sec):
         if not available_choices:
             available_choices = available_loops
             
-        loop_type = random.choice(available_choices)
+        loop_type = rng.choice(available_choices)
         structure.append(loop_type)
         current_duration += 60
         last_loop = loop_type
@@ -321,9 +251,47 @@ def generate_structure(default_section_sec, short_section_sec):
     structure.append("outro")
     return structure
 
-def generate_lofi_song(index):
-    all_folders = get_key_bpm_folders()
-    selected_folder = random.choice(all_folders)
+def build_combination_space(seed=ENUMERATION_SEED):
+    """One mixed-radix group per key/BPM folder: drums x chords x bass x melody choices"""
+    all_folders = sorted(get_key_bpm_folders())
+    catalog = []
+    for folder in all_folders:
+        bpm, _ = parse_bpm_key(folder)
+        drums_dir = os.path.join(DRUMS_BASE_DIR, str(bpm))
+        layer_files = {"drums": drop_mislabelled(drums_dir, list_wav_files(drums_dir))}
+        for layer in CORE_LAYERS[1:]:
+            layer_dir = os.path.join(SAMPLES_DIR, folder, layer)
+            layer_files[layer] = drop_mislabelled(layer_dir, list_wav_files(layer_dir))
+        catalog.append((folder, layer_files))
+    space = CombinationSpace([[len(files[layer]) for layer in CORE_LAYERS] for _, files in catalog], seed)
+    return space, catalog
+
+def combination_layers(combination, catalog):
+    """Resolve an enumerated (group, digits) into its folder and the sample path for each core layer"""
+    group, digits = combination
+    folder, layer_files = catalog[group]
+    bpm, _ = parse_bpm_key(folder)
+    forced_layers = {}
+    for layer, digit in zip(CORE_LAYERS, digits):
+        if not layer_files[layer]:
+            continue
+        base = os.path.join(DRUMS_BASE_DIR, str(bpm)) if layer == "drums" else os.path.join(SAMPLES_DIR, folder, layer)
+        forced_layers[layer] = os.path.join(base, layer_files[layer][digit])
+    return folder, forced_layers
+
+def plan_song(combination=None, catalog=None, rng=random):
+    """Pick folder, structure and every sample for a song; returns a plan with its pattern_id and duration.
+
+    With an enumerated combination the folder, intro chords and the first loop's drums, bass and
+    melody come from it, which makes the plan unique among all enumerated songs. Every other choice
+    comes from rng, so the same seed and combination always give the same plan.
+    """
+    all_folders = sorted(get_key_bpm_folders())
+    forced_layers = None
+    if combination is not None:
+        selected_folder, forced_layers = combination_layers(combination, catalog)
+    else:
+        selected_folder = rng.choice(all_folders)
     bpm, root_key = parse_bpm_key(selected_folder)
     default_sec, short_sec = get_section_durations(bpm)
     harmonizing_keys = HARMONIC_KEY_MAP.get(root_key, [])
@@ -332,7 +300,7 @@ def generate_lofi_song(index):
         if parse_bpm_key(f)[0] == bpm and parse_bpm_key(f)[1] in harmonizing_keys + [root_key]
     ]
 
-    structure = generate_structure(default_sec, short_sec)
+    structure = generate_structure(default_sec, short_sec, rng)
 
     section_presets = {
         "intro":  ["chords"],
@@ -342,90 +310,224 @@ def generate_lofi_song(index):
         "outro":  ["drums", "chords", "bass"]
     }
 
-    song = AudioSegment.silent(duration=0)
+    sections = []
     pattern_id = []
-    loop_caches = {}  # Cache samples for each loop type
-    global_bass_cache = None  # Global bass cache for entire song
-    used_drums = set()  # Track used drum files to avoid duplicates
+    file_cache = {}
+    loop_caches = {}  # Cache sample choices for each loop type
     intro_chords = None
     first_loop_after_intro = True
-    
-    # Store all sections for RMS matching
-    all_sections = []
-    loops_for_rms_matching = []
 
     for section_name in structure:
         if section_name == "intro":
-            # Create intro
-            section, used_files, _, chords_info = create_single_section(
-                compatible_folders, section_presets[section_name], bpm, 
-                default_sec, short_sec, section_name
-            )
-            if chords_info:
-                # Store intro chords for first loop
-                intro_chords = chords_info[2]
-            song += section
-            pattern_id.append(tuple(sorted(used_files)))
-            
+            planned = [plan_single_section(
+                compatible_folders, section_presets[section_name], bpm,
+                default_sec, short_sec, section_name, file_cache=file_cache, forced_layers=forced_layers, rng=rng
+            )]
+            # Store intro chords for first loop, as the clip the intro played
+            intro_chords = planned[0]["layers"].get("chords")
+            if intro_chords is not None:
+                intro_chords = {**intro_chords, "trim_ms": planned[0]["duration_ms"]}
+
         elif section_name == "outro":
             # Create outro using first loop's cached chords if available
-            first_loop_name = structure[1]  # First loop after intro
-            outro_chords = None
-            if first_loop_name in loop_caches and "chords" in loop_caches[first_loop_name]:
-                outro_chords = loop_caches[first_loop_name]["chords"]["sample"]
-            
-            section, used_files, _, _ = create_single_section(
+            first_loop_name = structure[1]
+            outro_chords = loop_caches.get(first_loop_name, {}).get("chords")
+            planned = [plan_single_section(
                 compatible_folders, section_presets[section_name], bpm,
-                default_sec, short_sec, section_name, 
-                {"chords": {"sample": outro_chords, "file": "cached_chords.wav"}} if outro_chords else None
-            )
-            song += section
-            pattern_id.append(tuple(sorted(used_files)))
-            
+                default_sec, short_sec, section_name,
+                {"chords": outro_chords} if outro_chords else None, file_cache=file_cache, rng=rng
+            )]
+
         else:
-            # Create loop section
             intro_chords_for_loop = intro_chords if first_loop_after_intro else None
-            section, used_files = create_loop_section(
+            planned = plan_loop_section(
                 compatible_folders, section_presets[section_name], bpm,
-                default_sec, section_name, loop_caches, intro_chords_for_loop
+                default_sec, section_name, loop_caches, intro_chords_for_loop, file_cache,
+                forced_layers if first_loop_after_intro else None, rng
             )
-            song += section
-            pattern_id.append(tuple(sorted(used_files)))
             first_loop_after_intro = False
 
-    song_hash = sha1(str(pattern_id).encode()).hexdigest()
-    if song_hash in used_patterns:
-        return False
-    used_patterns.add(song_hash)
-
-    song = song.fade_in(3000).fade_out(5000)
-    song = effects.normalize(song)
+        sections.extend(planned)
+        pattern_id.append(tuple(sorted(
+            layer["path"] for section in planned for layer in section["layers"].values()
+        )))
+
+    return {
+        "bpm": bpm,
+        "structure": structure,
+        "sections": sections,
+        "pattern_id": pattern_id,
+        "duration_ms": sum(section["duration_ms"] for section in sections),
+        "master_effects": MASTER_EFFECTS,
+    }
 
-    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}.wav")
-    song.export(filename, format="wav")
+def plan_sample_paths(plan):
+    return [layer["path"] for section in plan["sections"] for layer in section["layers"].values()]
 
-    limited_file = filename.replace(".wav", "_limited.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-i", filename,
-        "-af", "alimiter=limit=0.9",
-        limited_file
-    ])
-    os.remove(filename)
-    os.rename(limited_file, filename)
+def section_samples(section, sample_cache):
+    """layer -> (frames, gain_db) for a planned section, decoding each sample at most once per song"""
+    samples_by_layer = {}
+    for layer, planned in section["layers"].items():
+        path = planned["path"]
+        key = path
+        count_cache("sample", path in sample_cache)
+        if path not in sample_cache:
+            sample_cache[path] = load_and_adjust_sample(path)
+        sample = sample_cache[path]
+        if planned.get("trim_ms"):
+            # The intro's chords carry on as the clip the intro played, looped or cut to its length
+            key = (path, planned["trim_ms"])
+            if key not in sample_cache:
+                times = planned["trim_ms"] // len(sample) + 1
+                sample_cache[key] = (sample * times)[:planned["trim_ms"]]
+            sample = sample_cache[key]
+        if planned.get("effects"):
+            # Effects run once on the decoded sample, before it is looped across the section
+            key = (key, repr(planned["effects"]))
+            if key not in sample_cache:
+                with stage("effects"):
+                    sample_cache[key] = EffectChain(planned["effects"]).apply_to_segment(sample)
+            sample = sample_cache[key]
+        samples_by_layer[layer] = (key, sample)
+
+    # Adjust drum volume if needed; decided from stored levels, so every layer is placed and gained once
+    gains = {layer: planned["gain_db"] for layer, planned in section["layers"].items()}
+    if "drums" in samples_by_layer:
+        with stage("balance"):
+            levels = {layer: layer_rms(section["layers"][layer], sample) for layer, (_, sample) in samples_by_layer.items()}
+            gains["drums"] += drum_gain_adjustment(levels.pop("drums"), list(levels.values()))
+
+    frames_by_layer = {}
+    for layer, (key, sample) in samples_by_layer.items():
+        if ("frames", key) not in sample_cache:
+            sample_cache[("frames", key)] = segment_frames(sample)
+        frames_by_layer[layer] = (sample_cache[("frames", key)], gains[layer])
+    return frames_by_layer
+
+def mix_section(timeline, offset, section, sample_cache, fades=None):
+    """Loop every layer of a planned section across it from frame offset. fades maps a sample path to
+    its (lead_in, fade_out) frames from timeline.section_fades."""
+    length = timeline.frame_at(section["duration_ms"])
+    for layer, (frames, gain_db) in section_samples(section, sample_cache).items():
+        lead_in, fade_out = (fades or {}).get(section["layers"][layer]["path"], (0, 0))
+        with stage("place"):
+            timeline.place_looped(frames, offset, length, gain_db, lead_in, fade_out)
+
+def render_section(section, sample_cache):
+    """Render a planned section on its own, with hard edges"""
+    timeline = Timeline(section["duration_ms"])
+    mix_section(timeline, 0, section, sample_cache)
+    return timeline.to_segment()
+
+def mix_song(plan):
+    """Every section of the plan on one float Timeline, before mastering"""
+    sample_cache = {}
+    timeline = Timeline(plan["duration_ms"])
+    # Layers that change at a boundary crossfade just before it; layers that carry on stay untouched
+    fades = section_fades(
+        [[planned["path"] for planned in section["layers"].values()] for section in plan["sections"]],
+        timeline.frame_at(SECTION_CROSSFADE_MS),
+    )
+    offset = 0
+    for section, section_fade in zip(plan["sections"], fades):
+        mix_section(timeline, offset, section, sample_cache, section_fade)
+        offset += timeline.frame_at(section["duration_ms"])
+    return timeline
+
+def master_song(plan, timeline):
+    with stage("master"):
+        song = EffectChain(plan.get("master_effects", [])).apply_to_segment(timeline.to_segment())
+        song = song.fade_in(3000).fade_out(5000)
+        return effects.normalize(song)
+
+def render_song(plan):
+    return master_song(plan, mix_song(plan))
+
+def export_song(song, filename):
+    write_limited(song, filename, LIMITER_LEVEL)
+
+def generate_lofi_song(index, combination=None, catalog=None, seed=None, journal=None):
+    # Every choice for this song comes from its own seeded generator, recorded in the manifest
+    seed = new_seed() if seed is None else seed
+    with stage("plan"):
+        plan = plan_song(combination, catalog, random.Random(seed))
+
+    # Reject duplicates from the plan alone, before any audio is decoded
+    song_hash = pattern_hash(plan["pattern_id"])
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            return False
+
+    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}_{song_hash:016x}.wav")
+    # Written before rendering so a song that hangs or crashes can still be replayed; removed again
+    # when the song is rejected, so every manifest left names a song that shipped or never finished
+    manifest = write_manifest("lofi", "final_main", index, seed, song_hash, plan, plan_sample_paths(plan), filename, combination)
+
+    with stage("render"):
+        timeline = mix_song(plan)
+
+    # Perceptual check on the float mix catches different plans that still sound the same; the master
+    # chain is the same for every song, so it runs only once the song is kept
+    with stage("fingerprint"):
+        fingerprint = compute_fingerprint(timeline.buffer, timeline.sample_rate)
+        if get_fingerprint_index().find_near_duplicate(fingerprint) is not None:
+            print("❌ Song too similar to an existing one.")
+            os.remove(manifest)
+            return False
+
+    song = master_song(plan, timeline)
+    export_song(song, filename)
+    if not record_shipped(song_hash, filename):
+        os.remove(manifest)
+        return False
+    get_fingerprint_index().add(song_hash, fingerprint)
+    if journal is not None:
+        journal.record(index, song_hash, filename, seed=seed)
 
     return True
 
 
 def main():
-    count = 0
-    attempts = 0
-    while count < NUM_SONGS and attempts < NUM_SONGS * 5:
-        if generate_lofi_song(count + 1):
-            print(f"✔️ Generated song {count + 1}")
-            count += 1
-        else:
-            print("⚠️ Skipped duplicate pattern")
-        attempts += 1
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    space, catalog = build_combination_space()
+    cursor = EnumerationCursor("lofi", space)
+    print(f"🎲 {cursor.remaining()} unique songs left in this sample library")
+
+    journal = RunJournal("lofi")
+    count = journal.resume()
+    with MetricsExporter("lofi", total=max(NUM_SONGS - count, 0)) as exporter:
+        exporter.set_queue("unique_combinations_left", cursor.remaining)
+        song_index = None
+        index, attempts = None, 0
+        try:
+            while count < NUM_SONGS:
+                if index is None:
+                    index = cursor.take()
+                    if index is None:
+                        print("🏁 Every unique combination has been generated")
+                        break
+                # The journal index and the combination are both kept until a song actually lands, so a
+                # rejected plan re-plans the same combination with a new seed instead of using it up
+                song_index = song_index or journal.claim()
+                with song_metrics("lofi", song_index) as record:
+                    generated = generate_lofi_song(song_index, space.combination(index), catalog, journal=journal)
+                    record["outcome"] = "ok" if generated else "skipped"
+                attempts += 1
+                if generated:
+                    print(f"✔️ Generated song {song_index}")
+                    count += 1
+                    song_index = None
+                    index, attempts = None, 0
+                elif attempts >= COMBINATION_ATTEMPTS:
+                    print(f"⚠️ Giving up on combination {index} after {attempts} rejected plans")
+                    index, attempts = None, 0
+                else:
+                    print("⚠️ Skipped duplicate pattern, re-planning the same combination")
+        finally:
+            if index is not None:
+                cursor.release(index)
+
+    write_batch_summary("lofi")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,30 +1,40 @@
 import os
-import subprocess
 import random
 from pydub import AudioSegment, effects
-from hashlib import sha1
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from song_plan import pattern_hash
+from uniqueness_store import get_pattern_store, record_shipped
+from instrumentation import stage, song as song_metrics, write_batch_summary
+from metrics_exporter import MetricsExporter
+from wav_writer import write_limited
 
 # === Google Drive Setup ===
 SERVICE_ACCOUNT_FILE = 'songgenupload-cf8ed4438b4b.json'
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 DRIVE_FOLDER_ID = '1feczjlX5RKfsdwh4f6WR2V62Q2gLW40J'  # <- Replace with your real folder ID
 
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES
-)
-drive_service = build('drive', 'v3', credentials=credentials)
+_drive_service = None
+
+def get_drive_service():
+    """Build the Drive client on the first upload, so importing this module needs no credentials or network"""
+    global _drive_service
+    if _drive_service is None:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        credentials = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES
+        )
+        _drive_service = build('drive', 'v3', credentials=credentials)
+    return _drive_service
 
 def upload_to_drive(filepath, drive_folder_id=None):
+    from googleapiclient.http import MediaFileUpload
     file_metadata = {'name': os.path.basename(filepath)}
     if drive_folder_id:
         file_metadata['parents'] = [drive_folder_id]
 
     media = MediaFileUpload(filepath, mimetype='audio/wav')
 
-    uploaded_file = drive_service.files().create(
+    uploaded_file = get_drive_service().files().create(
         body=file_metadata,
         media_body=media,
         fields='id',
@@ -38,13 +48,11 @@ def upload_to_drive(filepath, drive_folder_id=None):
 NUM_SONGS = 1000
 MIN_SONG_LENGTH_SEC = 150
 MAX_SONG_LENGTH_SEC = 180
+LIMITER_LEVEL = 0.9
 
 SAMPLES_DIR = "samples"
 DRUMS_BASE_DIR = os.path.join(SAMPLES_DIR, "drums")
 OUTPUT_DIR = "output_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-used_patterns = set()
 
 HARMONIC_KEY_MAP = {
     "c": ["am", "em", "f", "g", "dm"], "g": ["em", "bm", "c", "d", "am"], "d": ["bm", "f#m", "g", "a", "em"],
@@ -72,7 +80,8 @@ def calculate_loop_sections(section_duration, target_duration=60):
     return max(1, round(target_duration / section_duration)) if section_duration > 0 else 1
 
 def load_and_adjust_sample(path):
-    return AudioSegment.from_wav(path)
+    with stage("decode"):
+        return AudioSegment.from_wav(path)
 
 def get_rms(audio):
     return audio.rms if len(audio) > 0 else 0
@@ -266,41 +275,43 @@ def generate_lofi_song(index):
             pattern_id.append(tuple(sorted(used_files)))
             first_loop_after_intro = False
 
-    song_hash = sha1(str(pattern_id).encode()).hexdigest()
-    if song_hash in used_patterns:
-        return False
-    used_patterns.add(song_hash)
+    song_hash = pattern_hash(pattern_id)
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            return False
 
-    song = song.fade_in(3000).fade_out(5000)
-    song = effects.normalize(song)
+    with stage("master"):
+        song = song.fade_in(3000).fade_out(5000)
+        song = effects.normalize(song)
 
-    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}.wav")
-    song.export(filename, format="wav")
-
-    limited_file = filename.replace(".wav", "_limited.wav")
-    subprocess.run([
-        "ffmpeg", "-y", "-i", filename,
-        "-af", "alimiter=limit=0.9",
-        limited_file
-    ])
-    os.remove(filename)
-    os.rename(limited_file, filename)
+    filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}_{song_hash:016x}.wav")
+    write_limited(song, filename, LIMITER_LEVEL)
+    if not record_shipped(song_hash, filename):
+        return False
 
     # ✅ Upload to Google Drive folder
-    upload_to_drive(filename, DRIVE_FOLDER_ID)
+    with stage("upload"):
+        upload_to_drive(filename, DRIVE_FOLDER_ID)
 
     return True
 
 def main():
-    count = 0
-    attempts = 0
-    while count < NUM_SONGS and attempts < NUM_SONGS * 5:
-        if generate_lofi_song(count + 1):
-            print(f"✔️ Generated song {count + 1}")
-            count += 1
-        else:
-            print("⚠️ Skipped duplicate pattern")
-        attempts += 1
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with MetricsExporter("lofi_drive", total=NUM_SONGS):
+        count = 0
+        attempts = 0
+        while count < NUM_SONGS and attempts < NUM_SONGS * 5:
+            with song_metrics("lofi_drive", count + 1) as record:
+                generated = generate_lofi_song(count + 1)
+                record["outcome"] = "ok" if generated else "skipped"
+            if generated:
+                print(f"✔️ Generated song {count + 1}")
+                count += 1
+            else:
+                print("⚠️ Skipped duplicate pattern")
+            attempts += 1
+
+    write_batch_summary("lofi_drive")
 
 if __name__ == "__main__":
     main()
@@ -1,36 +1,218 @@
 import os
+import json
+import mmap
+import struct
 import hashlib
-from pydub import AudioSegment
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 OUTPUT_DIR = "output_songs"
-HASHES = {}
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac")
+CACHE_PATH = os.path.join("song_state", "duplicate_hashes.json")
+MAX_WORKERS = os.cpu_count() or 4
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+PROBE_VERSION = 2  # cached probes from an older layout are probed again
 
-def hash_audio(file_path):
-    try:
-        audio = AudioSegment.from_file(file_path)
-        raw_data = audio.raw_data  # Uncompressed audio bytes
-        return hashlib.sha1(raw_data).hexdigest()
-    except Exception as e:
-        print(f"⚠️ Error loading {file_path}: {e}")
+# Files match when their stored audio is identical: WAV sample data, the MD5 of a FLAC's decoded PCM,
+# or the compressed frames of an MP3 or an MD5-less FLAC. Tags and headers never count, but nothing is
+# decoded, so the same song re-encoded (another bitrate, encoder or FLAC compression level) is not found.
+
+
+def probe_wav(f):
+    """Return (bucket, data_offset, data_size) for a RIFF/RF64 WAV file"""
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff not in (b"RIFF", b"RF64") or wave_id != b"WAVE":
         return None
+    fmt = None
+    data_size_64 = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+        if chunk_id == b"ds64":
+            data_size_64 = struct.unpack("<QQ", f.read(16))[1]
+            f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+        elif chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", f.read(16))
+            f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            if chunk_size == 0xFFFFFFFF and data_size_64 is not None:
+                chunk_size = data_size_64
+            _, channels, sample_rate, _, _, bits = fmt
+            return ("wav", channels, sample_rate, bits, chunk_size), f.tell(), chunk_size
+        else:
+            f.seek(chunk_size + (chunk_size & 1), 1)
 
-def main():
-    print(f"🔍 Scanning for duplicate songs in '{OUTPUT_DIR}'...\n")
-    duplicates = []
 
-    for filename in os.listdir(OUTPUT_DIR):
-        if not filename.lower().endswith(".wav"):
+def probe_flac(f):
+    """Return (bucket, md5, frames_offset). STREAMINFO carries the MD5 of the decoded PCM, so no decode
+    or hashing is needed; without it the frames after the metadata blocks are hashed, so retagging still
+    matches but a re-encode does not"""
+    if f.read(4) != b"fLaC":
+        return None
+    block_header = f.read(4)
+    if block_header[0] & 0x7F != 0:  # STREAMINFO must be the first metadata block
+        return None
+    info = f.read(34)
+    packed = int.from_bytes(info[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    md5 = info[18:34]
+    bucket = ("flac", channels, sample_rate, bits, total_samples)
+    last = block_header[0] & 0x80
+    while not last:
+        block_header = f.read(4)
+        if len(block_header) < 4:
+            return None
+        last = block_header[0] & 0x80
+        f.seek(int.from_bytes(block_header[1:4], "big"), 1)
+    return bucket, md5.hex() if any(md5) else None, f.tell()
+
+
+def probe_mp3(f, file_size):
+    """Return (bucket, data_offset, data_size) for the MPEG frames, skipping ID3v2/ID3v1 tags. The
+    frames are compared as stored, so only copies of the same encode match"""
+    start = 0
+    header = f.read(10)
+    if header[:3] == b"ID3":
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+    end = file_size
+    if file_size >= 128:
+        f.seek(file_size - 128)
+        if f.read(3) == b"TAG":
+            end -= 128
+    size = max(0, end - start)
+    return ("mp3", size), start, size
+
+
+def probe_file(path, file_size):
+    """Return (bucket, known_hash, data_offset, data_size); known_hash is set when the container stores one"""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        if ext == ".flac":
+            probed = probe_flac(f)
+            if probed:
+                bucket, md5, frames_offset = probed
+                return bucket, md5, frames_offset, file_size - frames_offset
+        elif ext == ".wav":
+            probed = probe_wav(f)
+            if probed:
+                return probed[0], None, probed[1], probed[2]
+        elif ext == ".mp3":
+            probed = probe_mp3(f, file_size)
+            return probed[0], None, probed[1], probed[2]
+    # Unknown layout: bucket on size only and hash the whole file
+    return ("raw", file_size), None, 0, file_size
+
+
+def hash_region(path, offset, size):
+    """SHA-1 of the audio payload read through mmap, so the header and tags never affect the result"""
+    h = hashlib.sha1()
+    if size == 0:
+        return h.hexdigest()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            end = min(offset + size, len(mm))
+            for pos in range(offset, end, HASH_CHUNK_BYTES):
+                h.update(view[pos:min(pos + HASH_CHUNK_BYTES, end)])
+        finally:
+            view.release()
+    return h.hexdigest()
+
+
+def load_cache(cache_path=CACHE_PATH):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, cache_path=CACHE_PATH):
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def scan(output_dir, cache):
+    """Probe every audio file, reusing cached probes whose path, mtime and size still match"""
+    entries = {}
+    for filename in sorted(os.listdir(output_dir)):
+        if not filename.lower().endswith(AUDIO_EXTENSIONS):
             continue
-        full_path = os.path.join(OUTPUT_DIR, filename)
-        audio_hash = hash_audio(full_path)
-        if not audio_hash:
+        full_path = os.path.join(output_dir, filename)
+        st = os.stat(full_path)
+        cached = cache.get(full_path)
+        if (cached and cached.get("probe") == PROBE_VERSION
+                and cached["mtime_ns"] == st.st_mtime_ns and cached["size"] == st.st_size):
+            entries[full_path] = cached
             continue
+        try:
+            bucket, known_hash, offset, size = probe_file(full_path, st.st_size)
+        except (OSError, struct.error, IndexError) as e:
+            print(f"⚠️ Error reading {full_path}: {e}")
+            continue
+        entries[full_path] = {
+            "probe": PROBE_VERSION,
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "bucket": list(bucket),
+            "offset": offset,
+            "length": size,
+            "hash": known_hash,
+        }
+    return entries
 
-        if audio_hash in HASHES:
-            original = HASHES[audio_hash]
-            duplicates.append((filename, original))
-        else:
-            HASHES[audio_hash] = filename
+
+def find_duplicates(output_dir=OUTPUT_DIR, cache_path=CACHE_PATH, max_workers=MAX_WORKERS):
+    """Return [(duplicate, original)] filename pairs with identical audio payloads (not re-encodes)"""
+    cache = load_cache(cache_path)
+    entries = scan(output_dir, cache)
+
+    # Only files sharing format and exact payload length can be identical
+    buckets = defaultdict(list)
+    for path, entry in entries.items():
+        buckets[tuple(entry["bucket"])].append(path)
+    candidates = [path for paths in buckets.values() if len(paths) > 1 for path in paths]
+    to_hash = [path for path in candidates if not entries[path]["hash"]]
+
+    if to_hash:
+        print(f"🔢 Hashing {len(to_hash)} of {len(entries)} files using {max_workers} threads...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = executor.map(
+                lambda p: hash_region(p, entries[p]["offset"], entries[p]["length"]), to_hash
+            )
+            for path, digest in zip(to_hash, hashes):
+                entries[path]["hash"] = digest
+
+    save_cache(entries, cache_path)
+
+    duplicates = []
+    for paths in buckets.values():
+        if len(paths) < 2:
+            continue
+        seen = {}
+        for path in paths:
+            digest = entries[path]["hash"]
+            if digest in seen:
+                duplicates.append((os.path.basename(path), os.path.basename(seen[digest])))
+            else:
+                seen[digest] = path
+    return duplicates
+
+
+def main(folder=OUTPUT_DIR):
+    print(f"🔍 Scanning for duplicate songs in '{folder}'...\n")
+    duplicates = find_duplicates(folder)
 
     if duplicates:
         print("🟡 Found duplicate songs:\n")
@@ -0,0 +1,166 @@
+import os
+import fcntl
+from functools import lru_cache
+import numpy as np
+
+FINGERPRINT_INDEX_PATH = os.path.join("song_state", "fingerprints")
+# Euclidean distance between unit-length fingerprints below which two songs count as near duplicates.
+# Calibrated on final_main mixes from a synthetic 90 BPM library (two keys, four samples per layer):
+# the same plan with every layer's gain moved up to ±4 dB or its loop sections reordered stayed within
+# 0.036, distinct plans were never closer than 0.099, and mastering moved a song by under 0.01.
+# A library of near-identical loops may need a lower value: set SONG_NEAR_DUPLICATE_DISTANCE.
+NEAR_DUPLICATE_DISTANCE = float(os.environ.get("SONG_NEAR_DUPLICATE_DISTANCE") or 0.06)
+
+FINGERPRINT_SAMPLE_RATE = 11025
+N_FFT = 2048
+HOP = 1024
+N_MELS = 32
+N_MFCC = 13
+FINGERPRINT_DIM = 2 * (N_MFCC - 1) + 12  # mfcc mean + std (without c0) + chroma
+
+
+def segment_to_array(segment):
+    """Return (float32 samples shaped (frames, channels), frame_rate) for a pydub AudioSegment"""
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32)
+    samples = samples.reshape(-1, segment.channels) / float(1 << (8 * segment.sample_width - 1))
+    return samples, segment.frame_rate
+
+
+@lru_cache(maxsize=8)
+def _filterbanks(sample_rate):
+    freqs = np.fft.rfftfreq(N_FFT, 1.0 / sample_rate)
+
+    def hz_to_mel(hz):
+        return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+    mel_points = np.linspace(hz_to_mel(60.0), hz_to_mel(sample_rate / 2), N_MELS + 2)
+    hz_points = 700.0 * (10 ** (mel_points / 2595.0) - 1.0)
+    mel = np.zeros((N_MELS, freqs.size), dtype=np.float32)
+    for m in range(N_MELS):
+        left, center, right = hz_points[m:m + 3]
+        rising = (freqs - left) / (center - left)
+        falling = (right - freqs) / (right - center)
+        mel[m] = np.clip(np.minimum(rising, falling), 0, None)
+
+    n = np.arange(N_MELS)
+    dct = np.cos(np.pi / N_MELS * (n[None, :] + 0.5) * np.arange(N_MFCC)[:, None]).astype(np.float32)
+
+    chroma = np.zeros((12, freqs.size), dtype=np.float32)
+    pitched = (freqs >= 65.0) & (freqs <= 5000.0)
+    pitch_class = np.round(12 * np.log2(freqs[pitched] / 440.0) + 69).astype(int) % 12
+    chroma[pitch_class, np.flatnonzero(pitched)] = 1.0
+
+    return mel, dct, chroma
+
+
+def compute_fingerprint(samples, sample_rate):
+    """Compact unit-length MFCC + chroma summary of a mix, computed from samples already in memory"""
+    samples = samples if samples.ndim == 2 else samples[:, None]
+    step = max(1, int(sample_rate // FINGERPRINT_SAMPLE_RATE))
+    # Downmix and box-filter decimation (plenty for a coarse spectral summary) as one matrix-vector
+    # product; a mean over the two-wide channel axis alone is ten times slower
+    width = step * samples.shape[1]
+    usable = len(samples) - len(samples) % step
+    mono = np.ascontiguousarray(samples[:usable]).reshape(-1, width) @ np.full(width, 1.0 / width, dtype=np.float32)
+    rate = sample_rate / step
+
+    if mono.size < N_FFT:
+        mono = np.pad(mono, (0, N_FFT - mono.size))
+    frame_count = 1 + (mono.size - N_FFT) // HOP
+    frames = np.lib.stride_tricks.as_strided(
+        mono, shape=(frame_count, N_FFT), strides=(mono.strides[0] * HOP, mono.strides[0])
+    )
+    power = np.abs(np.fft.rfft(frames * np.hanning(N_FFT).astype(np.float32), axis=1)) ** 2
+
+    mel, dct, chroma_map = _filterbanks(rate)
+    mel_energy = mel @ power.T
+    # Relative floor so near-silent bands and a little added noise don't dominate the cepstrum
+    mfcc = dct @ np.log(mel_energy + 1e-3 * mel_energy.mean() + 1e-10)
+    chroma = chroma_map @ power.T
+    chroma /= chroma.sum(axis=0, keepdims=True) + 1e-10
+
+    # Drop c0 (overall loudness) and give each block equal weight
+    blocks = [mfcc[1:].mean(axis=1), mfcc[1:].std(axis=1), chroma.mean(axis=1)]
+    blocks = [b / (np.linalg.norm(b) + 1e-10) for b in blocks]
+    return (np.concatenate(blocks) / np.sqrt(len(blocks))).astype(np.float32)
+
+
+class FingerprintIndex:
+    """Append-only on-disk matrix of song fingerprints with batched nearest-neighbour queries.
+
+    Rows live in <path>.f32 and the matching 64-bit song ids in <path>.ids; both are memory-mapped
+    for queries and only re-mapped when another process has appended to them. Appends are serialised
+    with an flock so several generator processes can share one index.
+    """
+
+    def __init__(self, path=FINGERPRINT_INDEX_PATH, dim=FINGERPRINT_DIM):
+        self.path = path
+        self.dim = dim
+        self._matrix_path = f"{path}.f32"
+        self._ids_path = f"{path}.ids"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype="<u8")
+        self._mapped_sizes = None
+
+    def _refresh(self):
+        # Keyed on both file sizes: add() grows the matrix before the ids, and a reader that lands in
+        # between maps only the rows both files hold, so it must look again once the ids catch up
+        size = os.path.getsize(self._matrix_path) if os.path.exists(self._matrix_path) else 0
+        ids_size = os.path.getsize(self._ids_path) if os.path.exists(self._ids_path) else 0
+        if (size, ids_size) == self._mapped_sizes:
+            return
+        rows = min(size // (4 * self.dim), ids_size // 8)
+        if rows:
+            self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            self._ids = np.memmap(self._ids_path, dtype="<u8", mode="r", shape=(rows,))
+        self._mapped_sizes = (size, ids_size)
+
+    def __len__(self):
+        self._refresh()
+        return len(self._ids)
+
+    def nearest(self, fingerprints):
+        """Return (song_ids, distances) of the closest stored song for each row of fingerprints"""
+        queries = np.atleast_2d(np.asarray(fingerprints, dtype=np.float32))
+        self._refresh()
+        if not len(self._ids):
+            return np.zeros(len(queries), dtype="<u8"), np.full(len(queries), np.inf, dtype=np.float32)
+        # Fingerprints are unit length, so the nearest neighbour is the largest dot product
+        similarity = queries @ self._matrix.T
+        best = similarity.argmax(axis=1)
+        best_similarity = similarity[np.arange(len(queries)), best]
+        distances = np.sqrt(np.clip(2.0 - 2.0 * best_similarity, 0.0, None))
+        return np.asarray(self._ids[best]), distances
+
+    def find_near_duplicate(self, fingerprint, max_distance=NEAR_DUPLICATE_DISTANCE):
+        """Return the id of a stored song within max_distance of fingerprint, or None"""
+        ids, distances = self.nearest(fingerprint)
+        return int(ids[0]) if distances[0] < max_distance else None
+
+    def add(self, song_id, fingerprint):
+        row = np.asarray(fingerprint, dtype=np.float32).reshape(self.dim)
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Trim any half-written row left by a crashed writer so both files stay aligned
+            matrix_size = os.path.getsize(self._matrix_path) if os.path.exists(self._matrix_path) else 0
+            ids_size = os.path.getsize(self._ids_path) if os.path.exists(self._ids_path) else 0
+            rows = min(matrix_size // (4 * self.dim), ids_size // 8)
+            with open(self._matrix_path, "ab") as f:
+                f.truncate(rows * 4 * self.dim)
+                f.write(row.tobytes())
+            with open(self._ids_path, "ab") as f:
+                f.truncate(rows * 8)
+                f.write(np.array([song_id & 0xFFFFFFFFFFFFFFFF], dtype="<u8").tobytes())
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_fingerprint_index = None
+
+
+def get_fingerprint_index():
+    """Process-wide fingerprint index, opened on first use"""
+    global _fingerprint_index
+    if _fingerprint_index is None:
+        _fingerprint_index = FingerprintIndex()
+    return _fingerprint_index
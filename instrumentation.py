@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+
+# Per-stage wall-clock timings (and optionally memory peaks) for every song, appended as JSON lines to
+# song_state/metrics/<generator>.jsonl, plus a p50/p95 batch summary at the end of a run.
+METRICS_DIR = os.path.join("song_state", "metrics")
+PROFILE_DIR = os.path.join("song_state", "profiles")
+# Set SONG_PROFILE=<song index> to run the sampling profiler while that song is generated
+PROFILE_SONG = os.environ.get("SONG_PROFILE")
+PROFILE_INTERVAL_SEC = 0.001
+# Set SONG_MEMORY=1 to also record tracemalloc peaks per song and stage plus process RSS;
+# SONG_MEMORY_BUDGET_MB warns about songs whose peak goes over it
+MEMORY_MODE = os.environ.get("SONG_MEMORY") == "1"
+MEMORY_BUDGET_MB = float(os.environ["SONG_MEMORY_BUDGET_MB"]) if os.environ.get("SONG_MEMORY_BUDGET_MB") else None
+MB = 1 << 20
+
+_current = None
+_batch = []
+_memory_frames = []
+_song_listeners = []
+_cache_counts = {}
+_cache_info = {}
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    """Process RSS high-water mark (ru_maxrss is bytes on macOS, KiB elsewhere)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def _memory_enter():
+    current, peak = tracemalloc.get_traced_memory()
+    if _memory_frames:
+        _memory_frames[-1]["peak"] = max(_memory_frames[-1]["peak"], peak)
+    tracemalloc.reset_peak()
+    _memory_frames.append({"start": current, "peak": current})
+
+
+def _memory_exit():
+    """Peak traced allocation (MB) above the level at _memory_enter, including nested frames"""
+    frame = _memory_frames.pop()
+    peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+    if _memory_frames:
+        _memory_frames[-1]["peak"] = max(_memory_frames[-1]["peak"], peak)
+    return (peak - frame["start"]) / MB
+
+
+@contextmanager
+def stage(name):
+    """Time a block of work and add it to the current song's total for this stage (stages may nest)"""
+    track_memory = MEMORY_MODE and _current is not None
+    if track_memory:
+        _memory_enter()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _current is not None:
+            stages = _current["stages"]
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+        if track_memory:
+            peak_mb = _memory_exit()
+            if _current is not None:
+                memory = _current["memory"]["stages"]
+                memory[name] = max(memory.get(name, 0.0), peak_mb)
+
+
+def add_song_listener(listener):
+    """listener(record) is called after every finished song attempt"""
+    _song_listeners.append(listener)
+
+
+def remove_song_listener(listener):
+    if listener in _song_listeners:
+        _song_listeners.remove(listener)
+
+
+def count_cache(name, hit):
+    counts = _cache_counts.setdefault(name, {"hits": 0, "misses": 0})
+    counts["hits" if hit else "misses"] += 1
+
+
+def register_cache_info(name, cache_info):
+    """Report a functools.lru_cache (pass its cache_info) alongside the counted caches"""
+    _cache_info[name] = cache_info
+
+
+def cache_stats():
+    stats = {name: dict(counts) for name, counts in _cache_counts.items()}
+    for name, cache_info in _cache_info.items():
+        info = cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses}
+    return stats
+
+
+def write_record(generator, record):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, f"{generator}.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def song(generator, index, profile=False):
+    """Collect stage timings for one song attempt; set record["outcome"] to label skips.
+    profile=True runs the sampling profiler regardless of SONG_PROFILE"""
+    global _current
+    record = {"type": "song", "generator": generator, "index": index, "started": time.time(), "outcome": "ok", "stages": {}}
+    profiler = SamplingProfiler() if profile or PROFILE_SONG == str(index) else None
+    if profiler:
+        profiler.start()
+    if MEMORY_MODE:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        record["memory"] = {"stages": {}}
+        _memory_enter()
+    _current = record
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record["outcome"] = "error"
+        raise
+    finally:
+        record["total_sec"] = round(time.perf_counter() - start, 6)
+        record["stages"] = {name: round(sec, 6) for name, sec in record["stages"].items()}
+        if MEMORY_MODE:
+            record_memory(record, _memory_exit())
+        _current = None
+        if profiler:
+            profiler.stop()
+            folded_path, trace_path = profiler.write(f"{generator}_{index:03d}")
+            print(f"🔥 Profile written to {trace_path} (Chrome trace) and {folded_path} (flame graph stacks)")
+        _batch.append(record)
+        write_record(generator, record)
+        for listener in list(_song_listeners):
+            listener(record)
+
+
+def record_memory(record, peak_mb):
+    memory = record["memory"]
+    memory["peak_mb"] = round(peak_mb, 2)
+    memory["stages"] = {name: round(mb, 2) for name, mb in memory["stages"].items()}
+    rss_mb = current_rss_mb()
+    memory["rss_mb"] = round(rss_mb, 1) if rss_mb is not None else None
+    memory["rss_peak_mb"] = round(peak_rss_mb(), 1)
+    if MEMORY_BUDGET_MB and max(peak_mb, rss_mb or 0) > MEMORY_BUDGET_MB:
+        print(f"⚠️ {record['generator']} song {record['index']} used {peak_mb:.0f}MB at peak (RSS {rss_mb or 0:.0f}MB), "
+              f"over the {MEMORY_BUDGET_MB:.0f}MB budget")
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 6),
+        "p50": round(float(np.percentile(values, 50)), 6),
+        "p95": round(float(np.percentile(values, 95)), 6),
+    }
+
+
+def summarize(records):
+    """p50/p95 per stage over the finished songs in records, plus overall throughput"""
+    rendered = [r for r in records if r["outcome"] == "ok"]
+    stage_values = {}
+    for record in rendered:
+        for name, sec in record["stages"].items():
+            stage_values.setdefault(name, []).append(sec)
+    wall_sec = (time.time() - records[0]["started"]) if records else 0.0
+    summary = {
+        "attempts": len(records),
+        "songs": len(rendered),
+        "outcomes": dict(Counter(r["outcome"] for r in records)),
+        "wall_sec": round(wall_sec, 3),
+        "songs_per_minute": round(len(rendered) * 60 / wall_sec, 3) if wall_sec else 0.0,
+        "total": percentiles([r["total_sec"] for r in rendered]) if rendered else None,
+        "stages": {name: percentiles(values) for name, values in sorted(stage_values.items())},
+    }
+
+    measured = [r["memory"] for r in rendered if "memory" in r]
+    if measured:
+        stage_peaks = {}
+        for memory in measured:
+            for name, mb in memory["stages"].items():
+                stage_peaks.setdefault(name, []).append(mb)
+        summary["memory"] = {
+            "song_peak_mb": percentiles([m["peak_mb"] for m in measured]),
+            "rss_peak_mb": max(m["rss_peak_mb"] for m in measured),
+            "stages": {name: percentiles(values) for name, values in sorted(stage_peaks.items())},
+        }
+    return summary
+
+
+def write_batch_summary(generator):
+    """Append this run's summary to the metrics file and print the slowest stages"""
+    summary = {"type": "batch", "generator": generator, "finished": time.time(), **summarize(_batch)}
+    write_record(generator, summary)
+    print(f"📈 {summary['songs']}/{summary['attempts']} songs, {summary['songs_per_minute']:.2f} songs/min")
+    slowest = sorted(summary["stages"].items(), key=lambda item: -item[1]["p50"])
+    for name, stats in slowest[:8]:
+        print(f"   {name:12} p50 {stats['p50'] * 1000:9.1f}ms   p95 {stats['p95'] * 1000:9.1f}ms")
+    if "memory" in summary:
+        memory = summary["memory"]
+        print(f"🧠 Peak per song p50 {memory['song_peak_mb']['p50']:.0f}MB, p95 {memory['song_peak_mb']['p95']:.0f}MB, "
+              f"process RSS high-water {memory['rss_peak_mb']:.0f}MB")
+        hungriest = sorted(memory["stages"].items(), key=lambda item: -item[1]["p95"])
+        for name, stats in hungriest[:5]:
+            print(f"   {name:12} p95 {stats['p95']:7.1f}MB")
+    _batch.clear()
+    return summary
+
+
+class SamplingProfiler:
+    """Samples the main thread's Python stack from a background thread; no extra dependencies"""
+
+    def __init__(self, interval=PROFILE_INTERVAL_SEC, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame.f_code))
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), tuple(reversed(stack))))
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._end = time.perf_counter()
+
+    def folded_stacks(self):
+        """Collapsed stacks ("a;b;c count"), the input format of flamegraph.pl and speedscope"""
+        counts = Counter(";".join(stack) for _, stack in self.samples if stack)
+        return [f"{stack} {count}" for stack, count in counts.most_common()]
+
+    def trace_events(self):
+        """Chrome trace "X" events: consecutive samples sharing a stack prefix become one span"""
+        events = []
+        open_frames = []  # (label, start_time)
+
+        def close_from(depth, now):
+            while len(open_frames) > depth:
+                label, started = open_frames.pop()
+                events.append({
+                    "name": label, "ph": "X", "pid": 1, "tid": 1,
+                    "ts": round((started - self._start) * 1e6, 1),
+                    "dur": round((now - started) * 1e6, 1),
+                })
+
+        for now, stack in self.samples:
+            common = 0
+            while common < min(len(stack), len(open_frames)) and open_frames[common][0] == stack[common]:
+                common += 1
+            close_from(common, now)
+            open_frames.extend((label, now) for label in stack[common:])
+        close_from(0, self._end)
+        return events
+
+    def write(self, name, profile_dir=PROFILE_DIR):
+        os.makedirs(profile_dir, exist_ok=True)
+        folded_path = os.path.join(profile_dir, f"{name}.folded")
+        trace_path = os.path.join(profile_dir, f"{name}.trace.json")
+        with open(folded_path, "w") as f:
+            f.write("\n".join(self.folded_stacks()) + "\n")
+        with open(trace_path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+        return folded_path, trace_path
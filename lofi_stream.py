@@ -0,0 +1,328 @@
+import os
+import sys
+import time
+import queue
+import random
+import socket
+import argparse
+import threading
+from collections import deque
+import numpy as np
+import final_main
+from song_plan import pattern_hash, new_seed
+from timeline import segment_frames, equal_power, SAMPLE_RATE, CHANNELS
+from effects_chain import EffectChain
+from wav_writer import wav_header, RIFF_MAX_DATA_BYTES
+from instrumentation import stage, song as song_metrics
+from metrics_exporter import MetricsExporter
+
+# Endless lofi: final_main plans songs (intro/loop_a/loop_b/bridge/outro) one after another, a
+# background thread renders them a section at a time just ahead of the listener, and the main thread
+# sends fixed-size 16-bit PCM blocks to stdout, a FIFO or a local socket.
+BLOCK_FRAMES = 4410            # 100 ms
+LATENCY_BUDGET_MS = 250        # a block not ready within this is sent as silence, so the stream never stalls
+AHEAD_SEC = 30                 # rendered audio queued ahead of the listener
+TRANSITION_SEC = 6             # one song's outro crossfades into the next song's intro
+DECLICK_FRAMES = 256           # sections within a song overlap this much, so loops cut mid-cycle do not click
+STREAM_FADE_IN_SEC = 3
+PEAK_TARGET = 0.89             # about -1 dBFS, like pydub's normalize headroom
+MAX_GAIN_DB = 12
+GAIN_RAMP_SEC = 2.0
+RECENT_SONGS = 500             # plans heard this recently are planned again
+CLIENT_BUFFER_SEC = 2          # audio a socket client may fall behind by before it is dropped
+
+
+def parse_target(target):
+    """"-" is stdout, unix:/path and tcp:host:port are sockets, anything else is a FIFO path"""
+    if target == "-":
+        return "stdout", None
+    if target.startswith("unix:"):
+        return "unix", target[5:]
+    if target.startswith("tcp:"):
+        host, port = target[4:].rsplit(":", 1)
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "fifo", target
+
+
+class PipeSink:
+    """stdout or a FIFO; a FIFO whose reader goes away is reopened for the next reader"""
+
+    def __init__(self, path=None, header=b""):
+        self.path = path
+        self.header = header
+        self.f = None
+        if path is None:
+            # The generators print progress; keep it off the audio
+            self.stdout = sys.stdout.buffer
+            sys.stdout = sys.stderr
+        if path and not os.path.exists(path):
+            os.mkfifo(path)
+
+    def _open(self):
+        if self.path is None:
+            self.f = self.stdout
+        else:
+            print(f"📻 Waiting for a reader on {self.path}", file=sys.stderr)
+            self.f = open(self.path, "wb", buffering=0)
+        if self.header:
+            self.f.write(self.header)
+
+    def write(self, block):
+        if self.f is None:
+            self._open()
+        try:
+            self.f.write(block)
+        except BrokenPipeError:
+            if self.path is None:
+                raise
+            self.f = None
+
+    def close(self):
+        if self.f is not None and self.path is not None:
+            self.f.close()
+
+
+class SocketSink:
+    """Listens on a unix or localhost TCP socket and sends every block to every connected client.
+
+    Clients are non-blocking with their own send buffer, so a stalled or slow listener never holds up
+    the others or the render queue; one that falls CLIENT_BUFFER_SEC behind is dropped.
+    """
+
+    def __init__(self, kind, address, header=b"", buffer_sec=CLIENT_BUFFER_SEC):
+        self.header = header
+        self.max_pending = len(header) + int(buffer_sec * SAMPLE_RATE) * CHANNELS * 2
+        self.clients = {}  # socket -> bytes not yet sent to it
+        self.lock = threading.Lock()
+        if kind == "unix":
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            client.setblocking(False)
+            with self.lock:
+                self.clients[client] = bytearray(self.header)
+                self._send(client)
+
+    def _send(self, client):
+        """Send what the socket takes right now; drop the client if it is gone or too far behind"""
+        pending = self.clients[client]
+        if len(pending) > self.max_pending:
+            print("📻 Dropping a listener that fell behind", file=sys.stderr)
+            self._drop(client)
+            return
+        try:
+            sent = client.send(pending) if pending else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(client)
+            return
+        del pending[:sent]
+
+    def _drop(self, client):
+        client.close()
+        del self.clients[client]
+
+    def write(self, block):
+        with self.lock:
+            for client in list(self.clients):
+                self.clients[client] += block
+                self._send(client)
+
+    def close(self):
+        self.server.close()
+        with self.lock:
+            for client in list(self.clients):
+                self._drop(client)
+
+
+class GainRider:
+    """Normalises section by section (a stream never has the whole song to normalise), rising slowly and
+    dropping at once so a louder section cannot clip on the way in"""
+
+    def __init__(self, ramp_frames=int(GAIN_RAMP_SEC * SAMPLE_RATE)):
+        self.ramp_frames = ramp_frames
+        self.gain = None
+
+    def apply(self, frames):
+        peak = float(np.abs(frames).max()) if len(frames) else 0.0
+        target = min(PEAK_TARGET / peak, 10 ** (MAX_GAIN_DB / 20)) if peak > 0 else 1.0
+        if self.gain is None or target <= self.gain:
+            self.gain = target
+            return frames * np.float32(target)
+        ramp = min(len(frames), self.ramp_frames)
+        envelope = np.full(len(frames), target, dtype=np.float32)
+        envelope[:ramp] = np.linspace(self.gain, target, ramp, dtype=np.float32)
+        self.gain = target
+        return frames * envelope[:, None]
+
+
+def to_pcm16(frames):
+    return (np.clip(frames, -1.0, 1.0) * 32767).astype("<i2")
+
+
+class StreamRenderer:
+    """Plans and renders songs on a background thread into a bounded queue of PCM blocks"""
+
+    def __init__(self, seed=None, ahead_sec=AHEAD_SEC, transition_sec=TRANSITION_SEC):
+        self.rng = random.Random(new_seed() if seed is None else seed)
+        self.blocks = queue.Queue(maxsize=max(1, int(ahead_sec * SAMPLE_RATE / BLOCK_FRAMES)))
+        self.transition_frames = int(transition_sec * SAMPLE_RATE)
+        self.recent = deque(maxlen=RECENT_SONGS)
+        self.master = EffectChain(final_main.MASTER_EFFECTS)
+        self.rider = GainRider()
+        self.position = 0
+        self.pending = np.zeros((0, CHANNELS), dtype=np.float32)
+        self.songs = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def plan_next(self):
+        for _ in range(20):
+            plan = final_main.plan_song(rng=self.rng)
+            song_hash = pattern_hash(plan["pattern_id"])
+            if song_hash not in self.recent:
+                break
+        self.recent.append(song_hash)
+        return plan
+
+    def _emit(self, frames):
+        """Cut frames into fixed-size blocks; a partial block waits for the next section"""
+        frames = np.concatenate([self.pending, frames]) if len(self.pending) else frames
+        whole = len(frames) - len(frames) % BLOCK_FRAMES
+        for start in range(0, whole, BLOCK_FRAMES):
+            block = to_pcm16(frames[start:start + BLOCK_FRAMES]).tobytes()
+            while not self.stop.is_set():
+                try:
+                    self.blocks.put(block, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+        self.pending = frames[whole:]
+
+    def _render_song(self, plan, held_tail):
+        sample_cache = {}
+        sections = plan["sections"]
+        for i, section in enumerate(sections):
+            with stage("render"):
+                frames = segment_frames(final_main.render_section(section, sample_cache))
+            with stage("master"):
+                frames = self.rider.apply(self.master.process(frames, SAMPLE_RATE, self.position) if self.master else frames)
+                if self.position == 0:
+                    fade = min(len(frames), STREAM_FADE_IN_SEC * SAMPLE_RATE)
+                    frames[:fade] *= np.linspace(0, 1, fade, dtype=np.float32)[:, None]
+                if held_tail is not None:
+                    # Equal-power overlap of what came before (the last song's outro, or a few ms of the
+                    # previous section) with the start of this section
+                    n = min(len(held_tail), len(frames))
+                    fade_in, fade_out = equal_power(n)
+                    frames[:n] = frames[:n] * fade_in[:, None] + held_tail[:n] * fade_out[:, None]
+                    held_tail = None
+                hold = self.transition_frames if i == len(sections) - 1 else DECLICK_FRAMES
+                if len(frames) > hold:
+                    frames, held_tail = frames[:-hold], frames[-hold:].copy()
+            self.position += len(frames)
+            self._emit(frames)
+            if self.stop.is_set():
+                break
+        return held_tail
+
+    def _run(self):
+        held_tail = None
+        while not self.stop.is_set():
+            self.songs += 1
+            with song_metrics("lofi_stream", self.songs):
+                with stage("plan"):
+                    plan = self.plan_next()
+                held_tail = self._render_song(plan, held_tail)
+
+
+def next_block(renderer, timeout):
+    """The next rendered block, or None once timeout passes (timeout=None waits as long as rendering runs)"""
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    while True:
+        wait = 0.5 if deadline is None else max(0.0, deadline - time.perf_counter())
+        try:
+            return renderer.blocks.get(timeout=wait)
+        except queue.Empty:
+            if not renderer.thread.is_alive():
+                raise RuntimeError("the render thread stopped; see the traceback above")
+            if deadline is not None:
+                return None
+
+
+def run_stream(sink, seed=None, budget_ms=LATENCY_BUDGET_MS, realtime=False, duration_sec=None):
+    """Send blocks to sink until interrupted (or for duration_sec); returns the stream stats"""
+    renderer = StreamRenderer(seed)
+    silence = bytes(BLOCK_FRAMES * CHANNELS * 2)
+    block_sec = BLOCK_FRAMES / SAMPLE_RATE
+    stats = {"blocks": 0, "underruns": 0, "first_block_ms": None}
+
+    with MetricsExporter("lofi_stream") as exporter:
+        exporter.set_queue("blocks_ahead", renderer.blocks.qsize)
+        exporter.set_queue("underruns", lambda: stats["underruns"])
+        started = time.perf_counter()
+        renderer.start()
+        # The first block may take as long as the first section; after that each block has the budget
+        block = next_block(renderer, None)
+        stats["first_block_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"▶️ Streaming after {stats['first_block_ms']:.0f}ms", file=sys.stderr)
+        next_send = time.perf_counter()
+        try:
+            while duration_sec is None or stats["blocks"] * block_sec < duration_sec:
+                if block is None:
+                    block = next_block(renderer, budget_ms / 1000)
+                    if block is None:
+                        block = silence
+                        stats["underruns"] += 1
+                if realtime:
+                    time.sleep(max(0.0, next_send - time.perf_counter()))
+                    next_send += block_sec
+                sink.write(block)
+                stats["blocks"] += 1
+                block = None
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        finally:
+            renderer.stop.set()
+            sink.close()
+    print(f"⏹️ {stats['blocks'] * block_sec / 60:.1f} min streamed over {renderer.songs} songs, "
+          f"{stats['underruns']} underruns", file=sys.stderr)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Endless lofi stream as 16-bit stereo PCM")
+    parser.add_argument("target", nargs="?", default="-", help="- for stdout, a FIFO path, unix:/path or tcp:host:port")
+    parser.add_argument("--wav", action="store_true", help="start with a WAV header so players can read it directly")
+    parser.add_argument("--realtime", action="store_true", help="pace blocks to the wall clock (implied for sockets)")
+    parser.add_argument("--budget-ms", type=float, default=LATENCY_BUDGET_MS)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--minutes", type=float, help="stop after this much audio")
+    args = parser.parse_args(argv)
+
+    header = wav_header(SAMPLE_RATE, CHANNELS, 2, RIFF_MAX_DATA_BYTES) if args.wav else b""
+    kind, address = parse_target(args.target)
+    sink = SocketSink(kind, address, header) if kind in ("unix", "tcp") else PipeSink(address, header)
+    run_stream(sink, args.seed, args.budget_ms, args.realtime or kind in ("unix", "tcp"),
+               args.minutes * 60 if args.minutes else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,9 @@ import librosa
 import soundfile as sf
 from hashlib import sha1
 import numpy as np
+from fingerprint_index import get_fingerprint_index, compute_fingerprint, segment_to_array
 
 # Config
-song_signatures = []
 MIN_SONG_LENGTH_SEC = 150  # 2 min 30 sec
 MAX_SONG_LENGTH_SEC = 180  # 3 min
 SECTION_DURATION_SEC = 24   # One 4-bar loop at 120 BPM
@@ -17,15 +17,9 @@ NUM_SONGS = 1000
 SAMPLES_DIR = "samples"
 GLOBAL_DRUMS_DIR = os.path.join(SAMPLES_DIR, "drums")
 OUTPUT_DIR = "output_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 used_patterns = set()
 
 
-def get_mfcc_signature(file_path, n_mfcc=13):
-    y, sr = librosa.load(file_path, sr=None)
-    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=n_mfcc)
-    return np.mean(mfcc, axis=1)  # summarize as 1D vector
-
 def get_key_bpm_folders():
     return [
         f for f in os.listdir(SAMPLES_DIR)
@@ -118,21 +112,18 @@ def generate_song(index):
     used_patterns.add(song_hash)
     song = song.fade_in(3000).fade_out(5000)
     song = effects.normalize(song)
+
+    # Compare a fingerprint of the in-memory mix against every previous song
+    fingerprint = compute_fingerprint(*segment_to_array(song))
+    if get_fingerprint_index().find_near_duplicate(fingerprint) is not None:
+        print("❌ Song too similar to an existing one.")
+        return False
+
     filename = os.path.join(OUTPUT_DIR, f"song_{index:03d}.wav")
 
     # Export raw song first
     song.export(filename, format="wav")
 
-    # Compute MFCC signature and compare with previous
- #   new_sig = get_mfcc_signature(filename)
-  #  for sig in song_signatures:
-  #      similarity = np.linalg.norm(new_sig - sig)
- #       if similarity < 20:  # Adjust this threshold to tune similarity sensitivity
-  #          print("❌ Song too similar to an existing one. Deleting.")
-  #          os.remove(filename)
-  #          return False
- #  song_signatures.append(new_sig)
-
     # Apply hard limiter using FFmpeg
     limited_file = filename.replace(".wav", "_limited.wav")
 
@@ -145,10 +136,12 @@ def generate_song(index):
     # Replace original with limited version
     os.remove(filename)
     os.rename(limited_file, filename)
+    get_fingerprint_index().add(int(song_hash[:16], 16), fingerprint)
 
     return True
 
 def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     count = 0
     attempts = 0
     while count < NUM_SONGS and attempts < NUM_SONGS * 5:
@@ -2,9 +2,10 @@ import os
 import subprocess
 import random
 import re
-import tempfile
 from pydub import AudioSegment, effects
 from hashlib import sha1
+from stretch_cache import to_segment
+from time_stretch import load_stretched
 
 # Configuration
 NUM_SONGS = 1000
@@ -17,7 +18,6 @@ SHORT_SECTION_DURATION_SEC = 10.5  # for intro
 SAMPLES_DIR = "samples"
 GLOBAL_DRUMS_DIR = os.path.join(SAMPLES_DIR, "drums")
 OUTPUT_DIR = "output_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 used_patterns = set()
 
@@ -38,39 +38,16 @@ def compute_musical_stretch_ratio(audio, original_bpm, target_bpm, desired_durat
     target_beats = target_bpm * (desired_duration_ms / 1000 / 60)
     return original_beats / target_beats
 
-def time_stretch_with_ffmpeg(input_path, stretch_ratio):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        output_path = tmp.name
-
-    filters = []
-    remaining = 1 / stretch_ratio
-    while remaining < 0.5 or remaining > 2.0:
-        step = 2.0 if remaining > 2.0 else 0.5
-        filters.append(f"atempo={step}")
-        remaining /= step
-    filters.append(f"atempo={remaining:.6f}")
-    atempo_filter = ",".join(filters)
-
-    subprocess.run([
-        "ffmpeg", "-y", "-i", input_path,
-        "-filter:a", atempo_filter,
-        output_path
-    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    return output_path
-
 def load_and_adjust_sample(path, target_bpm, num_bars=8):
     original_bpm = extract_bpm_from_filename(os.path.basename(path))
     if not original_bpm:
         print(f"[WARN] No BPM found in filename: {path}")
         return None
 
-    original_audio = AudioSegment.from_wav(path)
-
-    # Step 1: Stretch to match target BPM
+    # Step 1: Stretch to match target BPM in-process (cached per sample and tempo across runs)
     stretch_ratio = original_bpm / target_bpm
-    stretched_path = time_stretch_with_ffmpeg(path, stretch_ratio)
-    stretched_audio = AudioSegment.from_wav(stretched_path)
+    samples, sample_rate = load_stretched(path, 1 / stretch_ratio, "wsola")
+    stretched_audio = to_segment(samples, sample_rate)
 
     # Step 2: Calculate how long N bars is at target BPM
     beats_per_second = target_bpm / 60
@@ -231,6 +208,7 @@ def generate_lofi_song(index):
     return True
 
 def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     count = 0
     attempts = 0
     while count < NUM_SONGS and attempts < NUM_SONGS * 5:
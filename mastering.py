@@ -4,25 +4,32 @@ import matchering as mg
 INPUT_DIR = "output_songs"
 REFERENCE_TRACK = "reference.wav"
 OUTPUT_DIR = "mastered_songs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Optional: log progress
-mg.log(print)
 
-for fname in os.listdir(INPUT_DIR):
-    if not fname.lower().endswith(".wav"):
-        continue
+def main(input_dir=INPUT_DIR, output_dir=OUTPUT_DIR, reference=REFERENCE_TRACK):
+    os.makedirs(output_dir, exist_ok=True)
 
-    target = os.path.join(INPUT_DIR, fname)
-    output = os.path.join(OUTPUT_DIR, fname)
+    # Optional: log progress
+    mg.log(print)
 
-    print(f"🎧 Matching {fname} to reference...")
+    for fname in os.listdir(input_dir):
+        if not fname.lower().endswith(".wav"):
+            continue
 
-    mg.process(
-        target=target,
-        reference=REFERENCE_TRACK,
-        results=[
-            mg.pcm16(output.rsplit(".", 1)[0] + "_master16.wav"),
-            mg.pcm24(output.rsplit(".", 1)[0] + "_master24.wav"),
-        ],
-    )
+        target = os.path.join(input_dir, fname)
+        output = os.path.join(output_dir, fname)
+
+        print(f"🎧 Matching {fname} to reference...")
+
+        mg.process(
+            target=target,
+            reference=reference,
+            results=[
+                mg.pcm16(output.rsplit(".", 1)[0] + "_master16.wav"),
+                mg.pcm24(output.rsplit(".", 1)[0] + "_master24.wav"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import os
+import random
+import argparse
+from functools import lru_cache
+import numpy as np
+from song_plan import pattern_hash, list_wav_files, new_seed
+from uniqueness_store import get_pattern_store, record_shipped
+from timeline import load_frames, equal_power, SAMPLE_RATE, CHANNELS
+from wav_writer import WavStream
+from run_journal import RunJournal
+from instrumentation import stage, song as song_metrics, write_batch_summary
+from metrics_exporter import MetricsExporter
+
+# Long-form (1-10 hour) ambient tracks rendered in fixed-size blocks straight to disk. Every layer is
+# looped by index arithmetic into the current block, so memory is the same for 1 hour as for 10.
+
+# Configuration
+NUM_TRACKS = 1
+TRACK_HOURS = 1.0
+SECTION_SEC_RANGE = (90, 180)   # each section keeps its samples this long before crossfading on
+CROSSFADE_SEC = 8
+BED_SEAM_SEC = 4                # a bed's tail is blended into its head once, so its loop point is inaudible
+FADE_IN_SEC = 15
+FADE_OUT_SEC = 60
+BLOCK_SEC = 10
+PERCUSSION_CHANCE = 0.35
+MASTER_GAIN_DB = -3.0
+
+# Paths
+MEDITATION_DIR = os.path.join("meditation_samples", "80_meditation")
+PERCUSSION_DIR = os.path.join("meditation_samples", "percussion")
+AMBIENT_BED_DIR = "meditation_tracks"
+PIANO_DIR = os.path.join("samples_piano_nature", "piano")
+NATURE_DIR = os.path.join("samples_piano_nature", "nature")
+OUTPUT_DIR = "meditation_output"
+
+# mode -> per-section layers and whole-track beds: name -> (folder, gain_db)
+MODES = {
+    "meditation": {
+        "layers": {
+            "chords": (os.path.join(MEDITATION_DIR, "chords"), -6),
+            "melody": (os.path.join(MEDITATION_DIR, "melody"), -9),
+            "percussion": (PERCUSSION_DIR, -15),
+        },
+        "beds": {"ambient": (AMBIENT_BED_DIR, -10), "nature": (NATURE_DIR, -16)},
+    },
+    "piano": {
+        "layers": {"piano": (PIANO_DIR, -6)},
+        "beds": {"nature": (NATURE_DIR, -10)},
+    },
+}
+OPTIONAL_LAYERS = {"percussion": PERCUSSION_CHANCE}
+
+
+def db_to_gain(db):
+    return np.float32(10 ** (db / 20))
+
+
+@lru_cache(maxsize=32)
+def load_source(path):
+    """Decoded and peak-normalised once per process; layer gains are applied on top"""
+    samples = load_frames(path)
+    peak = float(np.abs(samples).max()) if len(samples) else 0.0
+    return samples / np.float32(peak) if peak > 0 else samples
+
+
+@lru_cache(maxsize=8)
+def load_bed(path, seam_frames=BED_SEAM_SEC * SAMPLE_RATE):
+    """A loop with its last seam_frames crossfaded into its first, so bed[t % len(bed)] never clicks"""
+    samples = load_source(path)
+    if len(samples) < 2 * seam_frames:
+        return samples
+    fade_in, fade_out = equal_power(seam_frames)
+    loop = samples[:-seam_frames].copy()
+    loop[:seam_frames] = samples[:seam_frames] * fade_in[:, None] + samples[-seam_frames:] * fade_out[:, None]
+    return loop
+
+
+def add_looped(out, samples, offset, gain):
+    """out += samples repeated forever, read from frame offset: the read position is offset % len(samples),
+    so a loop costs a slice or two per block however long the track is"""
+    position = offset % len(samples)
+    done = 0
+    while done < len(out):
+        take = min(len(out) - done, len(samples) - position)
+        out[done:done + take] += samples[position:position + take] * gain
+        done += take
+        position = 0
+
+
+def plan_track(mode, hours, rng=random):
+    """Sections of a few minutes each, every one with its own samples, over beds that run the whole track"""
+    total_frames = int(hours * 3600 * SAMPLE_RATE)
+    file_cache = {}
+    beds = {}
+    for name, (folder, gain_db) in MODES[mode]["beds"].items():
+        files = list_wav_files(folder, file_cache)
+        if files:
+            beds[name] = {"path": os.path.join(folder, rng.choice(files)), "gain_db": gain_db}
+
+    sections = []
+    start = 0
+    while start < total_frames:
+        frames = min(rng.randint(*SECTION_SEC_RANGE) * SAMPLE_RATE, total_frames - start)
+        layers = {}
+        for name, (folder, gain_db) in MODES[mode]["layers"].items():
+            files = list_wav_files(folder, file_cache)
+            if not files or rng.random() >= OPTIONAL_LAYERS.get(name, 1.0):
+                continue
+            layers[name] = {"path": os.path.join(folder, rng.choice(files)), "gain_db": gain_db + rng.uniform(-2, 1)}
+        sections.append({"start": start, "frames": frames, "layers": layers})
+        start += frames
+
+    pattern_id = [tuple(sorted(layer["path"] for layer in s["layers"].values())) for s in sections]
+    pattern_id.append(tuple(sorted(bed["path"] for bed in beds.values())))
+    return {"mode": mode, "hours": hours, "frames": total_frames, "sections": sections, "beds": beds, "pattern_id": pattern_id}
+
+
+def section_extent(plan, i, crossfade):
+    """Frames a section sounds over: its own span plus a crossfade tail into the next one"""
+    section = plan["sections"][i]
+    tail = crossfade if i + 1 < len(plan["sections"]) else 0
+    return section["start"], section["start"] + section["frames"] + tail
+
+
+def section_envelope(plan, i, positions, crossfade):
+    """Gain per frame (positions relative to the section start): fade in over the previous section's tail,
+    fade out over its own"""
+    fade_in, fade_out = equal_power(crossfade)
+    envelope = np.ones(len(positions), dtype=np.float32)
+    if i > 0:
+        rising = positions < crossfade
+        envelope[rising] = fade_in[positions[rising]]
+    if i + 1 < len(plan["sections"]):
+        frames = plan["sections"][i]["frames"]
+        falling = positions >= frames
+        envelope[falling] = fade_out[positions[falling] - frames]
+    return envelope
+
+
+def master_envelope(total_frames, frames):
+    """Track fade in/out for absolute frame numbers"""
+    fade_in = np.clip(frames / (FADE_IN_SEC * SAMPLE_RATE), 0, 1)
+    fade_out = np.clip((total_frames - frames) / (FADE_OUT_SEC * SAMPLE_RATE), 0, 1)
+    return (np.minimum(fade_in, fade_out) * db_to_gain(MASTER_GAIN_DB)).astype(np.float32)
+
+
+def render_block(plan, block_start, block_frames, crossfade=CROSSFADE_SEC * SAMPLE_RATE):
+    """Mix frames [block_start, block_start + block_frames) without touching anything outside them"""
+    out = np.zeros((block_frames, CHANNELS), dtype=np.float32)
+
+    for bed in plan["beds"].values():
+        add_looped(out, load_bed(bed["path"]), block_start, db_to_gain(bed["gain_db"]))
+
+    for i, section in enumerate(plan["sections"]):
+        start, end = section_extent(plan, i, crossfade)
+        lo, hi = max(start, block_start), min(end, block_start + block_frames)
+        if lo >= hi:
+            continue
+        mix = np.zeros((hi - lo, CHANNELS), dtype=np.float32)
+        for layer in section["layers"].values():
+            add_looped(mix, load_source(layer["path"]), lo - start, db_to_gain(layer["gain_db"]))
+        if lo - start < crossfade or hi - start > section["frames"]:
+            mix *= section_envelope(plan, i, np.arange(lo - start, hi - start), crossfade)[:, None]
+        out[lo - block_start:hi - block_start] += mix
+
+    if block_start < FADE_IN_SEC * SAMPLE_RATE or block_start + block_frames > plan["frames"] - FADE_OUT_SEC * SAMPLE_RATE:
+        out *= master_envelope(plan["frames"], np.arange(block_start, block_start + block_frames))[:, None]
+    else:
+        out *= db_to_gain(MASTER_GAIN_DB)
+    return out
+
+
+def to_pcm16(block):
+    return (np.clip(block, -1.0, 1.0) * 32767).astype("<i2")
+
+
+def generate_track(index, mode="meditation", hours=TRACK_HOURS, seed=None, journal=None):
+    seed = new_seed() if seed is None else seed
+    with stage("plan"):
+        plan = plan_track(mode, hours, random.Random(seed))
+    if not any(section["layers"] for section in plan["sections"]):
+        print(f"❌ No samples found for {mode} tracks")
+        return False
+
+    song_hash = pattern_hash(plan["pattern_id"])
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            return False
+
+    filename = os.path.join(OUTPUT_DIR, f"{mode}_{index:03d}_{hours:g}h_{song_hash:016x}.wav")
+    block_frames = BLOCK_SEC * SAMPLE_RATE
+    with WavStream(filename, SAMPLE_RATE, CHANNELS, 2, plan["frames"]) as out:
+        for block_start in range(0, plan["frames"], block_frames):
+            with stage("render"):
+                block = render_block(plan, block_start, min(block_frames, plan["frames"] - block_start))
+            with stage("write"):
+                out.write(to_pcm16(block))
+
+    if not record_shipped(song_hash, filename):
+        return False
+    if journal is not None:
+        journal.record(index, song_hash, filename, seed=seed)
+    print(f"✔️ Generated {hours:g}h {mode} track {index}")
+    return True
+
+
+def main(mode="meditation", hours=TRACK_HOURS, tracks=NUM_TRACKS):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    name = f"longform_{mode}"
+    journal = RunJournal(name)
+    count = journal.resume()
+    with MetricsExporter(name, total=max(tracks - count, 0)):
+        attempts = 0
+        song_index = None
+        while count < tracks and attempts < tracks * 5:
+            song_index = song_index or journal.claim()
+            with song_metrics(name, song_index) as record:
+                generated = generate_track(song_index, mode, hours, journal=journal)
+                record["outcome"] = "ok" if generated else "skipped"
+            if generated:
+                print(f"⚡ {hours * 3600 / record['total_sec']:.0f}x faster than real time")
+                count += 1
+                song_index = None
+            attempts += 1
+
+    write_batch_summary(name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render long ambient, meditation or piano-nature tracks")
+    parser.add_argument("--mode", choices=list(MODES), default="meditation")
+    parser.add_argument("--hours", type=float, default=TRACK_HOURS, help="track length, typically 1-10")
+    parser.add_argument("--tracks", type=int, default=NUM_TRACKS, help="how many tracks this run should reach")
+    args = parser.parse_args()
+    main(args.mode, args.hours, args.tracks)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import math
+import threading
+import instrumentation
+from instrumentation import METRICS_DIR, percentiles, cache_stats
+
+# Live view of a batch run: a Prometheus textfile (for node_exporter's textfile collector) and a
+# JSON status file, rewritten every EXPORT_INTERVAL_SEC while the run is going
+EXPORT_INTERVAL_SEC = 5.0
+OUTCOMES = ("done", "failed", "skipped_duplicate")
+SONG_OUTCOMES = {"ok": "done", "skipped": "skipped_duplicate", "error": "failed"}
+
+
+class MetricsExporter:
+    def __init__(self, name, total=None, workers=1, interval=EXPORT_INTERVAL_SEC, metrics_dir=METRICS_DIR):
+        self.name = name
+        self.total = total
+        self.workers = max(1, workers)
+        self.interval = interval
+        self.prom_path = os.path.join(metrics_dir, f"{name}.prom")
+        self.status_path = os.path.join(metrics_dir, f"{name}.status.json")
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.item_seconds = []
+        self.stage_seconds = {}
+        self.queues = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.prom_path), exist_ok=True)
+        instrumentation.add_song_listener(self.record_song)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        instrumentation.remove_song_listener(self.record_song)
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.export()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+    def record(self, outcome, seconds=None, stages=None):
+        """Count one finished item; outcome is one of OUTCOMES"""
+        with self._lock:
+            self.counts[outcome] += 1
+            if seconds is not None and outcome == "done":
+                self.item_seconds.append(seconds)
+            for stage, sec in (stages or {}).items():
+                self.stage_seconds.setdefault(stage, []).append(sec)
+
+    def record_song(self, record):
+        rendered = record["outcome"] == "ok"
+        self.record(SONG_OUTCOMES[record["outcome"]], record["total_sec"], record["stages"] if rendered else None)
+
+    def set_queue(self, name, depth):
+        """depth is a number or a zero-argument callable polled at export time"""
+        self.queues[name] = depth
+
+    def eta_seconds(self):
+        """Remaining items over observed wall-clock throughput, which already reflects the worker count;
+        before a full wave of workers has finished, fall back to mean item time per wave"""
+        finished = self.counts["done"] + self.counts["failed"]
+        if self.total is None:
+            return None
+        remaining = max(self.total - self.counts["done"], 0)
+        if remaining == 0:
+            return 0.0
+        elapsed = time.time() - self.started
+        if finished >= self.workers and elapsed > 0:
+            return remaining / (finished / elapsed)
+        if self.item_seconds:
+            mean = sum(self.item_seconds) / len(self.item_seconds)
+            return math.ceil(remaining / self.workers) * mean
+        return None
+
+    def status(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            counts = dict(self.counts)
+            stages = {
+                name: {**percentiles(values), "sum": round(sum(values), 6)}
+                for name, values in sorted(self.stage_seconds.items())
+            }
+        queues = {}
+        for name, depth in self.queues.items():
+            try:
+                queues[name] = depth() if callable(depth) else depth
+            except Exception:
+                queues[name] = None
+        caches = {}
+        for name, stats in cache_stats().items():
+            lookups = stats["hits"] + stats["misses"]
+            caches[name] = {**stats, "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else None}
+        eta = self.eta_seconds()
+        return {
+            "run": self.name,
+            "updated": time.time(),
+            "elapsed_sec": round(elapsed, 1),
+            "total": self.total,
+            "workers": self.workers,
+            "counts": counts,
+            "items_per_minute": round(counts["done"] * 60 / elapsed, 3) if elapsed else 0.0,
+            "eta_sec": round(eta, 1) if eta is not None else None,
+            "stages": stages,
+            "caches": caches,
+            "queues": queues,
+        }
+
+    def prometheus_lines(self, status):
+        run = f'run="{self.name}"'
+        lines = [
+            "# HELP songgen_items_total Items finished in this run, by outcome",
+            "# TYPE songgen_items_total counter",
+        ]
+        lines += [f'songgen_items_total{{{run},outcome="{o}"}} {n}' for o, n in status["counts"].items()]
+        lines += [
+            "# TYPE songgen_items_per_minute gauge",
+            f"songgen_items_per_minute{{{run}}} {status['items_per_minute']}",
+            "# TYPE songgen_workers gauge",
+            f"songgen_workers{{{run}}} {status['workers']}",
+        ]
+        if status["total"] is not None:
+            lines += ["# TYPE songgen_items_target gauge", f"songgen_items_target{{{run}}} {status['total']}"]
+        if status["eta_sec"] is not None:
+            lines += ["# TYPE songgen_eta_seconds gauge", f"songgen_eta_seconds{{{run}}} {status['eta_sec']}"]
+        lines += ["# HELP songgen_stage_seconds Per-stage latency of finished songs", "# TYPE songgen_stage_seconds summary"]
+        for stage, stats in status["stages"].items():
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                lines.append(f'songgen_stage_seconds{{{run},stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'songgen_stage_seconds_sum{{{run},stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'songgen_stage_seconds_count{{{run},stage="{stage}"}} {stats["count"]}')
+        lines += ["# TYPE songgen_cache_lookups_total counter"]
+        for cache, stats in status["caches"].items():
+            lines.append(f'songgen_cache_lookups_total{{{run},cache="{cache}",result="hit"}} {stats["hits"]}')
+            lines.append(f'songgen_cache_lookups_total{{{run},cache="{cache}",result="miss"}} {stats["misses"]}')
+        lines += ["# TYPE songgen_queue_depth gauge"]
+        lines += [f'songgen_queue_depth{{{run},queue="{q}"}} {d}' for q, d in status["queues"].items() if d is not None]
+        lines += ["# TYPE songgen_last_update_timestamp_seconds gauge", f"songgen_last_update_timestamp_seconds{{{run}}} {status['updated']:.0f}"]
+        return lines
+
+    def export(self):
+        """Atomically rewrite both files so a scraper never sees a half-written one"""
+        status = self.status()
+        for path, body in (
+            (self.status_path, json.dumps(status, indent=2)),
+            (self.prom_path, "\n".join(self.prometheus_lines(status)) + "\n"),
+        ):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        return status
@@ -1,5 +1,6 @@
 import os
 from pydub import AudioSegment, effects
+import sample_stats
 
 SAMPLES_DIR = "samples"
 
@@ -15,6 +16,9 @@ def normalize_all_wav_files():
                     normalized_audio.export(file_path, format="wav")
                 except Exception as e:
                     print(f"❌ Failed to normalize {file_path}: {e}")
+    # Measure the normalised files now, so generators never measure a layer while rendering
+    new = sample_stats.ingest([SAMPLES_DIR])
+    print(f"📊 Measured {new} samples")
 
 if __name__ == "__main__":
     normalize_all_wav_files()
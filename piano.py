@@ -1,21 +1,26 @@
 import os
 import random
-import librosa
-import soundfile as sf
 from pydub import AudioSegment, effects
-from hashlib import sha1
-import tempfile
+from song_plan import pattern_hash
+from uniqueness_store import get_pattern_store, record_shipped
+from plan_enumerator import CombinationSpace, EnumerationCursor
+from stretch_cache import to_segment
+from time_stretch import load_stretched, QUALITY_TIER
+from instrumentation import stage, song as song_metrics, write_batch_summary
+from metrics_exporter import MetricsExporter
+from wav_writer import write_segment
+from run_journal import RunJournal
 
 # Configuration
 NUM_SONGS = 100
 SECTION_DURATION_SEC = 60
 MIN_SONG_DURATION_SEC = 180  # 3 minutes
 MAX_SONG_DURATION_SEC = 240  # 4 minutes
+MIN_SECTIONS = MIN_SONG_DURATION_SEC // SECTION_DURATION_SEC
+MAX_SECTIONS = MAX_SONG_DURATION_SEC // SECTION_DURATION_SEC
+ENUMERATION_SEED = 0
 SAMPLES_DIR = "samples_piano_nature"
 OUTPUT_DIR = "output_piano_nature"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-used_patterns = set()
 
 def get_piano_samples():
     folder = os.path.join(SAMPLES_DIR, "piano")
@@ -27,12 +32,9 @@ def get_nature_loop():
     return AudioSegment.from_wav(os.path.join(folder, random.choice(files))) if files else None
 
 def load_piano_slowed(file_path, slowdown_factor=1.0):
-    y, sr = librosa.load(file_path, sr=None)
-    y_stretched = librosa.effects.time_stretch(y=y, rate=slowdown_factor)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp:
-        sf.write(temp.name, y_stretched, sr)
-        stretched = AudioSegment.from_wav(temp.name)
-    return effects.normalize(stretched)
+    with stage("stretch"):
+        samples, sr = load_stretched(file_path, slowdown_factor, QUALITY_TIER)
+        return effects.normalize(to_segment(samples, sr))
 
 def repeat_to_fill(audio: AudioSegment, target_ms: int) -> AudioSegment:
     result = AudioSegment.silent(duration=0)
@@ -40,59 +42,104 @@ def repeat_to_fill(audio: AudioSegment, target_ms: int) -> AudioSegment:
         result += audio
     return result[:target_ms]
 
-def generate_song(index):
-    piano_files = get_piano_samples()
-    if len(piano_files) < 3:
+def build_combination_space(piano_files, seed=ENUMERATION_SEED):
+    """One group per section count, with one piano-sample digit per section"""
+    return CombinationSpace(
+        [[len(piano_files)] * sections for sections in range(MIN_SECTIONS, MAX_SECTIONS + 1)], seed
+    )
+
+def generate_song(index, combination=None, journal=None):
+    piano_files = sorted(get_piano_samples())
+    if len(piano_files) < MIN_SECTIONS:
         print("⚠️ Not enough piano samples")
         return False
 
-    song = AudioSegment.silent(duration=0)
-    structure = []
-    nature = get_nature_loop()
+    if combination is not None:
+        _, digits = combination
+        structure = [piano_files[digit] for digit in digits]
+    else:
+        # Randomize section count between 3 and 4 minutes
+        total_sections = random.randint(MIN_SECTIONS, MAX_SECTIONS)
+        structure = [random.choice(piano_files) for _ in range(total_sections)]
 
-    # Randomize section count between 3 and 4 minutes
-    total_sections = random.randint(
-        MIN_SONG_DURATION_SEC // SECTION_DURATION_SEC,
-        MAX_SONG_DURATION_SEC // SECTION_DURATION_SEC
-    )
+    # Skip patterns already shipped before any audio is stretched; recorded once the file is written
+    song_hash = pattern_hash([tuple(structure)])
+    with stage("dedupe"):
+        if song_hash in get_pattern_store():
+            return False
 
+    song = AudioSegment.silent(duration=0)
+    with stage("decode"):
+        nature = get_nature_loop()
     slowdown = 1.0  # initial tempo
 
-    for _ in range(total_sections):
-        piano_path = random.choice(piano_files)
+    for piano_path in structure:
         section = load_piano_slowed(piano_path, slowdown)
-        section = repeat_to_fill(section, SECTION_DURATION_SEC * 1000)
-        song += section
-        structure.append(piano_path)
+        with stage("tile"):
+            section = repeat_to_fill(section, SECTION_DURATION_SEC * 1000)
+            song += section
         slowdown *= 0.97  # gradually slow down
 
     # Apply nature overlay
     if nature:
-        while len(nature) < len(song):
-            nature += nature
-        song = song.overlay(nature[:len(song)] - 6)
-
-    # Prevent duplicate patterns
-    song_hash = sha1(str(structure).encode()).hexdigest()
-    if song_hash in used_patterns:
+        with stage("overlay"):
+            while len(nature) < len(song):
+                nature += nature
+            song = song.overlay(nature[:len(song)] - 6)
+
+    with stage("master"):
+        song = song.fade_in(3000).fade_out(5000)
+        song = effects.normalize(song)
+
+    filename = os.path.join(OUTPUT_DIR, f"piano_nature_{index:03d}_{song_hash:016x}.wav")
+    write_segment(song, filename)
+    if not record_shipped(song_hash, filename):
         return False
-    used_patterns.add(song_hash)
-
-    song = song.fade_in(3000).fade_out(5000)
-    song = effects.normalize(song)
-
-    filename = os.path.join(OUTPUT_DIR, f"piano_nature_{index:03d}.wav")
-    song.export(filename, format="wav")
+    if journal is not None:
+        journal.record(index, song_hash, filename)
     print(f"✔️ Generated piano nature song {index}")
     return True
 
 def main():
-    count = 0
-    attempts = 0
-    while count < NUM_SONGS and attempts < NUM_SONGS * 5:
-        if generate_song(count + 1):
-            count += 1
-        attempts += 1
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # Checked before any combination is taken, so a small library does not use up the cursor
+    piano_files = sorted(get_piano_samples())
+    if len(piano_files) < MIN_SECTIONS:
+        print(f"⚠️ Not enough piano samples: {len(piano_files)} found, {MIN_SECTIONS} needed")
+        return
+    space = build_combination_space(piano_files)
+    cursor = EnumerationCursor("piano", space)
+    print(f"🎲 {cursor.remaining()} unique songs left in this sample library")
+
+    journal = RunJournal("piano")
+    count = journal.resume()
+    with MetricsExporter("piano", total=max(NUM_SONGS - count, 0)) as exporter:
+        exporter.set_queue("unique_combinations_left", cursor.remaining)
+        song_index = None
+        index = None
+        try:
+            while count < NUM_SONGS:
+                index = cursor.take()
+                if index is None:
+                    print("🏁 Every unique combination has been generated")
+                    break
+                song_index = song_index or journal.claim()
+                with song_metrics("piano", song_index) as record:
+                    generated = generate_song(song_index, space.combination(index), journal)
+                    record["outcome"] = "ok" if generated else "skipped"
+                # The combination is the whole song, so one that was already shipped is used up; one
+                # whose render failed goes back to the cursor below
+                if generated:
+                    count += 1
+                    song_index = None
+                else:
+                    print(f"⚠️ Skipped duplicate pattern for combination {index}")
+                index = None
+        finally:
+            if index is not None:
+                cursor.release(index)
+
+    write_batch_summary("piano")
 
 if __name__ == "__main__":
     main()
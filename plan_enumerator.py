@@ -0,0 +1,135 @@
+import os
+import json
+import fcntl
+from math import prod
+from bisect import bisect_right
+from hashlib import blake2b
+
+CURSOR_DIR = os.path.join("song_state", "cursors")
+FEISTEL_ROUNDS = 4
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+class FeistelPermutation:
+    """Seeded bijection on range(size): a balanced Feistel network with cycle walking"""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits & 1
+        self._half = bits // 2
+        self._mask = (1 << self._half) - 1
+        self._keys = [
+            int.from_bytes(blake2b(f"{seed}:{r}".encode(), digest_size=8).digest(), "big")
+            for r in range(FEISTEL_ROUNDS)
+        ]
+
+    def _round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B97F4A7C15) & MASK64
+        value ^= value >> 29
+        return ((value * 0xBF58476D1CE4E5B9) & MASK64) >> 7
+
+    def __call__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        value = index
+        # The network permutes the next power of four; walk until we land back inside range(size)
+        while True:
+            left, right = value >> self._half, value & self._mask
+            for key in self._keys:
+                left, right = right, left ^ (self._round(right, key) & self._mask)
+            value = (left << self._half) | right
+            if value < self.size:
+                return value
+
+
+class CombinationSpace:
+    """Maps song indexes onto unique sample combinations without materialising the product.
+
+    The space is a union of mixed-radix groups (e.g. one per key/BPM folder, with one radix per
+    layer), so index -> (group, digits) is a prefix-sum lookup plus divmods. A seeded permutation
+    shuffles the order while keeping every index distinct.
+    """
+
+    def __init__(self, groups, seed=0):
+        self.groups = [tuple(max(1, r) for r in radices) for radices in groups]
+        self.seed = seed
+        self._offsets = []
+        total = 0
+        for radices in self.groups:
+            self._offsets.append(total)
+            total += prod(radices)
+        self.size = total
+        self._permutation = FeistelPermutation(total, seed) if total else None
+
+    def __len__(self):
+        return self.size
+
+    def combination(self, index):
+        """Return (group, digits) for song index; distinct indexes always give distinct combinations"""
+        rank = self._permutation(index)
+        group = bisect_right(self._offsets, rank) - 1
+        rank -= self._offsets[group]
+        digits = []
+        for radix in reversed(self.groups[group]):
+            rank, digit = divmod(rank, radix)
+            digits.append(digit)
+        return group, tuple(reversed(digits))
+
+    def key(self):
+        """Identifies this exact catalog layout and seed, so cursors reset when samples change"""
+        return blake2b(json.dumps([self.seed, self.groups]).encode(), digest_size=8).hexdigest()
+
+
+class EnumerationCursor:
+    """Persistent, process-safe position in a CombinationSpace shared by every run of a generator"""
+
+    def __init__(self, name, space, cursor_dir=CURSOR_DIR):
+        self.space = space
+        self.path = os.path.join(cursor_dir, f"{name}.json")
+        os.makedirs(cursor_dir, exist_ok=True)
+
+    def _read(self, f):
+        """(next index, released indexes) for this space; both reset when the space changed"""
+        f.seek(0)
+        try:
+            state = json.load(f)
+        except ValueError:
+            return 0, []
+        if state.get("space") != self.space.key():
+            return 0, []
+        return state["next"], state.get("released", [])
+
+    def _write(self, f, index, released):
+        f.seek(0)
+        f.truncate()
+        json.dump({"space": self.space.key(), "next": index, "released": released}, f)
+        f.flush()
+
+    def take(self):
+        """Claim an unused index (a released one first), or None once the space is exhausted"""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            index, released = self._read(f)
+            if released:
+                taken = released.pop(0)
+                self._write(f, index, released)
+                return taken
+            if index >= self.space.size:
+                return None
+            self._write(f, index + 1, released)
+            return index
+
+    def release(self, index):
+        """Hand back a taken index no song landed in, so the next take() gets it again"""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            next_index, released = self._read(f)
+            if index < next_index and index not in released:
+                self._write(f, next_index, released + [index])
+
+    def remaining(self):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            index, released = self._read(f)
+            return self.space.size - index + len(released)
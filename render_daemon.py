@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import argparse
+import importlib
+import threading
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from run_journal import RunJournal
+from instrumentation import song as song_metrics, cache_stats
+from metrics_exporter import MetricsExporter
+
+# One long-lived process that keeps generator modules imported, decoded samples and folder listings in
+# memory and the dedupe stores open, and renders jobs (generator, count, seed, format) one at a time.
+# Jobs arrive as JSON files in the spool directory; the localhost HTTP API only writes into the spool,
+# so both ways in share one queue and a job survives a daemon restart until it is finished. Audio
+# modules are imported by the daemon itself, never by `submit` or `status`.
+DAEMON_DIR = os.path.join("song_state", "daemon")
+SPOOL_DIR = os.path.join(DAEMON_DIR, "spool")    # pending jobs, oldest first; removed once finished
+JOBS_DIR = os.path.join(DAEMON_DIR, "jobs")      # <job id>.json status for every job ever submitted
+OUTPUT_ROOT = "daemon_output"                    # each job writes to daemon_output/<job id>/
+HOST = "127.0.0.1"
+PORT = 8765
+POLL_SEC = 0.5
+MAX_WAIT_SEC = 600
+ATTEMPTS_PER_SONG = 5
+FORMATS = ("wav", "mp3")
+FINISHED = ("done", "failed")
+
+# generator -> (module, song function, whether the song function takes a seed)
+GENERATORS = {
+    "lofi": ("final_main", "generate_lofi_song", True),
+    "afro": ("afro", "generate_lofi_song", True),
+    "edm": ("edm", "generate_edm_song", False),
+    "edm-cohesion": ("edm_cohesion", "generate_edm_song", False),
+}
+
+
+def new_job_id():
+    # Sorts by submission time, which is the order the spool is worked through
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+
+
+def validate_job(job):
+    """Normalised copy of a job request; raises ValueError for anything the daemon cannot run"""
+    if not isinstance(job, dict):
+        raise ValueError("a job is a JSON object")
+    generator = job.get("generator")
+    if generator not in GENERATORS:
+        raise ValueError(f"generator must be one of {', '.join(GENERATORS)}")
+    count = job.get("count", 1)
+    if not isinstance(count, int) or count < 1:
+        raise ValueError("count must be a positive integer")
+    seed = job.get("seed")
+    if seed is not None and not isinstance(seed, int):
+        raise ValueError("seed must be an integer")
+    output_format = job.get("format", "wav")
+    if output_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(63)
+    return {"generator": generator, "count": count, "seed": seed, "format": output_format}
+
+
+def write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def read_status(job_id, jobs_dir=JOBS_DIR):
+    try:
+        with open(os.path.join(jobs_dir, f"{os.path.basename(job_id)}.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def submit(job, spool_dir=SPOOL_DIR, jobs_dir=JOBS_DIR):
+    """Queue a job; returns its status (with the job id)"""
+    job = validate_job(job)
+    job_id = new_job_id()
+    os.makedirs(spool_dir, exist_ok=True)
+    os.makedirs(jobs_dir, exist_ok=True)
+    status = {"id": job_id, **job, "state": "queued", "submitted": time.time(), "done": 0, "outputs": []}
+    write_json(os.path.join(jobs_dir, f"{job_id}.json"), status)
+    write_json(os.path.join(spool_dir, f"{job_id}.json"), job)
+    return status
+
+
+def library_signature(folders):
+    """Changes whenever a sample under folders is added, removed or rewritten"""
+    h = blake2b(digest_size=8)
+    for folder in sorted(folders):
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(".wav"):
+                    st = os.stat(os.path.join(root, name))
+                    h.update(f"{root}/{name}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    return h.hexdigest()
+
+
+def to_mp3(wav_path):
+    import convert_to_mp3
+    folder, filename = os.path.split(wav_path)
+    converted, _, _ = convert_to_mp3.convert_file(filename, folder, folder)
+    if not converted:
+        raise RuntimeError(f"ffmpeg could not convert {wav_path}")
+    os.remove(wav_path)
+    return os.path.splitext(wav_path)[0] + ".mp3"
+
+
+class Mp3Journal(RunJournal):
+    """Converts each finished song before it is recorded, so the journal (and `songgen verify`) names the
+    file the job delivers, and a song counted as done on resume is never left as an unconverted wav"""
+
+    def record(self, index, song_hash, output, **extra):
+        return super().record(index, song_hash, to_mp3(output), **extra)
+
+
+class RenderDaemon:
+    def __init__(self, spool_dir=SPOOL_DIR, jobs_dir=JOBS_DIR, output_root=OUTPUT_ROOT):
+        self.spool_dir = spool_dir
+        self.jobs_dir = jobs_dir
+        self.output_root = output_root
+        self.modules = {}
+        self.signature = None
+        self.current = None
+        self.started = time.time()
+        self.stop = threading.Event()
+        os.makedirs(spool_dir, exist_ok=True)
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def warm(self):
+        """Import every generator and open the dedupe stores before the first job arrives"""
+        from uniqueness_store import get_pattern_store
+        from fingerprint_index import get_fingerprint_index
+        started = time.perf_counter()
+        for name, (module_name, _, _) in GENERATORS.items():
+            self.modules[name] = importlib.import_module(module_name)
+        get_pattern_store()
+        get_fingerprint_index()
+        self.refresh_library()
+        print(f"🔥 Warmed up in {time.perf_counter() - started:.1f}s")
+
+    def refresh_library(self):
+        """Drop decoded samples when the sample library changed on disk since the last job"""
+        folders = {module.SAMPLES_DIR for module in self.modules.values()}
+        signature = library_signature(folders)
+        if self.signature is not None and signature != self.signature:
+            print("🔄 Sample library changed, dropping decoded samples")
+            for module in self.modules.values():
+                if hasattr(module, "load_and_adjust_sample"):
+                    module.load_and_adjust_sample.cache_clear()
+            from timeline import load_frames, load_trimmed
+            load_frames.cache_clear()
+            load_trimmed.cache_clear()
+        self.signature = signature
+
+    def pending(self):
+        return sorted(f[:-5] for f in os.listdir(self.spool_dir) if f.endswith(".json"))
+
+    def health(self):
+        return {
+            "uptime_sec": round(time.time() - self.started, 1),
+            "current_job": self.current,
+            "queued": len(self.pending()),
+            "caches": cache_stats(),
+        }
+
+    def serve(self):
+        """Work through the spool until stopped; an unfinished job (e.g. after a crash) resumes first"""
+        with MetricsExporter("daemon") as exporter:
+            exporter.set_queue("spooled_jobs", lambda: len(self.pending()))
+            while not self.stop.is_set():
+                jobs = self.pending()
+                if not jobs:
+                    self.stop.wait(POLL_SEC)
+                    continue
+                self.run_spooled(jobs[0])
+
+    def run_spooled(self, job_id):
+        spool_path = os.path.join(self.spool_dir, f"{job_id}.json")
+        status = read_status(job_id, self.jobs_dir) or {"id": job_id, "submitted": time.time(), "done": 0, "outputs": []}
+        try:
+            with open(spool_path) as f:
+                job = validate_job(json.load(f))
+        except ValueError as e:
+            # Dropped into the spool by hand and not a valid job
+            status.update(state="failed", error=str(e), finished=time.time())
+            self.write_status(status)
+            os.rename(spool_path, f"{spool_path}.rejected")
+            print(f"❌ Rejected job {job_id}: {e}")
+            return
+        # Pin the seed chosen for a hand-written job, so a restart resumes the same sequence of songs
+        write_json(spool_path, job)
+
+        status.update(job)
+        self.current = job_id
+        try:
+            self.run_job(job_id, job, status)
+        except Exception as e:
+            status.update(state="failed", error=f"{type(e).__name__}: {e}", finished=time.time())
+            self.write_status(status)
+            print(f"❌ Job {job_id} failed: {e}")
+        finally:
+            self.current = None
+        os.remove(spool_path)
+
+    def run_job(self, job_id, job, status):
+        generator = job["generator"]
+        module_name, function_name, seeded = GENERATORS[generator]
+        module = self.modules.get(generator) or importlib.import_module(module_name)
+        generate = getattr(module, function_name)
+        output_dir = os.path.join(self.output_root, job_id)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.refresh_library()
+        status.update(state="running", started=status.get("started") or time.time(), error=None)
+        self.write_status(status)
+        print(f"🎛️ Job {job_id}: {job['count']} {generator} songs as {job['format']}")
+
+        # A per-job journal lets a restarted daemon pick the job up at its first missing song
+        journal = (Mp3Journal if job["format"] == "mp3" else RunJournal)(f"daemon_{job_id}")
+        count = journal.resume()
+        # A song recorded just before the daemon died may not have reached the status file yet
+        listed = {output["index"] for output in status["outputs"]}
+        for index, entry in sorted(journal.completed().items()):
+            if index not in listed:
+                status["outputs"].append({"index": index, "path": entry["output"], "seed": entry.get("seed")})
+        # Song seeds come from the job seed, so the same job always tries the same plans in the same order
+        seeds = random.Random(job["seed"])
+        attempts = 0
+        song_index = None
+        saved_output_dir = module.OUTPUT_DIR
+        module.OUTPUT_DIR = output_dir
+        try:
+            while count < job["count"] and attempts < job["count"] * ATTEMPTS_PER_SONG:
+                song_index = song_index or journal.claim()
+                seed = seeds.getrandbits(63)
+                with song_metrics(f"daemon_{generator}", song_index) as record:
+                    if seeded:
+                        generated = generate(song_index, seed=seed, journal=journal)
+                    else:
+                        # The EDM generators draw from the module-level random
+                        random.seed(seed)
+                        generated = generate(song_index, journal)
+                    record["outcome"] = "ok" if generated else "skipped"
+                attempts += 1
+                if not generated:
+                    continue
+                output = journal.completed()[song_index]["output"]
+                count += 1
+                status["outputs"].append({"index": song_index, "path": output, "seed": seed, "sec": record["total_sec"]})
+                status["done"] = count
+                self.write_status(status)
+                print(f"✔️ Job {job_id}: song {count}/{job['count']} in {record['total_sec']:.1f}s")
+                song_index = None
+        finally:
+            module.OUTPUT_DIR = saved_output_dir
+
+        status["done"] = count
+        status["finished"] = time.time()
+        status["elapsed_sec"] = round(status["finished"] - status["started"], 3)
+        if count < job["count"]:
+            status.update(state="failed", error=f"only {count} of {job['count']} songs were unique")
+        else:
+            status["state"] = "done"
+        self.write_status(status)
+        print(f"🏁 Job {job_id} {status['state']} in {status['elapsed_sec']:.1f}s")
+
+    def write_status(self, status):
+        write_json(os.path.join(self.jobs_dir, f"{status['id']}.json"), status)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """POST /jobs queues a job (add ?wait=<sec> to block until it finishes), GET /jobs/<id> reports it,
+    GET /jobs lists recent jobs and GET /health shows the daemon's state and cache hit rates"""
+    daemon = None
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wait_for(self, job_id, wait_sec):
+        deadline = time.time() + min(wait_sec, MAX_WAIT_SEC)
+        status = read_status(job_id, self.daemon.jobs_dir)
+        while status is not None and status["state"] not in FINISHED and time.time() < deadline:
+            time.sleep(0.1)
+            status = read_status(job_id, self.daemon.jobs_dir)
+        return status
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/jobs":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            wait_sec = float(parse_qs(url.query).get("wait", [0])[0])
+            length = int(self.headers.get("Content-Length", 0))
+            status = submit(json.loads(self.rfile.read(length) or b"{}"), self.daemon.spool_dir, self.daemon.jobs_dir)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        if wait_sec > 0:
+            status = self.wait_for(status["id"], wait_sec)
+        self.send_json(200 if status["state"] in FINISHED else 202, status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            return self.send_json(200, self.daemon.health())
+        if url.path == "/jobs":
+            ids = sorted((f[:-5] for f in os.listdir(self.daemon.jobs_dir) if f.endswith(".json")), reverse=True)
+            return self.send_json(200, [read_status(job_id, self.daemon.jobs_dir) for job_id in ids[:100]])
+        if url.path.startswith("/jobs/"):
+            job_id = url.path[len("/jobs/"):]
+            wait_sec = float(parse_qs(url.query).get("wait", [0])[0])
+            status = self.wait_for(job_id, wait_sec) if wait_sec > 0 else read_status(job_id, self.daemon.jobs_dir)
+            return self.send_json(200, status) if status else self.send_json(404, {"error": "no such job"})
+        self.send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_daemon(host=HOST, port=PORT, spool_dir=SPOOL_DIR):
+    daemon = RenderDaemon(spool_dir)
+    daemon.warm()
+    JobHandler.daemon = daemon
+    server = ThreadingHTTPServer((host, port), JobHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🛰️ Listening on http://{host}:{server.server_port}/jobs and watching {spool_dir}/")
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        print("⏹️ Stopping; unfinished jobs stay in the spool")
+    finally:
+        server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render daemon with warm caches and a local job API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sub = commands.add_parser("serve", help="run the daemon")
+    sub.add_argument("--host", default=HOST)
+    sub.add_argument("--port", type=int, default=PORT)
+
+    sub = commands.add_parser("submit", help="queue a job through the spool (works while the daemon is down)")
+    sub.add_argument("generator", choices=list(GENERATORS))
+    sub.add_argument("--count", type=int, default=1)
+    sub.add_argument("--seed", type=int)
+    sub.add_argument("--format", choices=FORMATS, default="wav")
+
+    sub = commands.add_parser("status", help="show a job's status, or every job's")
+    sub.add_argument("job_id", nargs="?")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        run_daemon(args.host, args.port)
+    elif args.command == "submit":
+        status = submit({"generator": args.generator, "count": args.count, "seed": args.seed, "format": args.format})
+        print(f"📥 Queued job {status['id']}")
+    elif args.job_id:
+        status = read_status(args.job_id)
+        if status is None:
+            print(f"❌ No job {args.job_id}")
+            sys.exit(1)
+        print(json.dumps(status, indent=1))
+    else:
+        for name in sorted(f for f in os.listdir(JOBS_DIR) if f.endswith(".json")) if os.path.isdir(JOBS_DIR) else []:
+            status = read_status(name[:-5])
+            print(f"{status['id']}  {status['state']:8} {status['generator']:12} {status['done']}/{status['count']} {status['format']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import random
+import argparse
+import importlib
+from stretch_cache import sample_digest
+from instrumentation import song as song_metrics
+from wav_writer import write_segment
+
+# Re-render one song from the manifest its batch wrote to song_state/manifests/<generator>/
+REPLAY_DIR = os.path.join("song_state", "replays")
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_samples(manifest):
+    """Warn about samples that moved or changed since the song was made; returns how many differ"""
+    changed = 0
+    for path, digest in manifest["samples"].items():
+        if not os.path.exists(path):
+            print(f"⚠️ Missing sample: {path}")
+            changed += 1
+        elif sample_digest(path) != digest:
+            print(f"⚠️ Sample changed since the original render: {path}")
+            changed += 1
+    return changed
+
+
+def check_plan(module, manifest):
+    """Plan again from the recorded seed and combination; True when it matches the stored plan"""
+    catalog = None
+    combination = manifest["combination"]
+    if combination is not None:
+        _, catalog = module.build_combination_space()
+        combination = (combination[0], tuple(combination[1]))
+    plan = module.plan_song(combination, catalog, random.Random(manifest["seed"]))
+    return json.loads(json.dumps(plan)) == manifest["plan"]
+
+
+def replay(manifest, output=None, profile=False, limiter=True):
+    module = importlib.import_module(manifest["module"])
+    output = output or os.path.join(REPLAY_DIR, os.path.basename(manifest["output"]))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    with song_metrics(f"{manifest['generator']}_replay", manifest["index"], profile=profile) as record:
+        record["seed"] = manifest["seed"]
+        song = module.render_song(manifest["plan"])
+        if limiter:
+            module.export_song(song, output)
+        else:
+            write_segment(song, output)
+    print(f"🔁 Replayed {manifest['generator']} song {manifest['index']} in {record['total_sec']:.2f}s -> {output}")
+    slowest = sorted(record["stages"].items(), key=lambda item: -item[1])
+    for name, sec in slowest[:5]:
+        print(f"   {name:12} {sec * 1000:9.1f}ms")
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-render one song exactly from its manifest")
+    parser.add_argument("manifest", help="song_state/manifests/<generator>/song_<index>_<hash>.json")
+    parser.add_argument("--output", help=f"where to write the WAV (default: {REPLAY_DIR}/<original name>)")
+    parser.add_argument("--profile", action="store_true", help="run the sampling profiler during the replay")
+    parser.add_argument("--no-limiter", action="store_true", help="write the mix before the ffmpeg limiter")
+    parser.add_argument("--check-plan", action="store_true", help="also re-plan from the seed and compare")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest)
+    if check_samples(manifest):
+        print("⚠️ The replay will not match the original exactly")
+    if args.check_plan:
+        module = importlib.import_module(manifest["module"])
+        if not check_plan(module, manifest):
+            print("❌ Planning from the recorded seed gives a different plan")
+            sys.exit(1)
+        print("✅ Seed reproduces the recorded plan")
+    replay(manifest, args.output, args.profile, not args.no_limiter)
+
+
+if __name__ == "__main__":
+    main()
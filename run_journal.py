@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+from hashlib import blake2b
+from uniqueness_store import get_pattern_store
+
+# Append-only record of a generator's batch: which song indices are claimed, which are finished, and
+# the pattern hash and checksum of every finished output. A restarted run resumes at the first missing
+# index instead of starting over at song 1.
+JOURNAL_DIR = os.path.join("song_state", "journals")
+CHECKSUM_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def file_checksum(path):
+    h = blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RunJournal:
+    def __init__(self, name, journal_dir=JOURNAL_DIR):
+        self.name = name
+        self.path = os.path.join(journal_dir, f"{name}.jsonl")
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def _entries(self, f):
+        f.seek(0)
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # a line cut short by a crash
+        return entries
+
+    def _append(self, f, entry):
+        f.seek(0, os.SEEK_END)
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def completed(self):
+        """index -> finished entry"""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return {e["index"]: e for e in self._entries(f) if e["event"] == "done"}
+
+    def claim(self):
+        """Reserve the lowest index that is neither finished nor claimed by a live process"""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            taken = set()
+            for e in self._entries(f):
+                if e["event"] == "done" or (e["event"] == "claim" and pid_alive(e["pid"])):
+                    taken.add(e["index"])
+            index = 1
+            while index in taken:
+                index += 1
+            self._append(f, {"event": "claim", "index": index, "pid": os.getpid(), "time": time.time()})
+            return index
+
+    def record(self, index, song_hash, output, **extra):
+        """Mark index finished; output must already be in its final place"""
+        entry = {
+            "event": "done",
+            "index": index,
+            "song_hash": f"{song_hash:016x}",
+            "output": output,
+            "size": os.path.getsize(output),
+            "checksum": file_checksum(output),
+            "time": time.time(),
+            **extra,
+        }
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._append(f, entry)
+        return entry
+
+    def restore_patterns(self):
+        """Put every finished song's pattern back into the uniqueness store (e.g. after song_state was lost)"""
+        store = get_pattern_store()
+        restored = 0
+        for entry in self.completed().values():
+            song_hash = int(entry["song_hash"], 16)
+            if song_hash not in store:
+                store.add(song_hash)
+                restored += 1
+        return restored
+
+    def resume(self):
+        """Number of songs already finished; prints where the run picks up"""
+        done = self.completed()
+        restored = self.restore_patterns()
+        if done:
+            missing = next(i for i in range(1, len(done) + 2) if i not in done)
+            print(f"⏯️ Resuming {self.name}: {len(done)} songs already done, next index {missing}"
+                  + (f", {restored} patterns restored" if restored else ""))
+        return len(done)
+
+    def verify(self):
+        """Re-check every finished output against the journal without rendering; returns the problems"""
+        problems = []
+        for index, entry in sorted(self.completed().items()):
+            output = entry["output"]
+            if not os.path.exists(output):
+                problems.append((index, output, "missing"))
+            elif os.path.getsize(output) != entry["size"]:
+                problems.append((index, output, f"size {os.path.getsize(output)} != {entry['size']}"))
+            elif file_checksum(output) != entry["checksum"]:
+                problems.append((index, output, "checksum mismatch"))
+        return problems
+
+    def forget(self, indices):
+        """Drop finished entries (e.g. ones that failed verification) so the next run renders them again"""
+        indices = set(indices)
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            kept = [e for e in self._entries(f) if not (e["event"] == "done" and e["index"] in indices)]
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as out:
+                out.writelines(json.dumps(e) + "\n" for e in kept)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check a generator's finished songs against its run journal")
+    parser.add_argument("run", help="journal name: lofi, afro, piano, edm, edm_cohesion")
+    parser.add_argument("--forget-bad", action="store_true",
+                        help="drop missing or corrupt songs from the journal so the next run makes them again")
+    args = parser.parse_args(argv)
+
+    journal = RunJournal(args.run)
+    done = journal.completed()
+    problems = journal.verify()
+    for index, output, problem in problems:
+        print(f"❌ Song {index}: {output} ({problem})")
+    if not problems:
+        print(f"✅ All {len(done)} {args.run} songs match the journal")
+        return
+    print(f"⚠️ {len(problems)} of {len(done)} songs failed verification")
+    if args.forget_bad:
+        journal.forget(index for index, _, _ in problems)
+        print("🧹 Removed them from the journal (the files are left in place); the next run renders those indices again")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from stretch_cache import sample_digest
+
+# Library catalog: for every sample, the key and BPM its folder (or filename) claims next to the key,
+# tempo, onset times and bar count detected in the audio. Built by an incremental, parallel pass at
+# ingest, so planning reads metadata instead of analysing audio, and a file whose label disagrees
+# with its content is flagged and left out of new plans.
+CATALOG_PATH = os.path.join("song_state", "sample_catalog.json")
+INGEST_DIRS = ["samples", "edm_samples"]
+ANALYSIS_VERSION = 1       # bump to re-analyse every file after changing the analysis
+ANALYSIS_SAMPLE_RATE = 22050
+BPM_RANGE = (60, 200)
+BPM_TOLERANCE = 0.04       # detected and labelled tempo may differ this much (half and double time match too)
+KEY_CONFIDENCE = 0.6       # key flags need at least this profile correlation
+BAR_TOLERANCE = 0.03       # a loop within this fraction of a bar of a whole bar count fits its label
+UNKEYED_LAYERS = {"drums", "fx", "risers", "builds", "percussion"}
+ONE_SHOT_LAYERS = {"fx", "risers", "builds"}  # not loops, so their length says nothing about tempo
+MAX_WORKERS = os.cpu_count() or 4
+
+NOTE_NAMES = ["c", "c#", "d", "eb", "e", "f", "f#", "g", "ab", "a", "bb", "b"]
+PITCH_CLASSES = {name: pc for pc, name in enumerate(NOTE_NAMES)}
+PITCH_CLASSES.update({"db": 1, "d#": 3, "gb": 6, "g#": 8, "a#": 10, "cb": 11, "e#": 5, "fb": 4, "b#": 0})
+# Krumhansl-Kessler key profiles, tonic first
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+_catalog = None
+_catalog_mtime = None
+
+
+def parse_key(name):
+    """'am', 'F#', 'bbm' -> (pitch class, is_minor), or None when name is not a key"""
+    match = re.fullmatch(r"([a-g][#b]?)(m|min|minor|maj|major)?", name.strip().lower())
+    if not match or match.group(1) not in PITCH_CLASSES:
+        return None
+    return PITCH_CLASSES[match.group(1)], match.group(2) in ("m", "min", "minor")
+
+
+def key_name(pitch_class, minor):
+    return NOTE_NAMES[pitch_class] + ("m" if minor else "")
+
+
+def path_labels(path):
+    """BPM and key the library layout claims for a file: <bpm>_<key>/ or <bpm>_<genre>/ folders,
+    drums/<bpm>/ folders, or an explicit '<n>bpm' in the filename"""
+    bpm, key = None, None
+    for part in os.path.normpath(os.path.dirname(path)).split(os.sep):
+        match = re.fullmatch(r"(\d{2,3})(?:_(.+))?", part)
+        if match:
+            bpm = int(match.group(1))
+            if match.group(2) and parse_key(match.group(2)):
+                key = match.group(2).lower()
+    match = re.search(r"(\d{2,3})\s*bpm", os.path.basename(path), re.IGNORECASE)
+    if match:
+        bpm = int(match.group(1))
+    return bpm, key
+
+
+def estimate_key(chroma):
+    """Best-correlating major or minor profile for a 12-bin chroma vector: (key name, correlation)"""
+    best = (None, -1.0)
+    for minor, profile in ((False, MAJOR_PROFILE), (True, MINOR_PROFILE)):
+        for tonic in range(12):
+            correlation = float(np.corrcoef(chroma, np.roll(profile, tonic))[0, 1])
+            if correlation > best[1]:
+                best = (key_name(tonic, minor), correlation)
+    return best
+
+
+def loop_bpm(tempo, duration_sec):
+    """A loop holds a whole number of bars, so the tempo that fits its length exactly wins over the beat
+    tracker's estimate when the two agree (allowing for half and double time)"""
+    best = None
+    for bars in (1, 2, 4, 8, 16, 32):
+        candidate = 240 * bars / duration_sec
+        if not BPM_RANGE[0] <= candidate <= BPM_RANGE[1]:
+            continue
+        error = min(abs(candidate / (tempo * m) - 1) for m in (0.5, 1, 2))
+        # Ties (1 bar at 60 vs 2 bars at 120) go to the candidate nearest the tracked tempo itself
+        rank = (round(error, 3), abs(candidate - tempo))
+        if error <= BPM_TOLERANCE and (best is None or rank < best[0]):
+            best = (rank, candidate)
+    return best[1] if best else tempo
+
+
+def analyze_file(path):
+    """Detected key, tempo, onsets and bar count for one file (runs in a worker process)"""
+    import librosa  # pulls in numba/llvmlite, so only in the processes that analyse audio
+    y, sr = librosa.load(path, sr=ANALYSIS_SAMPLE_RATE, mono=True)
+    duration_sec = len(y) / sr
+    if duration_sec == 0 or not np.any(y):
+        return {"duration_sec": round(duration_sec, 3), "bpm": None, "key": None, "key_confidence": 0.0, "onsets": [], "bars": None}
+
+    onset_envelope = librosa.onset.onset_strength(y=y, sr=sr)
+    tempo, _ = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr)
+    tempo = float(np.atleast_1d(tempo)[0])
+    onsets = librosa.onset.onset_detect(onset_envelope=onset_envelope, sr=sr, units="time")
+    key, confidence = estimate_key(librosa.feature.chroma_stft(y=y, sr=sr).mean(axis=1))
+    bpm = loop_bpm(tempo, duration_sec) if tempo > 0 else None
+    return {
+        "duration_sec": round(duration_sec, 3),
+        "bpm": round(bpm, 2) if bpm else None,
+        "key": key,
+        "key_confidence": round(confidence, 3),
+        "onsets": [round(float(t), 3) for t in onsets],
+        "bars": round(duration_sec * bpm / 240, 2) if bpm else None,
+    }
+
+
+def fits_bars(duration_sec, bpm):
+    """True when duration_sec is a whole number of 4/4 bars at bpm"""
+    bars = duration_sec * bpm / 240
+    return round(bars) >= 1 and abs(bars - round(bars)) <= BAR_TOLERANCE
+
+
+def find_flags(path, entry):
+    """Reasons the file's label disagrees with its audio; empty when it looks right"""
+    flags = []
+    layer = os.path.basename(os.path.dirname(path)).lower()
+    labelled_bpm, detected_bpm = entry["labelled_bpm"], entry["bpm"]
+    if labelled_bpm and detected_bpm and layer not in ONE_SHOT_LAYERS:
+        error = min(abs(detected_bpm / (labelled_bpm * m) - 1) for m in (0.5, 1, 2))
+        # The beat tracker alone misjudges sparse loops, so a loop that is a whole number of bars at its
+        # labelled tempo is taken at its word, unless the detected tempo explains its length too: a
+        # 4-bar loop at 120 BPM is also 3 bars at 90, and then the detection is the better evidence
+        unreliable = fits_bars(entry["duration_sec"], labelled_bpm) and not fits_bars(entry["duration_sec"], detected_bpm)
+        if error > BPM_TOLERANCE and not unreliable:
+            flags.append(f"labelled {labelled_bpm} BPM, sounds like {detected_bpm:g}")
+
+    labelled_key = parse_key(entry["labelled_key"]) if entry["labelled_key"] else None
+    detected_key = parse_key(entry["key"]) if entry["key"] else None
+    if labelled_key and detected_key and layer not in UNKEYED_LAYERS and entry["key_confidence"] >= KEY_CONFIDENCE:
+        # A relative major/minor shares every note, so chroma cannot tell them apart
+        relative = ((labelled_key[0] + (3 if labelled_key[1] else 9)) % 12, not labelled_key[1])
+        if detected_key not in (labelled_key, relative):
+            flags.append(f"labelled {entry['labelled_key']}, sounds like {entry['key']}")
+    return flags
+
+
+def load_catalog():
+    """path -> entry, re-read whenever an ingest rewrote the file"""
+    global _catalog, _catalog_mtime
+    try:
+        mtime = os.stat(CATALOG_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != _catalog_mtime:
+        with open(CATALOG_PATH) as f:
+            _catalog = json.load(f)
+        _catalog_mtime = mtime
+    return _catalog
+
+
+def save_catalog(catalog):
+    os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+    tmp_path = f"{CATALOG_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(catalog, f, separators=(",", ":"))
+    os.replace(tmp_path, CATALOG_PATH)
+
+
+def catalog_entry(path):
+    return load_catalog().get(os.path.normpath(path))
+
+
+def catalog_bpm(path):
+    """Detected tempo of a sample, or None when it was never analysed"""
+    entry = catalog_entry(path)
+    return entry["bpm"] if entry else None
+
+
+def drop_mislabelled(folder, files):
+    """files (names in folder) without the ones the catalog flagged; unchanged when there is no catalog"""
+    catalog = load_catalog()
+    if not catalog:
+        return files
+    return [f for f in files if not catalog.get(os.path.normpath(os.path.join(folder, f)), {}).get("flags")]
+
+
+def ingest(folders=INGEST_DIRS, workers=MAX_WORKERS):
+    """Analyse every new or changed .wav under folders; returns the updated catalog"""
+    catalog = dict(load_catalog())
+    seen = set()
+    pending = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.lower().endswith(".wav"):
+                    continue
+                path = os.path.normpath(os.path.join(root, name))
+                seen.add(path)
+                st = os.stat(path)
+                entry = catalog.get(path)
+                if entry and entry["version"] == ANALYSIS_VERSION and (entry["mtime_ns"], entry["size"]) == (st.st_mtime_ns, st.st_size):
+                    continue
+                digest = sample_digest(path)
+                if entry and entry["version"] == ANALYSIS_VERSION and entry["digest"] == digest:
+                    # Touched but the same audio: keep the analysis
+                    entry.update(mtime_ns=st.st_mtime_ns, size=st.st_size)
+                    continue
+                catalog[path] = {"digest": digest, "version": ANALYSIS_VERSION, "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+                pending.append(path)
+
+    scanned = [os.path.normpath(folder) + os.sep for folder in folders]
+    for path in [p for p in catalog if p not in seen and any(p.startswith(prefix) for prefix in scanned)]:
+        del catalog[path]
+
+    print(f"🔎 {len(pending)} samples to analyse, {len(seen) - len(pending)} unchanged, using {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_file, path): path for path in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                catalog[path].update(future.result())
+                print(f"✔️ [{done}/{len(pending)}] {path}: {catalog[path]['bpm']} BPM, {catalog[path]['key']}")
+            except Exception as e:
+                del catalog[path]
+                print(f"❌ [{done}/{len(pending)}] {path}: {e}")
+
+    # Labels and flags are cheap, so they are redone for every file without analysing audio again
+    # (a change to the flagging rules applies on the next ingest)
+    for path, entry in catalog.items():
+        entry["labelled_bpm"], entry["labelled_key"] = path_labels(path)
+        entry["flags"] = find_flags(path, entry)
+    save_catalog(catalog)
+    return catalog
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Detect key, BPM, onsets and bars for every sample and flag mislabelled files")
+    parser.add_argument("folders", nargs="*", default=INGEST_DIRS)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    args = parser.parse_args(argv)
+
+    catalog = ingest(args.folders, args.workers)
+    flagged = {path: entry["flags"] for path, entry in sorted(catalog.items()) if entry.get("flags")}
+    for path, flags in flagged.items():
+        print(f"⚠️ {path}: {'; '.join(flags)}")
+    print(f"📚 {len(catalog)} samples in {CATALOG_PATH}, {len(flagged)} flagged as mislabelled (left out of new plans)")
+
+
+if __name__ == "__main__":
+    main()
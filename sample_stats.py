@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import math
+import numpy as np
+from stretch_cache import sample_digest, read_wav_float
+from instrumentation import stage, count_cache
+
+# Loudness of every sample, measured once at ingest and keyed by content digest, so gain staging is
+# arithmetic on stored numbers instead of a pass over every tiled layer. A loop tiled to any length has
+# the RMS of one period, so the sample's own RMS stands in for the section's.
+STATS_PATH = os.path.join("song_state", "sample_stats.json")
+INGEST_DIRS = ["samples", "edm_samples", "samples_piano_nature", "meditation_samples", "meditation_tracks"]
+
+_stats = None
+
+
+def measure(samples):
+    """RMS and peak as fractions of full scale, plus both in dBFS (None for silence)"""
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if samples.size else 0.0
+    peak = float(np.abs(samples).max()) if samples.size else 0.0
+    return {
+        "rms": rms,
+        "peak": peak,
+        "loudness_dbfs": round(20 * math.log10(rms), 2) if rms > 0 else None,
+        "peak_dbfs": round(20 * math.log10(peak), 2) if peak > 0 else None,
+    }
+
+
+def segment_rms(segment):
+    """RMS of a pydub segment as a fraction of full scale, comparable with the stored stats"""
+    return segment.rms / segment.max_possible_amplitude if len(segment) > 0 else 0.0
+
+
+def _load():
+    global _stats
+    if _stats is None:
+        try:
+            with open(STATS_PATH) as f:
+                _stats = json.load(f)
+        except (OSError, ValueError):
+            _stats = {}
+    return _stats
+
+
+def save():
+    os.makedirs(os.path.dirname(STATS_PATH), exist_ok=True)
+    tmp_path = f"{STATS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_load(), f, separators=(",", ":"))
+    os.replace(tmp_path, STATS_PATH)
+
+
+def get_sample_stats(path, persist=True):
+    """Stored stats for a sample, measured (and saved) the first time its content is seen"""
+    stats = _load()
+    digest = sample_digest(path)
+    count_cache("sample_stats", digest in stats)
+    if digest not in stats:
+        with stage("measure"):
+            samples, sample_rate = read_wav_float(path)
+            stats[digest] = {
+                "frames": len(samples),
+                "sample_rate": sample_rate,
+                "channels": 1 if samples.ndim == 1 else samples.shape[1],
+                **measure(samples),
+            }
+        if persist:
+            save()
+    return stats[digest]
+
+
+def ingest(folders=INGEST_DIRS):
+    """Measure every sample under folders that is not in the store yet; returns how many were new"""
+    stats = _load()
+    known = len(stats)
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".wav"):
+                    path = os.path.join(root, name)
+                    try:
+                        get_sample_stats(path, persist=False)
+                    except ValueError as e:
+                        print(f"❌ Could not read {path}: {e}")
+    save()
+    return len(stats) - known
+
+
+if __name__ == "__main__":
+    new = ingest(sys.argv[1:] or INGEST_DIRS)
+    print(f"📊 Measured {new} new samples, {len(_load())} in {STATS_PATH}")
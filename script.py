@@ -1,8 +1,10 @@
 import os
-import itertools
 from pydub import AudioSegment
-import librosa
-import soundfile as sf
+import numpy as np
+from plan_enumerator import CombinationSpace
+from stretch_cache import get_detected_bpm, to_segment
+from time_stretch import load_stretched, QUALITY_TIER
+from sample_analysis import catalog_bpm
 
 # Config
 SECTION_DURATION_SEC = 24
@@ -12,22 +14,28 @@ SAMPLES_DIR = "samples"
 OUTPUT_DIR = "output_songs"
 GLOBAL_DRUMS_DIR = os.path.join(SAMPLES_DIR, "drums")
 KEY_BPM_FOLDER = "80_A_minor"  # choose 1 key folder for now
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 MELODY_DIR = os.path.join(SAMPLES_DIR, KEY_BPM_FOLDER, "melody")
 CHORDS_DIR = os.path.join(SAMPLES_DIR, KEY_BPM_FOLDER, "chords")
 BASS_DIR = os.path.join(SAMPLES_DIR, KEY_BPM_FOLDER, "bass")
 BPM = int(KEY_BPM_FOLDER.split("_")[0])
+ENUMERATION_SEED = 0
 
 
-def load_and_adjust_sample(path, target_bpm):
+def detect_bpm(path):
+    import librosa  # pulls in numba/llvmlite, so only when a BPM actually has to be detected
     y, sr = librosa.load(path)
     bpm, _ = librosa.beat.beat_track(y=y, sr=sr)
+    return np.atleast_1d(bpm)[0]
+
+
+def load_and_adjust_sample(path, target_bpm):
+    # Tempo comes from the ingest catalog (sample_analysis.py); detection and the stretch itself are
+    # otherwise computed once per sample, not once per use
+    bpm = catalog_bpm(path) or get_detected_bpm(path, detect_bpm)
     stretch = bpm / target_bpm if bpm > 0 else 1.0
-    y_stretched = librosa.effects.time_stretch(y, stretch)
-    temp_path = "temp.wav"
-    sf.write(temp_path, y_stretched, sr)
-    return AudioSegment.from_wav(temp_path)
+    samples, sr = load_stretched(path, stretch, QUALITY_TIER)
+    return to_segment(samples, sr)
 
 
 def create_layered_section(drum_file, melody_file, chord_file, bass_file):
@@ -49,15 +57,19 @@ def create_layered_section(drum_file, melody_file, chord_file, bass_file):
 
 
 def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     drums = [os.path.join(GLOBAL_DRUMS_DIR, f) for f in os.listdir(GLOBAL_DRUMS_DIR) if f.endswith(".wav")]
     melodies = [os.path.join(MELODY_DIR, f) for f in os.listdir(MELODY_DIR) if f.endswith(".wav")]
     chords = [os.path.join(CHORDS_DIR, f) for f in os.listdir(CHORDS_DIR) if f.endswith(".wav")]
     basses = [os.path.join(BASS_DIR, f) for f in os.listdir(BASS_DIR) if f.endswith(".wav")]
 
-    combinations = list(itertools.product(drums, melodies, chords, basses))
-    print(f"Generating {len(combinations)} unique songs...")
+    catalog = [sorted(drums), sorted(melodies), sorted(chords), sorted(basses)]
+    space = CombinationSpace([[len(files) for files in catalog]] if all(catalog) else [], ENUMERATION_SEED)
+    print(f"Generating {space.size} unique songs...")
 
-    for i, (drum, melody, chord, bass) in enumerate(combinations):
+    for i in range(space.size):
+        _, digits = space.combination(i)
+        drum, melody, chord, bass = (files[digit] for files, digit in zip(catalog, digits))
         song = AudioSegment.silent(duration=0)
         while song.duration_seconds < MIN_SONG_LENGTH_SEC:
             section = create_layered_section(drum, melody, chord, bass)
@@ -0,0 +1,73 @@
+import os
+import json
+import random
+from hashlib import blake2b
+from instrumentation import stage, count_cache
+from stretch_cache import sample_digest
+
+# One manifest per rendered song: enough to re-render it exactly with replay.py
+MANIFEST_DIR = os.path.join("song_state", "manifests")
+
+_listings = {}
+
+
+def pattern_hash(pattern_id):
+    """Compact 64-bit integer hash of a pattern_id (list of per-section tuples of sample ids)"""
+    h = blake2b(digest_size=8)
+    for section in pattern_id:
+        for item in section:
+            h.update(str(item).encode())
+            h.update(b"\x1f")
+        h.update(b"\x1e")
+    return int.from_bytes(h.digest(), "big")
+
+
+def list_wav_files(folder, file_cache=None):
+    """List .wav files in a folder, memoised in file_cache for the lifetime of a plan and per process
+    until the folder's mtime changes (adding, removing or renaming a file updates it)"""
+    if file_cache is not None:
+        count_cache("file_list", folder in file_cache)
+        if folder in file_cache:
+            return file_cache[folder]
+    with stage("list_dir"):
+        if not os.path.isdir(folder):
+            files = []
+        else:
+            mtime = os.stat(folder).st_mtime_ns
+            cached = _listings.get(folder)
+            count_cache("folder_listing", cached is not None and cached[0] == mtime)
+            if cached is not None and cached[0] == mtime:
+                files = cached[1]
+            else:
+                # Sorted, so a seeded choice picks the same file on every filesystem
+                files = sorted(f for f in os.listdir(folder) if f.endswith(".wav"))
+                _listings[folder] = (mtime, files)
+    if file_cache is not None:
+        file_cache[folder] = files
+    return files
+
+
+def new_seed():
+    """Fresh 63-bit seed for one song's random.Random"""
+    return random.SystemRandom().getrandbits(63)
+
+
+def write_manifest(generator, module, index, seed, song_hash, plan, samples, output, combination=None):
+    """Record what a song was built from (seed, plan, sample digests) next to the metrics"""
+    folder = os.path.join(MANIFEST_DIR, generator)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"song_{index:03d}_{song_hash:016x}.json")
+    manifest = {
+        "generator": generator,
+        "module": module,
+        "index": index,
+        "seed": seed,
+        "song_hash": f"{song_hash:016x}",
+        "combination": list(combination) if combination is not None else None,
+        "plan": plan,
+        "samples": {path: sample_digest(path) for path in sorted(set(samples))},
+        "output": output,
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    return path
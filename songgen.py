@@ -0,0 +1,176 @@
+import sys
+import argparse
+import importlib
+
+# One entry point for every tool. Only argparse is imported up front; each subcommand imports its own
+# module when it runs, so `songgen.py wah` never loads pydub and `songgen.py --help` loads nothing.
+
+# subcommand -> (module, song count constant, help)
+GENERATORS = {
+    "lofi": ("final_main", "NUM_SONGS", "lofi songs from samples/"),
+    "edm": ("edm", "SONG_COUNT", "EDM songs from edm_samples/"),
+    "edm-cohesion": ("edm_cohesion", "SONG_COUNT", "EDM songs with a consistent sample set per song"),
+    "afro": ("afro", "NUM_SONGS", "afro songs from samples/"),
+    "piano": ("piano", "NUM_SONGS", "piano and nature songs from samples_piano_nature/"),
+}
+
+
+def run_generator(args):
+    module_name, count_attr, _ = GENERATORS[args.command]
+    module = importlib.import_module(module_name)
+    if args.songs is not None:
+        setattr(module, count_attr, args.songs)
+    module.main()
+
+
+def run_meditation(args):
+    import meditation
+    meditation.main(args.mode, args.hours, args.tracks)
+
+
+def run_stream(args):
+    import lofi_stream
+    argv = [args.target, "--budget-ms", str(args.budget_ms)]
+    argv += ["--wav"] if args.wav else []
+    argv += ["--realtime"] if args.realtime else []
+    argv += ["--seed", str(args.seed)] if args.seed is not None else []
+    argv += ["--minutes", str(args.minutes)] if args.minutes else []
+    lofi_stream.main(argv)
+
+
+def run_daemon(args):
+    import render_daemon
+    render_daemon.run_daemon(args.host, args.port)
+
+
+def run_ingest(args):
+    import sample_stats
+    import sample_analysis
+    new = sample_stats.ingest(args.folders or sample_stats.INGEST_DIRS)
+    print(f"📊 Measured loudness of {new} new samples")
+    sample_analysis.main((args.folders or sample_analysis.INGEST_DIRS) + ["--workers", str(args.workers or sample_analysis.MAX_WORKERS)])
+
+
+def run_convert(args):
+    import convert_to_mp3
+    if args.bitrate:
+        convert_to_mp3.BITRATE = args.bitrate
+    convert_to_mp3.main(
+        args.input_dir or convert_to_mp3.INPUT_FOLDER,
+        args.output_dir or convert_to_mp3.OUTPUT_FOLDER,
+        args.workers or convert_to_mp3.MAX_WORKERS,
+    )
+
+
+def run_master(args):
+    import mastering
+    mastering.main(
+        args.input_dir or mastering.INPUT_DIR,
+        args.output_dir or mastering.OUTPUT_DIR,
+        args.reference or mastering.REFERENCE_TRACK,
+    )
+
+
+def run_dedupe(args):
+    import find_duplicate_songs
+    find_duplicate_songs.main(args.folder or find_duplicate_songs.OUTPUT_DIR)
+
+
+def run_wah(args):
+    import wahwah
+    wahwah.main(
+        args.input_dir or wahwah.INPUT_DIR,
+        args.output_dir or wahwah.WAHWAH_DIR,
+        args.workers or wahwah.MAX_WORKERS,
+        args.bpm,
+    )
+
+
+def run_verify(args):
+    import run_journal
+    run_journal.main([args.run] + (["--forget-bad"] if args.forget_bad else []))
+
+
+def run_replay(args):
+    import replay
+    sys.argv = [replay.__file__, args.manifest] + args.replay_args
+    replay.main()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="songgen", description="Song generator tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, (_, _, help_text) in GENERATORS.items():
+        sub = commands.add_parser(name, help=f"generate {help_text}")
+        sub.add_argument("--songs", type=int, help="how many songs to generate (default: the script's setting)")
+        sub.set_defaults(handler=run_generator)
+
+    sub = commands.add_parser("meditation", help="long-form (1-10 hour) meditation or piano-nature tracks")
+    sub.add_argument("--mode", choices=["meditation", "piano"], default="meditation")
+    sub.add_argument("--hours", type=float, default=1.0)
+    sub.add_argument("--tracks", type=int, default=1, help="how many tracks the run should reach")
+    sub.set_defaults(handler=run_meditation)
+
+    sub = commands.add_parser("stream", help="endless lofi as 16-bit stereo PCM")
+    sub.add_argument("target", nargs="?", default="-", help="- for stdout, a FIFO path, unix:/path or tcp:host:port")
+    sub.add_argument("--wav", action="store_true", help="start with a WAV header so players can read it directly")
+    sub.add_argument("--realtime", action="store_true", help="pace blocks to the wall clock (implied for sockets)")
+    sub.add_argument("--budget-ms", type=float, default=250)
+    sub.add_argument("--seed", type=int)
+    sub.add_argument("--minutes", type=float, help="stop after this much audio")
+    sub.set_defaults(handler=run_stream)
+
+    sub = commands.add_parser("daemon", help="render jobs from a spool dir and a localhost HTTP API with warm caches")
+    sub.add_argument("--host", default="127.0.0.1")
+    sub.add_argument("--port", type=int, default=8765)
+    sub.set_defaults(handler=run_daemon)
+
+    sub = commands.add_parser("ingest", help="measure and analyse new samples (loudness, key, BPM, onsets, bars)")
+    sub.add_argument("folders", nargs="*", help="default: samples and edm_samples")
+    sub.add_argument("--workers", type=int)
+    sub.set_defaults(handler=run_ingest)
+
+    sub = commands.add_parser("convert", help="convert WAVs to MP3 with ffmpeg")
+    sub.add_argument("--input-dir", help="default: input_wavs")
+    sub.add_argument("--output-dir", help="default: output_mp3s")
+    sub.add_argument("--workers", type=int)
+    sub.add_argument("--bitrate", help="e.g. 192k")
+    sub.set_defaults(handler=run_convert)
+
+    sub = commands.add_parser("master", help="match songs to a reference track with matchering")
+    sub.add_argument("--input-dir", help="default: output_songs")
+    sub.add_argument("--output-dir", help="default: mastered_songs")
+    sub.add_argument("--reference", help="default: reference.wav")
+    sub.set_defaults(handler=run_master)
+
+    sub = commands.add_parser("dedupe", help="find songs with identical audio data (re-encoded mp3/flac copies are not matched)")
+    sub.add_argument("folder", nargs="?", help="default: output_songs")
+    sub.set_defaults(handler=run_dedupe)
+
+    sub = commands.add_parser("wah", help="apply the wah effect to every WAV in a folder")
+    sub.add_argument("--input-dir", help="default: output_songs")
+    sub.add_argument("--output-dir", help="default: wahwah_output")
+    sub.add_argument("--workers", type=int)
+    sub.add_argument("--bpm", type=float, help="sync the LFO to this tempo")
+    sub.set_defaults(handler=run_wah)
+
+    sub = commands.add_parser("verify", help="re-check a run's finished songs against its journal")
+    sub.add_argument("run", help="lofi, afro, piano, edm, edm_cohesion, longform_meditation or longform_piano")
+    sub.add_argument("--forget-bad", action="store_true", help="let the next run re-render songs that fail")
+    sub.set_defaults(handler=run_verify)
+
+    sub = commands.add_parser("replay", help="re-render one song from its manifest (see replay.py --help)")
+    sub.add_argument("manifest")
+    sub.add_argument("replay_args", nargs=argparse.REMAINDER)
+    sub.set_defaults(handler=run_replay)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import json
+from collections import OrderedDict
+from hashlib import blake2b
+import numpy as np
+from scipy.io import wavfile
+from pydub import AudioSegment
+from instrumentation import count_cache
+
+# Content-addressed: one stretched copy per (sample, rate, algorithm) for the whole library
+STRETCH_CACHE_DIR = os.path.join("song_state", "stretch_cache")
+RATE_DECIMALS = 3
+MEMORY_CACHE_ITEMS = 128
+
+_digests = {}
+_memory_cache = OrderedDict()
+_detected_bpms = None
+
+
+def sample_digest(path):
+    """Content hash of a sample file, memoised per path/mtime/size"""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in _digests:
+        h = blake2b(digest_size=12)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def quantize_rate(rate):
+    return round(float(rate), RATE_DECIMALS)
+
+
+def read_wav_float(path):
+    """Return (float32 samples shaped (frames,) or (frames, channels), sample_rate)"""
+    sample_rate, samples = wavfile.read(path)
+    if samples.dtype.kind in "iu":
+        bits = samples.dtype.itemsize * 8
+        offset = 1 << (bits - 1) if samples.dtype.kind == "u" else 0
+        samples = (samples.astype(np.float32) - offset) / float(1 << (bits - 1))
+    return samples.astype(np.float32, copy=False), sample_rate
+
+
+def to_segment(samples, sample_rate):
+    """Convert float samples to a 16-bit pydub AudioSegment without going through a temp file"""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+    return AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=int(sample_rate), channels=channels)
+
+
+def get_stretched(path, rate, algorithm, stretch_fn):
+    """Return (samples, sample_rate) of path sped up by rate, computing it at most once per library.
+
+    stretch_fn(path, rate) does the actual work and must return (float samples, sample_rate);
+    results are kept in memory (LRU) and as float32 WAVs under STRETCH_CACHE_DIR.
+    """
+    rate = quantize_rate(rate)
+    key = f"{sample_digest(path)}_{rate:.{RATE_DECIMALS}f}_{algorithm}"
+    count_cache("stretch_memory", key in _memory_cache)
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        return _memory_cache[key]
+
+    cache_path = os.path.join(STRETCH_CACHE_DIR, f"{key}.wav")
+    count_cache("stretch_disk", os.path.exists(cache_path))
+    if os.path.exists(cache_path):
+        result = read_wav_float(cache_path)
+    else:
+        samples, sample_rate = stretch_fn(path, rate)
+        result = (np.asarray(samples, dtype=np.float32), int(sample_rate))
+        os.makedirs(STRETCH_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        wavfile.write(tmp_path, result[1], result[0])
+        os.replace(tmp_path, cache_path)
+
+    _memory_cache[key] = result
+    while len(_memory_cache) > MEMORY_CACHE_ITEMS:
+        _memory_cache.popitem(last=False)
+    return result
+
+
+def get_detected_bpm(path, detect_fn):
+    """Tempo detection result for a sample, persisted alongside the stretch cache"""
+    global _detected_bpms
+    bpm_path = os.path.join(STRETCH_CACHE_DIR, "bpm.json")
+    if _detected_bpms is None:
+        try:
+            with open(bpm_path) as f:
+                _detected_bpms = json.load(f)
+        except (OSError, ValueError):
+            _detected_bpms = {}
+
+    digest = sample_digest(path)
+    if digest not in _detected_bpms:
+        _detected_bpms[digest] = float(detect_fn(path))
+        os.makedirs(STRETCH_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{bpm_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(_detected_bpms, f)
+        os.replace(tmp_path, bpm_path)
+    return _detected_bpms[digest]
@@ -0,0 +1,145 @@
+from functools import partial
+import numpy as np
+from stretch_cache import get_stretched, read_wav_float
+
+# "resample" is fastest but shifts pitch like a varispeed deck, "wsola" keeps pitch and suits
+# batch work on loops, "phase_vocoder" is the smoothest on sustained material such as pads/piano
+TIERS = ("resample", "wsola", "phase_vocoder")
+DEFAULT_TIER = "wsola"
+QUALITY_TIER = "phase_vocoder"
+
+WSOLA_FRAME = 1024
+WSOLA_TOLERANCE = 256
+PV_FFT = 2048
+PV_HOP = 512
+
+
+def _as_2d(samples):
+    samples = np.asarray(samples, dtype=np.float32)
+    return samples[:, None] if samples.ndim == 1 else samples
+
+
+def _restore_shape(result, original):
+    return result[:, 0] if np.ndim(original) == 1 else result
+
+
+def _periodic_hann(size):
+    return (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / size)).astype(np.float32)
+
+
+def _overlap_add(frames, hop):
+    """Sum frames (count, size) spaced hop apart; size must be a multiple of hop"""
+    count, size = frames.shape[:2]
+    ratio = size // hop
+    blocks = frames.reshape(count, ratio, hop, *frames.shape[2:])
+    out = np.zeros((count + ratio - 1, hop, *frames.shape[2:]), dtype=frames.dtype)
+    for j in range(ratio):
+        out[j:j + count] += blocks[:, j]
+    return out.reshape(-1, *frames.shape[2:])
+
+
+def resample_stretch(samples, rate):
+    """Linear-interpolation varispeed: duration and pitch both scale by 1/rate"""
+    x = _as_2d(samples)
+    n = x.shape[0]
+    out_len = max(1, int(round(n / rate)))
+    positions = np.minimum(np.arange(out_len) * rate, n - 1)
+    index = positions.astype(np.int64)
+    frac = (positions - index).astype(np.float32)[:, None]
+    upper = np.minimum(index + 1, n - 1)
+    return _restore_shape(x[index] * (1 - frac) + x[upper] * frac, samples)
+
+
+def wsola_stretch(samples, rate, frame=WSOLA_FRAME, tolerance=WSOLA_TOLERANCE):
+    """Waveform-similarity overlap-add; the alignment search runs on a mono mix and applies to every channel"""
+    x = _as_2d(samples)
+    n, channels = x.shape
+    hop = frame // 2
+    out_len = max(1, int(round(n / rate)))
+    count = out_len // hop + 1
+    window = _periodic_hann(frame)[:, None]
+
+    padded = np.pad(x, ((tolerance, frame + 2 * tolerance + hop + int(hop * rate) + 1), (0, 0)))
+    mono = padded.mean(axis=1)
+    search_len = frame + 2 * tolerance
+    fft_size = 1 << (search_len + frame - 1).bit_length()
+
+    out = np.zeros((count * hop + frame, channels), dtype=np.float32)
+    position = tolerance
+    for k in range(count):
+        target = int(k * hop * rate) + tolerance
+        if k:
+            # Pick the offset around target that best continues the previously placed frame
+            template = mono[position + hop:position + hop + frame]
+            region = mono[target - tolerance:target - tolerance + search_len]
+            corr = np.fft.irfft(
+                np.fft.rfft(region, fft_size) * np.conj(np.fft.rfft(template, fft_size)), fft_size
+            )[:2 * tolerance + 1]
+            position = target - tolerance + int(np.argmax(corr))
+        else:
+            position = target
+        out[k * hop:k * hop + frame] += padded[position:position + frame] * window
+    return _restore_shape(out[:out_len], samples)
+
+
+def phase_vocoder_stretch(samples, rate, n_fft=PV_FFT, hop=PV_HOP):
+    """STFT phase vocoder with the phase accumulation done as one cumulative sum per channel"""
+    x = _as_2d(samples)
+    n, channels = x.shape
+    out_len = max(1, int(round(n / rate)))
+    window = _periodic_hann(n_fft)
+    pad = n_fft // 2
+    bins = n_fft // 2 + 1
+    expected = (2 * np.pi * hop * np.arange(bins) / n_fft).astype(np.float32)
+
+    result = np.zeros((out_len, channels), dtype=np.float32)
+    for ch in range(channels):
+        signal = np.pad(x[:, ch], (pad, pad + n_fft))
+        frame_count = 1 + (signal.size - n_fft) // hop
+        frames = np.lib.stride_tricks.as_strided(
+            signal, shape=(frame_count, n_fft), strides=(signal.strides[0] * hop, signal.strides[0])
+        )
+        spec = np.fft.rfft(frames * window, axis=1)
+
+        steps = np.arange(0, frame_count - 1, rate)
+        index = steps.astype(np.int64)
+        frac = (steps - index).astype(np.float32)[:, None]
+        left, right = spec[index], spec[index + 1]
+        magnitude = (1 - frac) * np.abs(left) + frac * np.abs(right)
+
+        delta = np.angle(right) - np.angle(left) - expected
+        delta -= 2 * np.pi * np.round(delta / (2 * np.pi))
+        increments = expected + delta
+        phase = np.angle(spec[0]) + np.vstack([np.zeros((1, bins)), np.cumsum(increments[:-1], axis=0)])
+
+        out_frames = np.fft.irfft(magnitude * np.exp(1j * phase), n=n_fft, axis=1).astype(np.float32) * window
+        y = _overlap_add(out_frames, hop)
+        norm = _overlap_add(np.tile(window ** 2, (len(out_frames), 1)), hop)
+        y /= np.maximum(norm, 1e-6)
+        y = y[pad:pad + out_len]
+        result[:y.size, ch] = y
+    return _restore_shape(result, samples)
+
+
+STRETCHERS = {
+    "resample": resample_stretch,
+    "wsola": wsola_stretch,
+    "phase_vocoder": phase_vocoder_stretch,
+}
+
+
+def stretch(samples, rate, tier=DEFAULT_TIER):
+    """Speed samples up by rate (rate < 1 slows down); samples are (frames,) or (frames, channels)"""
+    if abs(rate - 1.0) < 1e-6:
+        return np.asarray(samples, dtype=np.float32)
+    return STRETCHERS[tier](samples, rate)
+
+
+def stretch_file(path, rate, tier=DEFAULT_TIER):
+    samples, sample_rate = read_wav_float(path)
+    return stretch(samples, rate, tier), sample_rate
+
+
+def load_stretched(path, rate, tier=DEFAULT_TIER):
+    """Stretched (samples, sample_rate) for a WAV file, computed once per library via the stretch cache"""
+    return get_stretched(path, rate, tier, partial(stretch_file, tier=tier))
@@ -0,0 +1,191 @@
+from functools import lru_cache
+import numpy as np
+from pydub import AudioSegment
+from fingerprint_index import segment_to_array
+from stretch_cache import to_segment
+from instrumentation import stage, register_cache_info
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+TRIM_CACHE_ITEMS = 64
+# Transitions: where a section changes a layer, the outgoing loop's tail and the incoming loop's lead-in
+# crossfade over the SECTION_CROSSFADE_MS before the boundary, so the downbeat itself is untouched; a loop
+# whose end does not meet its start dips over LOOP_SEAM_FRAMES wherever it repeats or is cut.
+SECTION_CROSSFADE_MS = 40
+LOOP_SEAM_FRAMES = 64
+SEAM_JUMP = 0.05               # end-to-start step (full scale = 1) above which a loop repeat would click
+
+
+def segment_frames(segment, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """Float32 (frames, channels) samples for a pydub AudioSegment at the timeline's format"""
+    if segment.frame_rate != sample_rate:
+        segment = segment.set_frame_rate(sample_rate)
+    if segment.channels != channels:
+        segment = segment.set_channels(channels)
+    return segment_to_array(segment)[0]
+
+
+@lru_cache(maxsize=TRIM_CACHE_ITEMS)
+def load_frames(path, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """Decode a sample once per process at the timeline's format"""
+    with stage("decode"):
+        samples = segment_frames(AudioSegment.from_wav(path), sample_rate, channels)
+    samples.flags.writeable = False
+    return samples
+
+
+@lru_cache(maxsize=TRIM_CACHE_ITEMS)
+def load_trimmed(path, length_frames, from_end=False, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """The first (or last) length_frames frames of a one-shot (riser, build), trimmed once and cached"""
+    samples = load_frames(path, sample_rate, channels)
+    return samples[-length_frames:] if from_end else samples[:length_frames]
+
+
+@lru_cache(maxsize=32)
+def equal_power(frames):
+    """(fade_in, fade_out) curves whose squares sum to one, so a crossfade keeps the level steady"""
+    t = (np.arange(frames, dtype=np.float32) + 0.5) / frames
+    return np.sin(t * np.pi / 2).astype(np.float32), np.cos(t * np.pi / 2).astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def seam_dip(frames):
+    """Fade out over frames, then back in over frames: laid across a loop's repeat point"""
+    fade_in, fade_out = equal_power(frames)
+    return np.concatenate([fade_out, fade_in])
+
+
+def seam_jump(samples):
+    """How far a loop's last frame is from its first, i.e. the step heard where it repeats"""
+    return float(np.abs(samples[-1] - samples[0]).max()) if len(samples) else 0.0
+
+
+def merge_windows(windows):
+    """(start, curve) gain windows sorted, with overlapping ones combined into one multiplied curve"""
+    merged = []
+    for start, curve in sorted(windows, key=lambda window: window[0]):
+        if merged and start < merged[-1][0] + len(merged[-1][1]):
+            first, combined = merged[-1]
+            end = max(first + len(combined), start + len(curve))
+            envelope = np.ones(end - first, dtype=np.float32)
+            envelope[:len(combined)] = combined
+            envelope[start - first:start - first + len(curve)] *= curve
+            merged[-1] = (first, envelope)
+        else:
+            merged.append((start, curve))
+    return merged
+
+
+def section_fades(sources, crossfade_frames):
+    """Per section, source -> (lead_in, fade_out) frames for place_looped. sources holds one collection of
+    source keys (e.g. sample paths) per section; a source heard on both sides of a boundary carries on
+    untouched, any other leads in before it or fades out into it. The song's own ends are left alone."""
+    fades = []
+    for i, keys in enumerate(sources):
+        previous = sources[i - 1] if i > 0 else None
+        following = sources[i + 1] if i + 1 < len(sources) else None
+        fades.append({
+            key: (crossfade_frames if previous is not None and key not in previous else 0,
+                  crossfade_frames if following is not None and key not in following else 0)
+            for key in keys
+        })
+    return fades
+
+
+register_cache_info("decoded_frames", load_frames.cache_info)
+register_cache_info("trimmed_one_shots", load_trimmed.cache_info)
+register_cache_info("transition_curves", equal_power.cache_info)
+
+
+class Timeline:
+    """A song-length float32 mix buffer; events are added in place over their own extent only"""
+
+    def __init__(self, duration_ms, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.buffer = np.zeros((self.frame_at(duration_ms), channels), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def frame_at(self, ms):
+        return int(round(ms * self.sample_rate / 1000))
+
+    def _add(self, samples, offset, gain_db=0.0):
+        """Mix samples starting at frame offset; parts before 0 or past the end are dropped"""
+        start = max(offset, 0)
+        end = min(offset + len(samples), len(self.buffer))
+        if end <= start:
+            return
+        chunk = samples[start - offset:end - offset]
+        if gain_db:
+            chunk = chunk * np.float32(10 ** (gain_db / 20))
+        self.buffer[start:end] += chunk
+
+    def place(self, samples, offset, gain_db=0.0, fade_in=0, fade_out=0):
+        """Mix samples at frame offset with optional equal-power fades (in frames) at either end; only
+        the faded frames are multiplied, the rest are added as they are"""
+        fade_in = min(fade_in, len(samples))
+        fade_out = min(fade_out, len(samples) - fade_in)
+        if fade_in:
+            self._add(samples[:fade_in] * equal_power(fade_in)[0][:, None], offset, gain_db)
+        self._add(samples[fade_in:len(samples) - fade_out], offset + fade_in, gain_db)
+        if fade_out:
+            tail_start = len(samples) - fade_out
+            self._add(samples[tail_start:] * equal_power(fade_out)[1][:, None], offset + tail_start, gain_db)
+
+    def _add_looped(self, samples, offset, start, end, gain_db, phase=0):
+        """Run frames [start, end) of samples repeated forever (run frame 0 reads loop frame phase),
+        mixed in at offset + start"""
+        position = start
+        while position < end:
+            index = (position + phase) % len(samples)
+            take = min(end - position, len(samples) - index)
+            self._add(samples[index:index + take], offset + position, gain_db)
+            position += take
+
+    def place_looped(self, samples, offset, length, gain_db=0.0, lead_in=0, fade_out=0):
+        """Repeat samples back to back over [offset, offset + length) without building the loop.
+
+        lead_in starts the loop that many frames early under an equal-power fade-in, reading its own end
+        as if it had been playing, so it crossfades with a fade_out tail ending at offset and the downbeat
+        keeps its attack. A loop whose end does not meet its start dips over LOOP_SEAM_FRAMES wherever
+        it repeats and at an edge without a fade. Only those frames are gathered and multiplied; the
+        rest are added slice by slice.
+        """
+        period = len(samples)
+        if period == 0 or length <= 0:
+            return
+        lead_in = min(lead_in, period)
+        total = length + lead_in  # run frames, starting lead_in before offset
+        fade_out = min(fade_out, total)
+        seam = min(LOOP_SEAM_FRAMES, total)
+        clicks = seam_jump(samples) > SEAM_JUMP
+        windows = []  # (run frame, gain curve) for the frames that are shaped rather than copied
+        if lead_in:
+            windows.append((0, equal_power(lead_in)[0]))
+        elif clicks:
+            windows.append((0, equal_power(seam)[0]))
+        if clicks and period >= 4 * LOOP_SEAM_FRAMES:
+            for repeat in range(lead_in or period, total - LOOP_SEAM_FRAMES + 1, period):
+                if repeat >= LOOP_SEAM_FRAMES:
+                    windows.append((repeat - LOOP_SEAM_FRAMES, seam_dip(LOOP_SEAM_FRAMES)))
+        if fade_out:
+            windows.append((total - fade_out, equal_power(fade_out)[1]))
+        elif float(np.abs(samples[(length - 1) % period] - samples[0]).max()) > SEAM_JUMP:
+            # Cut where the next section restarts this loop (or anything else) with a step
+            windows.append((total - seam, equal_power(seam)[1]))
+
+        position = 0
+        for start, curve in merge_windows(windows):
+            self._add_looped(samples, offset - lead_in, position, start, gain_db, -lead_in)
+            frames = np.take(samples, np.arange(start - lead_in, start - lead_in + len(curve)), axis=0, mode="wrap")
+            self._add(frames * curve[:, None], offset - lead_in + start, gain_db)
+            position = start + len(curve)
+        self._add_looped(samples, offset - lead_in, position, total, gain_db, -lead_in)
+
+    def place_segment(self, segment, offset, gain_db=0.0, fade_in=0, fade_out=0):
+        self.place(segment_frames(segment, self.sample_rate, self.channels), offset, gain_db, fade_in, fade_out)
+
+    def to_segment(self):
+        return to_segment(self.buffer, self.sample_rate)
@@ -0,0 +1,240 @@
+import os
+import mmap
+import fcntl
+import struct
+import math
+from contextlib import contextmanager
+import numpy as np
+
+# Shared across all generators so a restarted run never re-ships a pattern
+STATE_DIR = "song_state"
+PATTERN_STORE_PATH = os.path.join(STATE_DIR, "patterns.set")
+# Set to e.g. 50_000_000 to put a Bloom filter in front of very large stores
+BLOOM_EXPECTED_ITEMS = None
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+INITIAL_CAPACITY = 1 << 16
+MAX_LOAD = 0.6
+
+SET_MAGIC = b"SGUSET01"
+BLOOM_MAGIC = b"SGBLOOM1"
+HEADER = struct.Struct("<8sQQ")  # magic, capacity/bits, count/hash functions
+HEADER_SIZE = 32
+SLOT = struct.Struct("<Q")
+
+
+def _slot_key(value):
+    # 0 marks an empty slot on disk, so it shares a slot with 1
+    return (value & 0xFFFFFFFFFFFFFFFF) or 1
+
+
+class BloomFilter:
+    """Memory-mapped Bloom filter shared between processes through the page cache.
+
+    Creation is expected to happen under the owning store's lock.
+    """
+
+    def __init__(self, path, expected_items, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        if not os.path.exists(path):
+            num_bits = max(64, int(-expected_items * math.log(false_positive_rate) / (math.log(2) ** 2)))
+            num_hashes = max(1, round(num_bits / expected_items * math.log(2)))
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER.pack(BLOOM_MAGIC, num_bits, num_hashes).ljust(HEADER_SIZE, b"\0"))
+                f.truncate(HEADER_SIZE + (num_bits + 7) // 8)
+            os.replace(tmp_path, path)
+
+        self._file = open(path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, self.num_bits, self.num_hashes = HEADER.unpack_from(self._mm, 0)
+        if magic != BLOOM_MAGIC:
+            raise ValueError(f"{path} is not a Bloom filter file")
+
+    def _positions(self, key):
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        mm = self._mm
+        for bit in self._positions(key):
+            if not mm[HEADER_SIZE + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        mm = self._mm
+        for bit in self._positions(key):
+            offset = HEADER_SIZE + (bit >> 3)
+            mm[offset] = mm[offset] | (1 << (bit & 7))
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+class UniquenessStore:
+    """On-disk 64-bit hash set (open addressing, memory-mapped) that is safe to share between processes.
+
+    Lookups read the mapped table directly; add() is an atomic check-and-insert under an flock, so two
+    workers can never both claim the same pattern. The table doubles in place (via an atomic rename)
+    once it is more than MAX_LOAD full.
+    """
+
+    def __init__(self, path=PATTERN_STORE_PATH, bloom_expected_items=BLOOM_EXPECTED_ITEMS):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock_file = open(f"{path}.lock", "a+b")
+        self._file = None
+        self._mm = None
+        self._inode = None
+
+        self.bloom = None
+
+        with self._locked():
+            if not os.path.exists(path):
+                self._write_table(path, np.zeros(0, dtype="<u8"), INITIAL_CAPACITY)
+            self._map()
+
+            if bloom_expected_items:
+                bloom_path = f"{path}.bloom"
+                backfill = not os.path.exists(bloom_path)
+                self.bloom = BloomFilter(bloom_path, bloom_expected_items)
+                # A filter added to an existing store must know every key already in it
+                if backfill:
+                    for key in self._keys().tolist():
+                        self.bloom.add(key)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _map(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._file = open(self.path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        magic, self.capacity, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != SET_MAGIC:
+            raise ValueError(f"{self.path} is not a uniqueness store")
+
+    def _refresh(self):
+        # Another process may have grown the table and renamed a new file into place
+        if os.stat(self.path).st_ino != self._inode:
+            self._map()
+
+    def _probe(self, key):
+        """Return (found, slot_offset) for key using linear probing"""
+        mm = self._mm
+        capacity = self.capacity
+        slot = key % capacity
+        while True:
+            offset = HEADER_SIZE + slot * 8
+            current = SLOT.unpack_from(mm, offset)[0]
+            if current == key:
+                return True, offset
+            if current == 0:
+                return False, offset
+            slot = (slot + 1) % capacity
+
+    def __contains__(self, value):
+        key = _slot_key(value)
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        self._refresh()
+        return self._probe(key)[0]
+
+    def add(self, value):
+        """Insert value; returns False if it was already present (in this or any earlier run)"""
+        key = _slot_key(value)
+        with self._locked():
+            self._refresh()
+            found, offset = self._probe(key)
+            if found:
+                return False
+            SLOT.pack_into(self._mm, offset, key)
+            count = self._count() + 1
+            struct.pack_into("<Q", self._mm, 16, count)
+            if self.bloom is not None:
+                self.bloom.add(key)
+            if count > self.capacity * MAX_LOAD:
+                self._grow()
+        return True
+
+    def _count(self):
+        return HEADER.unpack_from(self._mm, 0)[2]
+
+    def __len__(self):
+        self._refresh()
+        return self._count()
+
+    def _keys(self):
+        table = np.frombuffer(self._mm, dtype="<u8", count=self.capacity, offset=HEADER_SIZE)
+        return table[table != 0].copy()
+
+    def _write_table(self, path, keys, capacity):
+        table = np.zeros(capacity, dtype="<u8")
+        slots = keys % np.uint64(capacity)
+        pending = keys
+        # Vectorised linear-probing insert: each round places the first pending key per free slot
+        while pending.size:
+            _, first = np.unique(slots, return_index=True)
+            placeable = np.zeros(pending.size, dtype=bool)
+            placeable[first] = True
+            placeable &= table[slots] == 0
+            table[slots[placeable]] = pending[placeable]
+            pending = pending[~placeable]
+            slots = (slots[~placeable] + np.uint64(1)) % np.uint64(capacity)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(SET_MAGIC, capacity, keys.size).ljust(HEADER_SIZE, b"\0"))
+            f.write(table.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _grow(self):
+        self._mm.flush()
+        self._write_table(self.path, self._keys(), self.capacity * 2)
+        self._map()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = None
+        if self.bloom is not None:
+            self.bloom.close()
+        self._lock_file.close()
+
+
+_pattern_store = None
+
+
+def get_pattern_store():
+    """Process-wide store of every shipped pattern hash, opened on first use"""
+    global _pattern_store
+    if _pattern_store is None:
+        _pattern_store = UniquenessStore(PATTERN_STORE_PATH, BLOOM_EXPECTED_ITEMS)
+    return _pattern_store
+
+
+def record_shipped(song_hash, output):
+    """Mark a pattern as shipped once its output is in its final place.
+
+    Generators only look the hash up at plan time, so a song that is rejected, fails or is killed after
+    that never marks its pattern as taken. If another worker shipped the same pattern in the meantime,
+    this output is removed and False returned.
+    """
+    if get_pattern_store().add(song_hash):
+        return True
+    os.remove(output)
+    return False
@@ -1,12 +1,15 @@
 import os
+import argparse
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from scipy.io import wavfile
-from scipy.signal import butter, lfilter
+from wav_writer import wav_header
 
-# Paths
-OUTPUT_DIR = "/Volumes/One Touch/output_songs"
+# Paths (override with --input-dir / --output-dir)
+INPUT_DIR = "output_songs"
 WAHWAH_DIR = "wahwah_output"
-os.makedirs(WAHWAH_DIR, exist_ok=True)
+MAX_WORKERS = os.cpu_count() or 4
 
 # Wahwah settings based on Audacity
 LFO_FREQ = 0.7
@@ -20,40 +23,125 @@ MAX_FREQ = 3000
 CENTER_FREQ = MIN_FREQ + FREQ_OFFSET * (MAX_FREQ - MIN_FREQ)
 OUT_SUFFIX = "_wah.wav"
 
-def wahwah_effect(data, samplerate):
-    t = np.arange(len(data)) / samplerate
-    mod = (np.sin(2 * np.pi * LFO_FREQ * t) + 1) / 2
-    depth_mod = 1 - DEPTH + DEPTH * mod
-    freqs = CENTER_FREQ * depth_mod
+# Engine settings
+BLOCK_SIZE = 1024             # samples per filter update, as in the original per-chunk design
+COEFF_TABLE_SIZE = 256        # filter designs precomputed across the LFO sweep
+LFO_BEATS_PER_CYCLE = 2       # one full sweep every two beats when synced to a BPM
+STREAM_BLOCK_FRAMES = BLOCK_SIZE * 256  # frames read per streamed block; keeps the LFO block grid intact
 
-    processed = np.zeros_like(data, dtype=np.float32)
-
-    for i in range(0, len(data), 1024):
-        fc = freqs[i]
+@lru_cache(maxsize=16)
+def coefficient_table(samplerate, table_size=COEFF_TABLE_SIZE):
+    """Band-pass SOS coefficients for table_size evenly spaced LFO positions, shape (table_size, sections, 6)"""
+    from scipy.signal import butter  # imported on first use: scipy.signal alone takes about a second to load
+    table = []
+    for mod in np.linspace(0.0, 1.0, table_size):
+        fc = CENTER_FREQ * (1 - DEPTH + DEPTH * mod)
         bw = fc / RESONANCE
         low = max(20, fc - bw / 2)
         high = min(samplerate / 2 - 1, fc + bw / 2)
+        table.append(butter(2, [low, high], btype='band', fs=samplerate, output='sos'))
+    return np.stack(table)
+
+def lfo_frequency(bpm=None):
+    return bpm / 60.0 / LFO_BEATS_PER_CYCLE if bpm else LFO_FREQ
+
+def wah_blocks(data, samplerate, zi=None, start_sample=0, bpm=None):
+    """Filter float data (frames[, channels]) block by block, continuing from zi at start_sample.
+
+    Returns (processed, zi) so a caller streaming a file in pieces can carry the filter state over.
+    """
+    from scipy.signal import sosfilt
+    table = coefficient_table(samplerate)
+    if zi is None:
+        zi = np.zeros((table.shape[1], 2) + data.shape[1:])
+
+    block_starts = np.arange(0, len(data), BLOCK_SIZE)
+    t = (start_sample + block_starts) / samplerate
+    mod = (np.sin(2 * np.pi * lfo_frequency(bpm) * t) + 1) / 2
+    table_index = np.rint(mod * (len(table) - 1)).astype(int)
+
+    processed = np.empty(data.shape, dtype=np.float32)
+    for start, index in zip(block_starts, table_index):
+        chunk = data[start:start + BLOCK_SIZE]
+        processed[start:start + BLOCK_SIZE], zi = sosfilt(table[index], chunk, axis=0, zi=zi)
+    return processed, zi
 
-        b, a = butter(2, [low, high], btype='band', fs=samplerate)
-        chunk = data[i:i+1024]
-        processed[i:i+1024] = lfilter(b, a, chunk)
+def wahwah_effect(data, samplerate, bpm=None):
+    """Apply the wah to mono or multi-channel data, keeping its dtype"""
+    processed, _ = wah_blocks(data.astype(np.float32), samplerate, bpm=bpm)
 
     gain_factor = 10 ** (OUTPUT_GAIN_DB / 20)
-    return (processed * gain_factor).astype(data.dtype)
+    processed *= gain_factor
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        processed = np.clip(processed, info.min, info.max)
+    return processed.astype(data.dtype)
+
+def write_wav_header(f, samplerate, channels, dtype, frames):
+    """PCM/float WAV header for a file whose length is known up front (RF64 past 4GB)"""
+    dtype = np.dtype(dtype)
+    f.write(wav_header(samplerate, channels, dtype.itemsize, frames * channels * dtype.itemsize, dtype.kind == "f"))
+
+def output_path_for(input_path, output_dir):
+    return os.path.join(output_dir, os.path.basename(input_path).replace(".wav", OUT_SUFFIX))
+
+def is_processed(input_path, output_path):
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+def process_file(input_path, output_path, bpm=None):
+    """Stream one file through the wah in memory-mapped blocks, writing each block as it is done"""
+    samplerate, data = wavfile.read(input_path, mmap=True)
+    channels = 1 if data.ndim == 1 else data.shape[1]
+    gain_factor = 10 ** (OUTPUT_GAIN_DB / 20)
+    limits = np.iinfo(data.dtype) if np.issubdtype(data.dtype, np.integer) else None
+
+    # Written under a temporary name so an interrupted run never looks finished
+    tmp_path = output_path + ".part"
+    zi = None
+    with open(tmp_path, "wb") as f:
+        write_wav_header(f, samplerate, channels, data.dtype, len(data))
+        for start in range(0, len(data), STREAM_BLOCK_FRAMES):
+            block = np.asarray(data[start:start + STREAM_BLOCK_FRAMES], dtype=np.float32)
+            processed, zi = wah_blocks(block, samplerate, zi=zi, start_sample=start, bpm=bpm)
+            processed *= gain_factor
+            if limits is not None:
+                processed = np.clip(processed, limits.min, limits.max)
+            f.write(processed.astype(data.dtype).tobytes())
+    del data
+    os.replace(tmp_path, output_path)
+    return input_path
 
-# Process all WAV files in OUTPUT_DIR
-for filename in os.listdir(OUTPUT_DIR):
-    if filename.endswith(".wav"):
-        input_path = os.path.join(OUTPUT_DIR, filename)
-        output_path = os.path.join(WAHWAH_DIR, filename.replace(".wav", OUT_SUFFIX))
+def main(input_dir=INPUT_DIR, output_dir=WAHWAH_DIR, workers=MAX_WORKERS, bpm=None):
+    os.makedirs(output_dir, exist_ok=True)
 
-        print(f"Processing: {input_path}")
-        samplerate, data = wavfile.read(input_path)
+    jobs = []
+    skipped = 0
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith(".wav"):
+            continue
+        input_path = os.path.join(input_dir, filename)
+        output_path = output_path_for(input_path, output_dir)
+        if is_processed(input_path, output_path):
+            skipped += 1
+            continue
+        jobs.append((input_path, output_path))
 
-        if len(data.shape) == 2:
-            data = data.mean(axis=1).astype(data.dtype)
+    print(f"🎛️ {len(jobs)} files to process, {skipped} already done, using {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_file, input_path, output_path, bpm) for input_path, output_path in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                print(f"✔️ [{done}/{len(jobs)}] {future.result()}")
+            except Exception as e:
+                print(f"❌ [{done}/{len(jobs)}] Failed: {e}")
 
-        processed = wahwah_effect(data, samplerate)
-        wavfile.write(output_path, samplerate, processed)
+    print("✅ Wahwah processing complete.")
 
-print("✅ Wahwah processing complete.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the wah effect to every WAV in a folder")
+    parser.add_argument("--input-dir", default=INPUT_DIR)
+    parser.add_argument("--output-dir", default=WAHWAH_DIR)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--bpm", type=float, default=None, help="sync the LFO to this tempo")
+    args = parser.parse_args()
+    main(args.input_dir, args.output_dir, args.workers, args.bpm)
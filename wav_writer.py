@@ -0,0 +1,103 @@
+import os
+import struct
+import subprocess
+from instrumentation import stage
+
+# Finished songs are written exactly once: the header goes out first (sizes are known up front), then
+# the PCM in blocks straight from a memoryview, one fsync, and an atomic rename. A crash leaves at most
+# a stray .part file, never a truncated or missing song.
+WRITE_BLOCK_BYTES = 1 << 20
+RIFF_MAX_DATA_BYTES = 0xFFFFFFFF - 36  # beyond this the 32-bit RIFF size overflows, so write RF64
+PCM_FORMATS = {1: "u8", 2: "s16le", 3: "s24le", 4: "s32le"}  # sample width -> ffmpeg raw format
+
+
+def wav_header(sample_rate, channels, sample_width, data_size, float_format=False):
+    """PCM/float WAV header; RF64 (EBU Tech 3306) with a ds64 chunk when data_size needs 64 bits"""
+    block_align = channels * sample_width
+    fmt = b"fmt " + struct.pack("<IHHIIHH", 16, 3 if float_format else 1, channels, sample_rate,
+                                sample_rate * block_align, block_align, sample_width * 8)
+    if data_size <= RIFF_MAX_DATA_BYTES:
+        return b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE" + fmt + b"data" + struct.pack("<I", data_size)
+    riff_size = 4 + (8 + 28) + len(fmt) + 8 + data_size
+    ds64 = b"ds64" + struct.pack("<IQQQI", 28, riff_size, data_size, data_size // block_align, 0)
+    return b"RF64" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE" + ds64 + fmt + b"data" + struct.pack("<I", 0xFFFFFFFF)
+
+
+class WavStream:
+    """A WAV whose length is known up front, written block by block and published on close.
+
+    Used as a context manager: an exception discards the partial file instead of publishing it.
+    """
+
+    def __init__(self, path, sample_rate, channels, sample_width, frames, float_format=False):
+        self.path = path
+        # Same directory as the destination, so os.replace is a rename and never a copy
+        self.tmp_path = f"{path}.{os.getpid()}.part"
+        self.data_size = frames * channels * sample_width
+        self.written = 0
+        self._f = open(self.tmp_path, "wb")
+        self._f.write(wav_header(sample_rate, channels, sample_width, self.data_size, float_format))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, pcm):
+        """Append interleaved PCM from any bytes-like object (a NumPy array works as is)"""
+        view = memoryview(pcm).cast("B")
+        for start in range(0, len(view), WRITE_BLOCK_BYTES):
+            self._f.write(view[start:start + WRITE_BLOCK_BYTES])
+        self.written += len(view)
+
+    def close(self):
+        if self.written != self.data_size:
+            self.abort()
+            raise ValueError(f"{self.path}: wrote {self.written} bytes of PCM, header says {self.data_size}")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_wav(path, pcm, sample_rate, channels, sample_width, float_format=False):
+    """Publish interleaved PCM (any bytes-like object) as a WAV at path, atomically"""
+    view = memoryview(pcm).cast("B")
+    with WavStream(path, sample_rate, channels, sample_width, len(view) // (channels * sample_width), float_format) as out:
+        out.write(view)
+    return path
+
+
+def write_segment(segment, path):
+    """Drop-in for segment.export(path, format="wav") without pydub's intermediate copies"""
+    with stage("export"):
+        return write_wav(path, segment.raw_data, segment.frame_rate, segment.channels, segment.sample_width)
+
+
+def limit_pcm(segment, limit):
+    """Run ffmpeg's alimiter over a segment through pipes; returns limited PCM in the segment's format"""
+    raw_format = PCM_FORMATS[segment.sample_width]
+    result = subprocess.run([
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", raw_format, "-ar", str(segment.frame_rate), "-ac", str(segment.channels), "-i", "pipe:0",
+        "-af", f"alimiter=limit={limit}",
+        "-f", raw_format, "pipe:1"
+    ], input=segment.raw_data, capture_output=True, check=True)
+    return result.stdout
+
+
+def write_limited(segment, path, limit):
+    """Limit and publish a finished song; the limited audio is the only thing ever written to disk"""
+    with stage("limiter"):
+        pcm = limit_pcm(segment, limit)
+    with stage("export"):
+        return write_wav(path, pcm, segment.frame_rate, segment.channels, segment.sample_width)